@@ -0,0 +1,52 @@
+import io
+import os
+import sys
+import time
+import logging
+from PIL import Image
+
+# Модули кластера находятся в родительском каталоге
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+import cluster
+import image_service_pb2
+
+logging.getLogger().setLevel(logging.WARNING)
+
+def generate_image(color, mode="RGB", size=(640, 480)):
+    byte_stream = io.BytesIO()
+    Image.new(mode, size, color).save(byte_stream, format="JPEG")
+    return byte_stream.getvalue()
+
+def worker_counts(limit):
+    """0 (декодирование в потоке gRPC), затем 1, 2, 4, ... до числа доступных ядер."""
+    counts, count = [0], 1
+    while count < limit:
+        counts.append(count)
+        count *= 2
+    counts.append(limit)
+    return counts
+
+# Пропускная способность узла кластера в зависимости от числа процессов
+def run_benchmark(images_count=512, repeats=3):
+    color_image = generate_image((255, 0, 0))
+    # Совпадения нет, поэтому узел обрабатывает все изображения
+    bw_images = [generate_image(100 + i % 100, mode="L") for i in range(images_count)]
+    request = image_service_pb2.CompareRequest(color_image=color_image, bw_images=bw_images)
+    print(f"Доступно ядер: {cluster.available_cpus()}, изображений: {images_count}")
+
+    for processes in worker_counts(cluster.available_cpus()):
+        # Кэш отключен, чтобы каждый повтор декодировал изображения заново
+        service = cluster.ImageService(cache=cluster.HistogramCache(max_entries=0), processes=processes)
+        try:
+            service.CompareImages(request, None)  # Прогрев пула процессов
+            start_time = time.perf_counter()
+            for _ in range(repeats):
+                service.CompareImages(request, None)
+            elapsed = time.perf_counter() - start_time
+        finally:
+            service.close()
+        print(f"Процессов: {processes:>3}  {images_count * repeats / elapsed:8.1f} изобр./с")
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,59 @@
+import glob
+import os
+import sys
+import time
+import logging
+
+# Модули кластера находятся в родительском каталоге
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+import cluster
+import histogram_engine
+
+logging.getLogger().setLevel(logging.WARNING)
+
+def load_corpus():
+    bw_paths = sorted(glob.glob(os.path.join(BASE_DIR, "images", "BW", "*.jpg")))
+    color_paths = [os.path.join(BASE_DIR, "images", name)
+                   for name in ("Color/test.png", "colorImage.png", "color_image.jpg", "test2.png")]
+    read = lambda path: open(path, "rb").read()
+    return [read(p) for p in bw_paths + color_paths], [read(p) for p in bw_paths]
+
+def histograms_for_mode(mode, references, bw_images, repeats=3):
+    """Гистограммы эталонов и ч/б изображений, а также время декодирования одного ч/б изображения."""
+    reference_histograms = [histogram_engine.calc_histogram(cluster.decode_grayscale(data, mode, reference=True))
+                            for data in references]
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        bw_histograms = [histogram_engine.calc_histogram(cluster.decode_grayscale(data, mode)) for data in bw_images]
+    decode_time = (time.perf_counter() - start_time) * 1000 / (repeats * len(bw_images))
+    return reference_histograms, histogram_engine.histogram_matrix(bw_histograms), decode_time
+
+def first_match_index(matches):
+    return int(matches.argmax()) if matches.any() else -1
+
+# Отчет о точности быстрых режимов декодирования относительно полного
+def run_report():
+    references, bw_images = load_corpus()
+    print(f"Эталонов: {len(references)}, ч/б изображений: {len(bw_images)}")
+    full_references, full_matrix, full_time = histograms_for_mode("full", references, bw_images)
+    full_scores = [histogram_engine.correlation_scores(hist, full_matrix) for hist in full_references]
+
+    print(f"{'режим':>9} | {'мс/изобр.':>9} | {'ускорение':>9} | {'первое совп.':>12} | {'пары':>9} | {'макс. |Δ|':>9}")
+    for mode in cluster.DECODE_MODES:
+        mode_references, mode_matrix, mode_time = histograms_for_mode(mode, references, bw_images)
+        same_first_match = 0
+        flipped_pairs = 0
+        max_delta = 0.0
+        for full_score, hist in zip(full_scores, mode_references):
+            mode_score = histogram_engine.correlation_scores(hist, mode_matrix)
+            full_match = full_score > histogram_engine.MATCH_THRESHOLD
+            mode_match = mode_score > histogram_engine.MATCH_THRESHOLD
+            same_first_match += first_match_index(full_match) == first_match_index(mode_match)
+            flipped_pairs += int((full_match != mode_match).sum())
+            max_delta = max(max_delta, float(abs(full_score - mode_score).max()))
+        print(f"{mode:>9} | {mode_time:9.2f} | {full_time / mode_time:8.2f}x | "
+              f"{same_first_match:5d} из {len(references):3d} | {flipped_pairs:3d} из {full_matrix.shape[0] * len(references)} | {max_delta:9.4f}")
+
+if __name__ == '__main__':
+    run_report()
@@ -0,0 +1,108 @@
+import glob
+import io
+import os
+import sys
+import time
+import logging
+import numpy as np
+import cv2
+from PIL import Image
+
+# Модули кластера находятся в родительском каталоге
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+import cluster
+import histogram_engine
+
+logging.getLogger().setLevel(logging.WARNING)
+
+# Прежний путь сравнения: для каждого кандидата гистограмма эталона считается заново,
+# эталон переводится в BGR, а кандидат масштабируется до размера эталона
+def legacy_score(color_image_bytes, bw_image_bytes):
+    color_array = np.array(Image.open(io.BytesIO(color_image_bytes)).convert('RGB'))
+    bw_image = cv2.cvtColor(color_array, cv2.COLOR_RGB2GRAY)
+    bw_array = np.array(Image.open(io.BytesIO(bw_image_bytes)).convert('L'))
+    bw_array_resized = cv2.resize(bw_array, (bw_image.shape[1], bw_image.shape[0]))
+    bw_image = cv2.cvtColor(bw_image, cv2.COLOR_GRAY2BGR)
+    hist_bw = cv2.calcHist([bw_image], [0], None, [256], [0, 256])
+    hist_bw_compare = cv2.calcHist([bw_array_resized], [0], None, [256], [0, 256])
+    cv2.normalize(hist_bw, hist_bw, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX)
+    cv2.normalize(hist_bw_compare, hist_bw_compare, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX)
+    return cv2.compareHist(hist_bw, hist_bw_compare, cv2.HISTCMP_CORREL)
+
+def legacy_find_match(color_image_bytes, bw_images):
+    for index, bw_image_bytes in enumerate(bw_images):
+        if legacy_score(color_image_bytes, bw_image_bytes) > histogram_engine.MATCH_THRESHOLD:
+            return index
+    return -1
+
+# Текущий путь кластера, кэш отключен, чтобы измерять именно вычисления
+def current_find_match(service, color_image_bytes, bw_images):
+    hist_bw = service.reference_histogram(color_image_bytes)
+    return service.find_match_in_batch(hist_bw, bw_images)
+
+def load_corpus():
+    bw_paths = sorted(glob.glob(os.path.join(BASE_DIR, "images", "BW", "*.jpg")))
+    color_paths = [os.path.join(BASE_DIR, "images", name)
+                   for name in ("Color/test.png", "colorImage.png", "color_image.jpg", "test2.png")]
+    read = lambda path: open(path, "rb").read()
+    return [(os.path.basename(p), read(p)) for p in bw_paths + color_paths], [read(p) for p in bw_paths]
+
+def run_benchmark(repeats=3):
+    references, bw_images = load_corpus()
+    service = cluster.ImageService(cache=cluster.HistogramCache(max_entries=0), decode_mode="full")
+    print(f"Эталонов: {len(references)}, ч/б изображений: {len(bw_images)}")
+
+    # Совпадение решений: индекс первого совпадения для каждого эталона
+    mismatches = 0
+    for name, color_image_bytes in references:
+        legacy_index = legacy_find_match(color_image_bytes, bw_images)
+        current_index = current_find_match(service, color_image_bytes, bw_images)
+        if legacy_index != current_index:
+            mismatches += 1
+            print(f"  Расхождение для {name}: было {legacy_index}, стало {current_index}")
+    print(f"Индекс первого совпадения совпал для {len(references) - mismatches} из {len(references)} эталонов")
+
+    # Отдельные пары, у которых оценка пересекла порог из-за отказа от масштабирования
+    flipped = 0
+    for name, color_image_bytes in references:
+        hist_bw = service.reference_histogram(color_image_bytes)
+        for bw_image_bytes in bw_images:
+            hist_bw_compare = histogram_engine.calc_histogram(np.array(Image.open(io.BytesIO(bw_image_bytes)).convert('L')))
+            legacy_match = legacy_score(color_image_bytes, bw_image_bytes) > histogram_engine.MATCH_THRESHOLD
+            current_match = histogram_engine.first_match(hist_bw, histogram_engine.histogram_matrix([hist_bw_compare])) == 0
+            flipped += legacy_match != current_match
+    print(f"Пар с другим решением: {flipped} из {len(references) * len(bw_images)}")
+
+    # Время на одно ч/б изображение (полный перебор без остановки на совпадении)
+    color_image_bytes = references[0][1]
+    hist_bw = service.reference_histogram(color_image_bytes)
+    timings = {}
+    for label, score in (
+            ("прежний путь", lambda data: legacy_score(color_image_bytes, data)),
+            ("текущий путь", lambda data: histogram_engine.correlation_scores(
+                hist_bw, histogram_engine.calc_histogram(np.array(Image.open(io.BytesIO(data)).convert('L')))))):
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            for data in bw_images:
+                score(data)
+        timings[label] = (time.perf_counter() - start_time) * 1000 / (repeats * len(bw_images))
+        print(f"{label}: {timings[label]:.2f} мс на изображение")
+    print(f"Ускорение: {timings['прежний путь'] / timings['текущий путь']:.2f}x")
+
+    # Ядро оценки: цикл cv2.compareHist против одной матричной операции
+    histograms = [histogram_engine.calc_histogram(np.array(Image.open(io.BytesIO(data)).convert('L')))
+                  for data in bw_images]
+    histograms = (histograms * (10000 // len(histograms) + 1))[:10000]
+    start_time = time.perf_counter()
+    for hist in histograms:
+        cv2.compareHist(hist_bw, hist, cv2.HISTCMP_CORREL)
+    loop_time = time.perf_counter() - start_time
+    matrix = histogram_engine.histogram_matrix(histograms)
+    start_time = time.perf_counter()
+    histogram_engine.correlation_scores(hist_bw, matrix)
+    batch_time = time.perf_counter() - start_time
+    print(f"Оценка {len(histograms)} гистограмм: цикл {loop_time * 1000:.1f} мс, матрица {batch_time * 1000:.1f} мс")
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -1,14 +1,24 @@
+import os
 import socket
+import sys
 import threading
 import time
 from PIL import Image
 import io
 import random
+
+# Модули сервера находятся в родительском каталоге
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import histogram_engine
 import tkinter as tk
 from tkinter import scrolledtext
 from tkinter import ttk  # Импортируем ttk для стилизации
 import matplotlib.pyplot as plt
 
+# Режим гистограмм: вместо изображений отправляются их гистограммы (см. MSG_COMPARE_FEATURES в server.py)
+MSG_COMPARE_FEATURES = 0xFFFFFF04
+SEND_FEATURES = False
+
 # Функция для генерации изображения
 def generate_image(color, size=(100, 100)):
     img = Image.new("RGB", size, color)
@@ -57,6 +67,10 @@ def generate_test_data(num_bw_images, output_callback):
     print(message)
     output_callback(message)
     
+    if SEND_FEATURES:
+        # Гистограммы вычисляются один раз, до отправки
+        color_image = histogram_engine.image_features(color_image)
+        bw_images = [histogram_engine.image_features(bw_image) for bw_image in bw_images]
     return color_image, bw_images
 
 
@@ -65,6 +79,8 @@ def client_simulation(color_image, bw_images, server_ip, server_port, output_cal
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
             client_socket.connect((server_ip, server_port))
+            if SEND_FEATURES:
+                client_socket.sendall(MSG_COMPARE_FEATURES.to_bytes(4, 'big'))
             client_socket.sendall(len(color_image).to_bytes(4, 'big'))
             client_socket.sendall(color_image)
 
@@ -194,6 +210,11 @@ class TestApp:
         self.batch_entry.insert(0, "20")
         self.batch_entry.grid(row=6, column=0, padx=10, pady=5, sticky="ew")
 
+        # Режим гистограмм: генераторы отправляют гистограммы вместо изображений
+        self.features_var = tk.BooleanVar(value=SEND_FEATURES)
+        self.features_check = ttk.Checkbutton(root, text="Передавать гистограммы", variable=self.features_var, command=self.toggle_features)
+        self.features_check.grid(row=7, column=0, padx=10, pady=5, sticky="w")
+
         # Адаптивная настройка
         self.root.grid_rowconfigure(0, weight=1)
         self.root.grid_columnconfigure(0, weight=1)
@@ -206,6 +227,10 @@ class TestApp:
         self.output_console.insert(tk.END, message + "\n")
         self.output_console.yview(tk.END)
 
+    def toggle_features(self):
+        global SEND_FEATURES
+        SEND_FEATURES = self.features_var.get()
+
     def enable_button_callback(self):
         # Включаем все кнопки после теста
         self.test_button_1.config(state=tk.NORMAL)
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+# Модули сервера находятся в родительском каталоге
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+import image_service_pb2
+import frame_protocol
+import server
+
+def send_frames(port, frame, count):
+    """Клиент в отдельном потоке: count кадров (длина + данные) и маркер конца."""
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        header = len(frame).to_bytes(4, 'big')
+        for _ in range(count):
+            sock.sendall(header)
+            sock.sendall(frame)
+        sock.sendall((0).to_bytes(4, 'big'))
+        sock.recv(4)
+
+async def receive_all(reader, writer, encode, stats, trace):
+    """Принимает кадры и собирает из них запрос к кластеру, как это делает сервер."""
+    bw_images = []
+    while True:
+        if trace:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        size = int.from_bytes(await reader.readexactly(4), 'big')
+        if not size:
+            break
+        bw_images.append(await (reader.read_frame_data(size) if hasattr(reader, 'read_frame_data')
+                                else reader.readexactly(size)))
+        if trace:
+            stats["peak"] += tracemalloc.get_traced_memory()[1] - before
+    request = encode(bw_images)
+    stats["request_bytes"] = len(request)
+    writer.write((0).to_bytes(4, 'big'))
+    await writer.drain()
+    writer.close()
+    stats["done"].set()
+
+def encode_protobuf(bw_images):
+    return image_service_pb2.CompareRequest(color_image=b"color", bw_images=bw_images).SerializeToString()
+
+def encode_raw(bw_images):
+    return server.encode_compare_request(b"color", bw_images)
+
+async def run_case(mode, frame_size, count, trace):
+    loop = asyncio.get_running_loop()
+    stats = {"peak": 0, "done": asyncio.Event()}
+    if mode == "StreamReader":
+        # Прежний прием: asyncio.StreamReader и сообщение protobuf
+        handler = lambda reader, writer: receive_all(reader, writer, encode_protobuf, stats, trace)
+        tcp_server = await asyncio.start_server(handler, '127.0.0.1', 0)
+    else:
+        handler = lambda reader, writer: receive_all(reader, writer, encode_raw, stats, trace)
+        tcp_server = await loop.create_server(lambda: frame_protocol.FrameProtocol(handler), '127.0.0.1', 0)
+    port = tcp_server.sockets[0].getsockname()[1]
+    frame = os.urandom(frame_size)
+    async with tcp_server:
+        start_time = time.perf_counter()
+        client = threading.Thread(target=send_frames, args=(port, frame, count))
+        client.start()
+        await stats["done"].wait()
+        elapsed = time.perf_counter() - start_time
+        await loop.run_in_executor(None, client.join)
+    return frame_size * count / elapsed / 2 ** 20, stats["peak"] / count / frame_size
+
+# Скорость приема (МБ/с) и объем новых буферов на изображение (в размерах изображения)
+def run_benchmark(frame_sizes=(16 * 1024, 256 * 1024, 4 * 1024 * 1024), total_mb=256):
+    print(f"{'кадр, КБ':>9} {'способ':>14} {'МБ/с':>9} {'буферов на изобр.':>18}")
+    for frame_size in frame_sizes:
+        count = max(1, total_mb * 2 ** 20 // frame_size)
+        for mode in ("StreamReader", "FrameProtocol"):
+            speed, _ = asyncio.run(run_case(mode, frame_size, count, trace=False))
+            tracemalloc.start()
+            _, buffers = asyncio.run(run_case(mode, frame_size, min(count, 200), trace=True))
+            tracemalloc.stop()
+            print(f"{frame_size // 1024:>9} {mode:>14} {speed:>9.0f} {buffers:>18.2f}")
+
+if __name__ == "__main__":
+    run_benchmark()
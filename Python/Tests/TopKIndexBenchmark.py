@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import numpy as np
+
+# Модули кластера находятся в родительском каталоге
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+import histogram_engine
+import histogram_index
+
+def generate_histograms(count, centers=500, seed=0):
+    """Синтетическая галерея: гистограммы группируются вокруг centers центров."""
+    rng = np.random.default_rng(seed)
+    base = rng.random((centers, histogram_engine.HIST_BINS)).astype(np.float32)
+    matrix = np.empty((count, histogram_engine.HIST_BINS), dtype=np.float32)
+    for start in range(0, count, 100000):
+        size = min(100000, count - start)
+        rows = base[rng.integers(0, centers, size)] + rng.normal(0, 0.05, (size, histogram_engine.HIST_BINS))
+        matrix[start:start + size] = np.clip(rows, 0, None)
+    return matrix / matrix.max(axis=1, keepdims=True)
+
+# Время поиска top-k и полнота (recall) индекса по сравнению с полным просмотром
+def run_benchmark(sizes=(10000, 100000, 1000000), k=10, queries=20, probes=histogram_index.DEFAULT_PROBES):
+    print(f"{'N':>9} {'списков':>8} {'построение, с':>14} {'полный, мс':>11} {'индекс, мс':>11} {'recall@' + str(k):>10}")
+    for size in sizes:
+        matrix = generate_histograms(size)
+        rng = np.random.default_rng(1)
+        references = matrix[rng.integers(0, size, queries)] + rng.normal(0, 0.02, (queries, histogram_engine.HIST_BINS))
+
+        start_time = time.perf_counter()
+        index = histogram_index.HistogramIndex(matrix)
+        build_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        exact = [np.argsort(-histogram_engine.correlation_scores(reference, matrix))[:k] for reference in references]
+        flat_time = (time.perf_counter() - start_time) * 1000 / queries
+
+        start_time = time.perf_counter()
+        found = [index.search(reference, k, probes)[0] for reference in references]
+        index_time = (time.perf_counter() - start_time) * 1000 / queries
+
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(exact, found)])
+        lists = 0 if index.centroids is None else len(index.centroids)
+        print(f"{size:>9} {lists:>8} {build_time:>14.2f} {flat_time:>11.2f} {index_time:>11.2f} {recall:>10.3f}")
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -1,10 +1,23 @@
+import os
 import socket
+import sys
 import threading
 import time
 from PIL import Image
 import io
 import random
 
+# Модули сервера находятся в родительском каталоге
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import histogram_engine
+
+# Режим гистограмм: вместо изображений отправляются их гистограммы (см. MSG_COMPARE_FEATURES в server.py)
+MSG_COMPARE_FEATURES = 0xFFFFFF04
+SEND_FEATURES = False
+
+# Ответ сервера "результат неизвестен": часть изображений не удалось обработать
+REPLY_UNKNOWN = 0xFFFFFFFF
+
 # Функция для генерации изображения
 def generate_image(color, size=(100, 100)):
     img = Image.new("RGB", size, color)
@@ -43,6 +56,10 @@ def generate_test_data(num_bw_images):
             print(f"Сгенерировано {i + 1}/{num_bw_images} ЧБ изображений...")
 
     print("Все ЧБ изображения сгенерированы.")
+    if SEND_FEATURES:
+        # Гистограммы вычисляются один раз, до отправки
+        color_image = histogram_engine.image_features(color_image)
+        bw_images = [histogram_engine.image_features(bw_image) for bw_image in bw_images]
     return color_image, bw_images
 
 
@@ -52,6 +69,8 @@ def client_simulation(color_image, bw_images, server_ip, server_port):
         
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
             client_socket.connect((server_ip, server_port))
+            if SEND_FEATURES:
+                client_socket.sendall(MSG_COMPARE_FEATURES.to_bytes(4, 'big'))
 
 
             # Отправка цветного изображения
@@ -68,7 +87,7 @@ def client_simulation(color_image, bw_images, server_ip, server_port):
 
             # Получение результата
             result = int.from_bytes(client_socket.recv(4), 'big')
-            print(f"Клиент получил результат: {result}")
+            print(f"Клиент получил результат: {'неизвестен' if result == REPLY_UNKNOWN else result}")
             return result
     except Exception as e:
         print(f"Ошибка в клиенте: {e}")
@@ -163,6 +182,8 @@ if __name__ == "__main__":
     SERVER_IP = "192.168.100.6"  # Замените на IP вашего сервера
     SERVER_PORT = 5000           # Замените на порт вашего сервера
 
+    SEND_FEATURES = input("Режим передачи (1 - изображения, 2 - гистограммы): ") == "2"
+
     mode = input("Выберите тест (1 - Один клиент, 2 - Несколько клиентов, 3 - Масштабируемость, 4 - Один клиент с 10,000 ЧБ изображений): ")
 
     if mode == "1":
@@ -1,12 +1,266 @@
 import tkinter as tk
-from tkinter import filedialog, messagebox, Label, Button, Frame, Listbox, Scrollbar
+from tkinter import filedialog, messagebox, Label, Button, Frame, Scrollbar
 import grpc
 import io
 import image_service_pb2
 import image_service_pb2_grpc
 from PIL import Image, ImageTk
+import queue
 import socket
+import threading
 import time
+from collections import OrderedDict
+from concurrent import futures
+from tkinter import ttk
+import histogram_engine
+
+# Адрес TCP сервера
+SERVER_ADDRESS = ('192.168.159.12', 5000)
+
+# Данные отправляются пачками не больше SEND_BATCH_BYTES; прогресс обновляется не чаще PROGRESS_POLL_MS (мс)
+SEND_BATCH_BYTES = 1024 * 1024
+PROGRESS_POLL_MS = 100
+
+# Маркер режима гистограмм (см. MSG_COMPARE_FEATURES в server.py): вместо изображений
+# передаются их гистограммы, вычисленные на клиенте, и кластеры не декодируют изображения
+MSG_COMPARE_FEATURES = 0xFFFFFF04
+
+# Ответ сервера "результат неизвестен": часть изображений не удалось обработать
+REPLY_UNKNOWN = 0xFFFFFFFF
+
+# Размер уменьшенной копии для показа и период проверки фоновой загрузки (мс)
+THUMBNAIL_SIZE = (400, 400)
+LOAD_POLL_MS = 50
+
+# Список ч/б изображений: размер миниатюры и высота строки, сколько миниатюр хранится
+# в памяти и сколько потоков их строит
+ROW_THUMBNAIL_SIZE = (48, 48)
+ROW_HEIGHT = 56
+THUMBNAIL_CACHE_ENTRIES = 256
+THUMBNAIL_WORKERS = 4
+
+def make_thumbnail(path, size):
+    """
+    Уменьшенная копия изображения для показа. JPEG декодируется сразу в уменьшенном
+    размере (масштабирование DCT в libjpeg), поэтому полное изображение не распаковывается.
+    """
+    with Image.open(path) as image:
+        image.draft(image.mode, size)
+        image.thumbnail(size)
+        # Изображение не больше size thumbnail не загружает, а файл закрывается при выходе из with
+        image.load()
+        return image
+
+def read_file(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+def read_image(path):
+    """
+    Читает файл изображения (выполняется в фоновом потоке).
+
+    :return: Пара (исходные байты файла для отправки, уменьшенная копия для показа).
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail(THUMBNAIL_SIZE)  # Уменьшаем изображение для отображения
+    return data, image
+
+class LazyImages:
+    """Данные изображений для отправки, которые читаются только в момент отправки."""
+
+    def __init__(self, count, load):
+        """
+        :param count: Число изображений.
+        :param load: Функция load(номер), возвращающая данные изображения.
+        """
+        self.count = count
+        self.load = load
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return map(self.load, range(self.count))
+
+class VirtualImageList(Frame):
+    """
+    Список ч/б изображений, в котором рисуются только видимые строки. Для строки
+    хранится только путь к файлу; миниатюры видимых строк строятся по требованию
+    в пуле потоков и хранятся в ограниченном LRU кэше, поэтому занимаемая память
+    не зависит от числа выбранных файлов.
+    """
+
+    def __init__(self, master, **options):
+        super().__init__(master, **options)
+        self.paths = []
+        self.canvas = tk.Canvas(self, bg="#f8f9fa", highlightthickness=0)
+        self.scrollbar = Scrollbar(self, command=self.yview)
+        self.canvas.config(yscrollcommand=self.scrollbar.set)
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.scrollbar.pack(side="right", fill="y")
+        self.thumbnails = OrderedDict()  # Номер строки -> PhotoImage
+        self.pending = {}  # Номер строки -> future миниатюры
+        self.failed = set()  # Строки, для которых миниатюру построить не удалось
+        self.pool = futures.ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+        self.polling = False
+        self.canvas.bind("<Configure>", lambda event: self.redraw())
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.canvas.bind(sequence, self.on_mouse_wheel)
+
+    def add_paths(self, paths):
+        self.paths.extend(paths)
+        self.canvas.config(scrollregion=(0, 0, 0, len(self.paths) * ROW_HEIGHT))
+        self.redraw()
+
+    def yview(self, *args):
+        self.canvas.yview(*args)
+        self.redraw()
+
+    def on_mouse_wheel(self, event):
+        self.canvas.yview_scroll(-1 if event.num == 4 or event.delta > 0 else 1, "units")
+        self.redraw()
+
+    def visible_rows(self):
+        top = int(self.canvas.canvasy(0)) // ROW_HEIGHT
+        bottom = int(self.canvas.canvasy(self.canvas.winfo_height())) // ROW_HEIGHT + 1
+        return range(max(top, 0), min(bottom, len(self.paths)))
+
+    def redraw(self):
+        """Перерисовывает видимые строки и запрашивает недостающие миниатюры."""
+        self.canvas.delete("row")
+        rows = self.visible_rows()
+        # Миниатюры строк, ушедших из видимой области, больше не строятся
+        for row in [row for row in self.pending if row not in rows]:
+            if self.pending[row].cancel():
+                del self.pending[row]
+        for row in rows:
+            y = row * ROW_HEIGHT + ROW_HEIGHT // 2
+            thumbnail = self.thumbnails.get(row)
+            if thumbnail is not None:
+                self.thumbnails.move_to_end(row)
+                self.canvas.create_image(4 + ROW_THUMBNAIL_SIZE[0] // 2, y, image=thumbnail, tags="row")
+            elif row not in self.pending and row not in self.failed:
+                self.pending[row] = self.pool.submit(make_thumbnail, self.paths[row], ROW_THUMBNAIL_SIZE)
+            self.canvas.create_text(ROW_THUMBNAIL_SIZE[0] + 12, y, anchor="w", text=f"Index: {row}: {self.paths[row]}",
+                                    font=("Helvetica", 10), tags="row")
+        if self.pending and not self.polling:
+            self.polling = True
+            self.after(LOAD_POLL_MS, self.collect_thumbnails)
+
+    def collect_thumbnails(self):
+        """Забирает готовые миниатюры (в цикле Tk: PhotoImage создается только в нем)."""
+        self.polling = False
+        ready = [row for row, future in self.pending.items() if future.done()]
+        for row in ready:
+            try:
+                image = self.pending.pop(row).result()
+            except Exception:
+                self.failed.add(row)
+                continue
+            self.thumbnails[row] = ImageTk.PhotoImage(image)
+            while len(self.thumbnails) > THUMBNAIL_CACHE_ENTRIES:
+                self.thumbnails.popitem(last=False)
+        if ready:
+            self.redraw()
+        elif self.pending:
+            self.polling = True
+            self.after(LOAD_POLL_MS, self.collect_thumbnails)
+
+class CancelledError(Exception):
+    """Запрос отменен пользователем."""
+
+class ResultUnknownError(Exception):
+    """Сервер не смог обработать часть изображений, поэтому результат неизвестен."""
+
+class ServerConnection:
+    """
+    Постоянное соединение с сервером: последовательные сравнения идут по одному
+    соединению. Запрос выполняется в фоновом потоке; abort() из другого потока
+    прерывает отправку или ожидание ответа.
+    """
+
+    def __init__(self, address=SERVER_ADDRESS):
+        self.address = address
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def compare(self, color_image_data, bw_images_data, send_features, progress, cancelled):
+        """
+        Отправляет запрос и ждет ответ; соединение, закрытое сервером между запросами,
+        открывается заново.
+
+        :param progress: Функция progress(отправлено, всего), вызывается из потока запроса.
+        :param cancelled: threading.Event отмены.
+        :return: Индекс совпадения (с нуля) или -1.
+        """
+        reused = self.sock is not None
+        try:
+            return self.send_request(color_image_data, bw_images_data, send_features, progress, cancelled)
+        except (ConnectionError, EOFError):
+            self.close()
+            if not reused or cancelled.is_set():
+                raise
+        return self.send_request(color_image_data, bw_images_data, send_features, progress, cancelled)
+
+    def send_request(self, color_image_data, bw_images_data, send_features, progress, cancelled):
+        with self.lock:
+            if self.sock is None:
+                self.sock = socket.create_connection(self.address)
+            sock = self.sock
+        try:
+            # Маркер режима гистограмм передается перед гистограммой эталона
+            batch = [MSG_COMPARE_FEATURES.to_bytes(4, 'big')] if send_features else []
+            batch += [len(color_image_data).to_bytes(4, 'big'), color_image_data]
+            batch_bytes = len(color_image_data)
+            for sent, bw_image_data in enumerate(bw_images_data):
+                batch += [len(bw_image_data).to_bytes(4, 'big'), bw_image_data]
+                batch_bytes += len(bw_image_data)
+                if batch_bytes >= SEND_BATCH_BYTES:
+                    self.send(sock, batch, cancelled)
+                    batch, batch_bytes = [], 0
+                    progress(sent + 1, len(bw_images_data))
+            # Сигнал окончания передачи черно-белых изображений
+            batch.append((0).to_bytes(4, 'big'))
+            self.send(sock, batch, cancelled)
+            progress(len(bw_images_data), len(bw_images_data))
+
+            # Получаем индекс соответствующего черно-белого изображения
+            reply = b""
+            while len(reply) < 4:
+                chunk = sock.recv(4 - len(reply))
+                if cancelled.is_set():
+                    raise CancelledError()
+                if not chunk:
+                    raise EOFError("Сервер закрыл соединение")
+                reply += chunk
+            if int.from_bytes(reply, 'big') == REPLY_UNKNOWN:
+                raise ResultUnknownError()
+            return int.from_bytes(reply, 'big') - 1  # Корректируем индекс
+        except OSError:
+            if cancelled.is_set():
+                raise CancelledError()
+            raise
+
+    def send(self, sock, batch, cancelled):
+        if cancelled.is_set():
+            raise CancelledError()
+        sock.sendall(b"".join(batch))
+
+    def abort(self):
+        """Прерывает текущий запрос: сервер видит закрытие соединения и отменяет обработку."""
+        self.close()
+
+    def close(self):
+        with self.lock:
+            sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
 
 class ImageComparisonApp:
     def __init__(self, master):
@@ -31,6 +285,15 @@ class ImageComparisonApp:
         self.compare_button = Button(self.button_frame, text="Сравнить Изображения", command=self.compare_images, bg="#ffc107", fg="white", font=("Helvetica", 12, "bold"), relief="flat")
         self.compare_button.pack(side="left", padx=10, pady=10)
 
+        # Режим гистограмм: изображения не передаются, на сервер уходят только их гистограммы
+        self.send_features = tk.BooleanVar(value=False)
+        self.features_check = tk.Checkbutton(self.button_frame, text="Передавать гистограммы", variable=self.send_features, bg="#f8f9fa", font=("Helvetica", 10))
+        self.features_check.pack(side="left", padx=10, pady=10)
+
+        # Кнопка отмены выполняющегося сравнения
+        self.cancel_button = Button(self.button_frame, text="Отменить", command=self.cancel_compare, bg="#dc3545", fg="white", font=("Helvetica", 12, "bold"), relief="flat", state=tk.DISABLED)
+        self.cancel_button.pack(side="left", padx=10, pady=10)
+
         # Панель для оригинального и совпадающего изображений
         self.images_frame = Frame(master, bg="#f8f9fa")
         self.images_frame.pack(pady=10, padx=20, fill="both", expand=True)
@@ -57,107 +320,186 @@ class ImageComparisonApp:
         self.toggle_button = Button(master, text="Показать/Скрыть ЧБ Изображения", command=self.toggle_bw_image_list, bg="#6c757d", fg="white", font=("Helvetica", 12, "bold"), relief="flat")
         self.toggle_button.pack(pady=10)
 
-        # Список для черно-белых изображений
-        self.bw_listbox = Listbox(self.list_frame, bg="#f8f9fa", font=("Helvetica", 10))
-        self.bw_listbox.pack(side="left", fill="both", expand=True)
-
-        # Полоса прокрутки для списка
-        self.scrollbar = Scrollbar(self.list_frame)
-        self.scrollbar.pack(side="right", fill="y")
-        self.bw_listbox.config(yscrollcommand=self.scrollbar.set)
-        self.scrollbar.config(command=self.bw_listbox.yview)
+        # Список для черно-белых изображений (рисуются только видимые строки)
+        self.bw_list = VirtualImageList(self.list_frame, bg="#f8f9fa")
+        self.bw_list.pack(side="left", fill="both", expand=True)
 
         # Статусная метка
         self.status_label = Label(master, text="", bg="#f8f9fa", font=("Helvetica", 10))
         self.status_label.pack(pady=10)
 
+        # Прогресс отправки изображений
+        self.progress = ttk.Progressbar(master, orient="horizontal", mode="determinate", length=400)
+        self.progress.pack(pady=5)
+
         self.color_image = None
-        self.bw_images = []
         self.bw_list_visible = False  # Отслеживание видимости списка
 
+        # Изображения отправляются в исходном виде, без перекодирования. Цветное изображение читается
+        # при загрузке в фоновом потоке; ч/б изображения читаются с диска только при отправке,
+        # поэтому память не зависит от числа выбранных файлов
+        self.loader = futures.ThreadPoolExecutor(max_workers=1)
+        self.color_image_data = None
+        self.color_features = None
+        self.bw_features = {}  # Номер -> гистограмма для режима гистограмм (вычисляется один раз)
+        self.pending_color = None  # Future загрузки цветного изображения
+        self.polling = False
+
+        # Сравнение выполняется в фоновом потоке, события передаются в цикл Tk через очередь
+        self.connection = ServerConnection()
+        self.events = queue.Queue()
+        self.cancelled = None  # threading.Event отмены текущего сравнения
+
     def load_color_image(self):
         file_path = filedialog.askopenfilename(filetypes=[("Файлы изображений", "*.jpg;*.jpeg;*.png")])
         if file_path:
-            self.color_image = Image.open(file_path)
-            self.color_image.thumbnail((400, 400))  # Уменьшаем изображение для отображения
-            self.show_image(self.original_label, self.color_image)
+            self.pending_color = self.loader.submit(read_image, file_path)
+            self.poll_loads()
 
     def load_bw_images(self):
         file_paths = filedialog.askopenfilenames(filetypes=[("Файлы изображений", "*.jpg;*.jpeg;*.png")])
         if file_paths:
-            for path in file_paths:
-                bw_image = Image.open(path)
-                bw_image.thumbnail((400, 400))  # Уменьшаем изображение для отображения
-                self.bw_images.append(bw_image)
-                self.bw_listbox.insert(tk.END, f"Index: {len(self.bw_images) - 1}: {path}")  # Добавляем в список с индексом
+            # Запоминаются только пути; миниатюры строятся для видимых строк списка
+            self.bw_list.add_paths(file_paths)
+
+    def poll_loads(self, block=False):
+        """
+        Забирает цветное изображение, прочитанное в фоне.
+
+        :param block: Дождаться окончания загрузки (перед отправкой запроса).
+        """
+        if self.pending_color is not None and (block or self.pending_color.done()):
+            future, self.pending_color = self.pending_color, None
+            try:
+                self.color_image_data, self.color_image = future.result()
+                self.color_features = None
+                self.show_image(self.original_label, self.color_image)
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось загрузить цветное изображение: {e}")
+
+        # Пока загрузка не закончена, проверка повторяется из цикла событий
+        if self.pending_color is not None:
+            if not self.polling:
+                self.polling = True
+                self.master.after(LOAD_POLL_MS, self.poll_loads_later)
+
+    def poll_loads_later(self):
+        self.polling = False
+        self.poll_loads()
+
+    def request_data(self, send_features):
+        """
+        Данные запроса: исходные байты файлов или их гистограммы (вычисляются один раз).
+        Ч/б изображения читаются с диска по одному во время отправки.
+        """
+        paths = list(self.bw_list.paths)
+        if not send_features:
+            return self.color_image_data, LazyImages(len(paths), lambda i: read_file(paths[i]))
+        if self.color_features is None:
+            self.color_features = histogram_engine.image_features(self.color_image_data)
+        return self.color_features, LazyImages(len(paths), lambda i: self.bw_image_features(i, paths[i]))
+
+    def bw_image_features(self, i, path):
+        features = self.bw_features.get(i)
+        if features is None:
+            features = self.bw_features[i] = histogram_engine.image_features(read_file(path))
+        return features
 
     def toggle_bw_image_list(self):
         """Переключить видимость списка черно-белых изображений."""
         if self.bw_list_visible:
-            self.bw_listbox.pack_forget()  # Скрыть список
+            self.bw_list.pack_forget()  # Скрыть список
             self.toggle_button.config(text="Показать ЧБ Изображения")  # Изменить текст кнопки
         else:
-            self.bw_listbox.pack(side="left", fill="both", expand=True)  # Показать список
+            self.bw_list.pack(side="left", fill="both", expand=True)  # Показать список
             self.toggle_button.config(text="Скрыть ЧБ Изображения")  # Изменить текст кнопки
         self.bw_list_visible = not self.bw_list_visible  # Изменить состояние видимости
 
     def compare_images(self):
-        if self.color_image is None or not self.bw_images:
+        if self.cancelled is not None:
+            return  # Предыдущее сравнение еще выполняется
+        # Файлы, которые еще читаются в фоне, дожидаемся здесь
+        self.poll_loads(block=True)
+        if self.color_image is None or not self.bw_list.paths:
             messagebox.showwarning("Предупреждение", "Пожалуйста, загрузите цветное и черно-белые изображения!")
             return
 
+        # Запрос выполняется в фоновом потоке, интерфейс остается отзывчивым
+        self.cancelled = threading.Event()
+        self.compare_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress.config(maximum=len(self.bw_list.paths), value=0)
+        self.status_label.config(text="Подготовка запроса...")
+        threading.Thread(target=self.run_compare, args=(self.send_features.get(), self.cancelled), daemon=True).start()
+        self.master.after(PROGRESS_POLL_MS, self.process_events)
+
+    def run_compare(self, send_features, cancelled):
+        """Выполняет сравнение (в фоновом потоке) и передает результат через очередь событий."""
         start_time = time.time()
-        
-        # Подготовка изображений для TCP
         try:
-            # Сериализация цветного изображения
-            color_image_bytes = io.BytesIO()
-            self.color_image.save(color_image_bytes, format='PNG')
-            color_image_data = color_image_bytes.getvalue()
-
-            # Сериализация черно-белых изображений
-            bw_images_data = []
-            for bw_image in self.bw_images:
-                bw_image_bytes = io.BytesIO()
-                bw_image.save(bw_image_bytes, format='PNG')
-                bw_images_data.append(bw_image_bytes.getvalue())
-
-            # Подключение к TCP серверу и отправка запросов
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect(('192.168.159.12', 5000))
-                # Отправляем размер цветного изображения
-                s.sendall(len(color_image_data).to_bytes(4, 'big'))
-                # Отправляем цветное изображение
-                s.sendall(color_image_data)
-
-                # Отправляем черно-белые изображения
-                for bw_image_data in bw_images_data:
-                    s.sendall(len(bw_image_data).to_bytes(4, 'big'))
-                    s.sendall(bw_image_data)
-
-                # Отправляем сигнал окончания передачи черно-белых изображений
-                s.sendall((0).to_bytes(4, 'big'))
-
-                # Получаем индекс соответствующего черно-белого изображения
-                matching_index_bytes = s.recv(4)
-                matching_index = int.from_bytes(matching_index_bytes, 'big') - 1  # Корректируем индекс
-
-            # Отображение результатов
-            if matching_index >= 0:
-                end_time = time.time()
-                # Рассчитываем время выполнения в миллисекундах
-                execution_time_ms = (end_time - start_time) * 1000
-                matching_bw_image = self.bw_images[matching_index]
-                self.show_image(self.matched_bw_label, matching_bw_image)
-                messagebox.showinfo("Результат", f"Совпадение найдено с изображением под индексом: {matching_index}. Время выполнения сравнения изображений: {execution_time_ms:.2f} мс")
-            else:
-                end_time = time.time()
-                self.matched_bw_label.config(image='', text='')  # Убираем изображение, если совпадений нет
-                messagebox.showinfo("Результат", "Совпадений изображения в черно-белом варианте не найдено.")
-
+            # Ч/б изображения читаются с диска по одному во время отправки, без перекодирования;
+            # в режиме гистограмм вместо них передаются гистограммы (1 КБ на изображение)
+            color_image_data, bw_images_data = self.request_data(send_features)
+            progress = lambda sent, total: self.events.put(("progress", sent, total))
+            matching_index = self.connection.compare(color_image_data, bw_images_data, send_features, progress, cancelled)
+            self.events.put(("result", matching_index, (time.time() - start_time) * 1000))
+        except CancelledError:
+            self.events.put(("cancelled",))
+        except ResultUnknownError:
+            # Соединение исправно: ошибка произошла на кластерах
+            self.events.put(("unknown",))
         except Exception as e:
-            messagebox.showerror("Ошибка", f"Произошла ошибка: {e}")
+            self.connection.close()
+            self.events.put(("error", e))
+
+    def cancel_compare(self):
+        if self.cancelled is not None:
+            self.cancelled.set()
+            self.connection.abort()
+            self.status_label.config(text="Отмена...")
 
+    def process_events(self):
+        """Обрабатывает события фонового сравнения в цикле Tk."""
+        finished = False
+        while not finished:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == "progress":
+                self.progress.config(value=event[1])
+                status = f"Отправлено изображений: {event[1]} из {event[2]}"
+                self.status_label.config(text=status + (", ожидание ответа..." if event[1] == event[2] else ""))
+                continue
+            finished = True
+            self.cancelled = None
+            self.compare_button.config(state=tk.NORMAL)
+            self.cancel_button.config(state=tk.DISABLED)
+            self.status_label.config(text="")
+            if event[0] == "result":
+                self.show_result(event[1], event[2])
+            elif event[0] == "cancelled":
+                self.status_label.config(text="Сравнение отменено")
+            elif event[0] == "unknown":
+                self.matched_bw_label.config(image='', text='')
+                messagebox.showwarning("Результат неизвестен",
+                                       "Часть изображений не удалось обработать на кластерах, результат неизвестен. "
+                                       "Повторите сравнение.")
+            else:
+                messagebox.showerror("Ошибка", f"Произошла ошибка: {event[1]}")
+        if not finished:
+            self.master.after(PROGRESS_POLL_MS, self.process_events)
+
+    def show_result(self, matching_index, execution_time_ms):
+        # Отображение результатов
+        if matching_index >= 0:
+            # Совпавшее изображение уменьшается при показе, JPEG декодируется сразу в нужном размере
+            matching_bw_image = make_thumbnail(self.bw_list.paths[matching_index], THUMBNAIL_SIZE)
+            self.show_image(self.matched_bw_label, matching_bw_image)
+            messagebox.showinfo("Результат", f"Совпадение найдено с изображением под индексом: {matching_index}. Время выполнения сравнения изображений: {execution_time_ms:.2f} мс")
+        else:
+            self.matched_bw_label.config(image='', text='')  # Убираем изображение, если совпадений нет
+            messagebox.showinfo("Результат", "Совпадений изображения в черно-белом варианте не найдено.")
 
     def show_image(self, label, image):
         """Отобразить изображение в указанной метке."""
@@ -5,105 +5,584 @@ import numpy as np
 import io
 import cv2
 import logging
+import threading
+import contextlib
+import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+from collections import OrderedDict
 
 import image_service_pb2
 import image_service_pb2_grpc
+import histogram_engine
+import histogram_index
 
 # Настройка логирования
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Адрес первого узла по умолчанию, остальные узлы занимают следующие порты
+DEFAULT_HOST = '192.168.159.12'
+DEFAULT_PORT = 50051
+
+# Файл конфигурации, из которого server.py читает список узлов
+CONFIG_PATH = 'config.json'
+
+# Число потоков, обрабатывающих запросы gRPC
+MAX_WORKERS = 10
+
+# Лимит на размер отправляемых и принимаемых сообщений gRPC (МБ)
+MAX_MESSAGE_MB = 100
+
+# Число процессов для декодирования и расчета гистограмм
+# (0 - все в потоках gRPC, None - по числу доступных ядер)
+PROCESSES = 0
+
+# Минимальное число изображений, которое уходит в один процесс за раз
+PROCESS_CHUNK_SIZE = 16
+
+# Число ч/б изображений, которые декодируются и оцениваются одной пачкой;
+# после пачки с совпадением остальные изображения не декодируются
+SCORING_BATCH_SIZE = 64
+
+# Режимы декодирования изображений:
+#   full - полное декодирование через PIL (в точности прежнее поведение);
+#   gray - декодирование сразу в градации серого средствами OpenCV;
+#   reduced2, reduced4, reduced8 - JPEG декодируется сразу в градации серого
+#   с уменьшением в 2/4/8 раз (масштабирование DCT в libjpeg), остальные форматы - как gray.
+# Если OpenCV не может прочитать формат, используется полное декодирование.
+# Точность режимов на images/BW проверяется скриптом Tests/DecodeAccuracyReport.py:
+# gray дает те же решения, что и full; уменьшенные режимы заметно меняют гистограммы.
+DECODE_MODES = {
+    "full": None,
+    "gray": cv2.IMREAD_GRAYSCALE,
+    "reduced2": cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    "reduced4": cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    "reduced8": cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+DECODE_MODE = "gray"
+
+def is_jpeg(image_bytes):
+    return image_bytes[:3] == b'\xff\xd8\xff'
+
+def decode_grayscale(image_bytes, mode=DECODE_MODE, reference=False):
+    """
+    Декодирует изображение в градации серого выбранным способом.
+
+    :param image_bytes: Данные изображения.
+    :param mode: Режим декодирования (ключ DECODE_MODES).
+    :param reference: Эталон в режиме full переводится в серый через RGB, как раньше.
+    :return: Изображение в градациях серого (массив NumPy uint8).
+    """
+    flag = DECODE_MODES[mode]
+    if flag is not None:
+        # Уменьшенное декодирование без потерь по времени возможно только для JPEG
+        if flag != cv2.IMREAD_GRAYSCALE and not is_jpeg(image_bytes):
+            flag = cv2.IMREAD_GRAYSCALE
+        image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), flag)
+        if image is not None:
+            return image
+
+    if reference:
+        return cv2.cvtColor(np.array(Image.open(io.BytesIO(image_bytes)).convert('RGB')), cv2.COLOR_RGB2GRAY)
+    return np.array(Image.open(io.BytesIO(image_bytes)).convert('L'))
+
+def decode_histogram(image_bytes, mode=DECODE_MODE):
+    """
+    Декодирует изображение и вычисляет его нормированную гистограмму.
+    Функция уровня модуля, чтобы ее можно было выполнять в процессе пула.
+
+    :return: Пара (гистограмма, None) или (None, текст ошибки).
+    """
+    try:
+        return histogram_engine.calc_histogram(decode_grayscale(image_bytes, mode)), None
+    except Exception as e:
+        return None, str(e)
+
+def decode_histograms(images_bytes, mode=DECODE_MODE):
+    return [decode_histogram(image_bytes, mode) for image_bytes in images_bytes]
+
+def available_cpus():
+    """
+    Число процессоров, доступных процессу, с учетом привязки к ядрам
+    и ограничения квоты CPU в cgroup (v2 и v1), как в контейнерах.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = None
+    try:
+        # cgroup v2: "<квота> <период>" или "max <период>"
+        with open('/sys/fs/cgroup/cpu.max') as file:
+            limit, period = file.read().split()
+            if limit != 'max':
+                quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as file:
+                limit = int(file.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as file:
+                period = int(file.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return max(1, cpus)
+
+# Ограничения кэша гистограмм: число записей и занимаемая память
+HISTOGRAM_CACHE_ENTRIES = 100000
+HISTOGRAM_CACHE_BYTES = 256 * 1024 * 1024
+
+class HistogramCache:
+    """
+    Потокобезопасный LRU кэш нормированных гистограмм ч/б изображений.
+    Ключ - хэш содержимого изображения, поэтому одинаковые изображения из разных
+    запросов не декодируются повторно. Размер ограничен числом записей и байтами.
+    """
+
+    def __init__(self, max_entries=HISTOGRAM_CACHE_ENTRIES, max_bytes=HISTOGRAM_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(image_bytes):
+        return hashlib.blake2b(image_bytes, digest_size=16).digest()
+
+    def get(self, key):
+        with self.lock:
+            hist = self.entries.get(key)
+            if hist is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return hist
+
+    def put(self, key, hist):
+        entry_bytes = hist.nbytes + len(key)
+        if self.max_entries <= 0 or entry_bytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = hist
+            self.size_bytes += entry_bytes
+            # Вытесняем давно не использованные записи
+            while len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size_bytes -= evicted.nbytes + len(evicted_key)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
 class ImageService(image_service_pb2_grpc.ImageServiceServicer):
+    def __init__(self, workers=MAX_WORKERS, cache=None, decode_mode=DECODE_MODE, processes=PROCESSES):
+        if decode_mode not in DECODE_MODES:
+            raise ValueError(f"Неизвестный режим декодирования: {decode_mode}")
+        self.workers = workers
+        self.decode_mode = decode_mode
+        self.cache = cache if cache is not None else HistogramCache()
+        self.in_flight = 0  # Число запросов CompareImages в обработке
+        self.lock = threading.Lock()
+        self.galleries = {}  # (имя галереи, номер части) -> индекс гистограмм (HistogramIndex)
+
+        # Декодирование ограничено GIL, поэтому для загрузки всех ядер
+        # его можно вынести в пул процессов (spawn: fork небезопасен для gRPC)
+        if processes is None:
+            processes = available_cpus()
+        self.processes = processes
+        self.process_pool = None
+        if processes > 0:
+            self.process_pool = futures.ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+            logging.info(f"Декодирование выполняется в {processes} процессах")
+
+    def close(self):
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+
+    def Ping(self, request, context):
+        # Сообщаем серверу, что кластер жив, его текущую загрузку и состояние кэша
+        with self.lock:
+            in_flight = self.in_flight
+        cache_stats = self.cache.stats()
+        return image_service_pb2.PingResponse(message="pong", in_flight=in_flight,
+                                              workers=max(self.workers, self.processes),
+                                              cache_hits=cache_stats["hits"], cache_misses=cache_stats["misses"],
+                                              cache_evictions=cache_stats["evictions"])
+
+    @contextlib.contextmanager
+    def track_request(self):
+        # Учет запросов в обработке для ответа на Ping
+        with self.lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
     def CompareImages(self, request, context):
         logging.debug("Получен запрос CompareImages")
+        if request.color_histogram:
+            with self.track_request():
+                matching_index = self.find_match_in_features(request.color_histogram, request.bw_histograms)
+            return image_service_pb2.CompareResponse(matching_index=matching_index)
+
+        with self.track_request():
+            # Гистограмма эталона вычисляется один раз на запрос
+            hist_bw = self.reference_histogram(request.color_image)
+            if hist_bw is None:
+                return image_service_pb2.CompareResponse(matching_index=-1)
+
+            matching_index = self.find_match_in_batch(hist_bw, request.bw_images, context=context)
+
+        logging.debug("Обработка изображений завершена, отправка ответа")
+        return image_service_pb2.CompareResponse(matching_index=matching_index)
+
+    def CompareImagesStream(self, request_iterator, context):
+        """
+        Потоковый вариант CompareImages: первое сообщение содержит цветное изображение,
+        далее ч/б изображения приходят порциями и обрабатываются по мере получения.
+        В памяти находится только текущая порция; после совпадения поток больше не читается.
+        """
+        logging.debug("Получен запрос CompareImagesStream")
+        with self.track_request():
+            hist_bw = None
+            color_histogram = None
+            processed = 0
+            for chunk in request_iterator:
+                if chunk.color_histogram:
+                    # Режим гистограмм: эталон и порции уже переданы гистограммами
+                    color_histogram = chunk.color_histogram
+                elif color_histogram is None and hist_bw is None:
+                    hist_bw = self.reference_histogram(chunk.color_image)
+                    if hist_bw is None:
+                        return image_service_pb2.CompareResponse(matching_index=-1)
+
+                if color_histogram is not None:
+                    matching_index = self.find_match_in_features(color_histogram, chunk.bw_histograms, start_index=processed)
+                    size = len(chunk.bw_histograms)
+                else:
+                    matching_index = self.find_match_in_batch(hist_bw, chunk.bw_images, start_index=processed, context=context)
+                    size = len(chunk.bw_images)
+                if matching_index >= 0:
+                    logging.debug(f"Совпадение найдено после {processed + size} изображений, остаток потока не читается")
+                    return image_service_pb2.CompareResponse(matching_index=matching_index)
+                processed += size
 
-        # Получаем цветное изображение
+        logging.debug(f"Поток обработан ({processed} изображений), совпадений нет")
+        return image_service_pb2.CompareResponse(matching_index=-1)
+
+    def RegisterGallery(self, request_iterator, context):
+        """
+        Сохраняет часть галереи: гистограммы ч/б изображений вычисляются один раз
+        при загрузке, последующие запросы QueryGallery передают только эталон.
+        Повторная регистрация той же части заменяет ее.
+        """
+        key = None
+        histograms = []
+        with self.track_request():
+            for chunk in request_iterator:
+                key = (chunk.gallery_id, chunk.shard)
+                histograms.extend(self.batch_histograms(list(chunk.bw_images), len(histograms)))
+            if key is None:
+                return image_service_pb2.GalleryResponse(size=0)
+            # Индекс для поиска top-k строится один раз при загрузке
+            index = histogram_index.HistogramIndex(histogram_engine.histogram_matrix(histograms))
+            with self.lock:
+                self.galleries[key] = index
+
+        logging.info(f"Галерея {key[0]} (часть {key[1]}) сохранена: {len(histograms)} изображений")
+        return image_service_pb2.GalleryResponse(size=len(histograms))
+
+    def QueryGallery(self, request, context):
+        logging.debug(f"Получен запрос QueryGallery для галереи {request.gallery_id} (часть {request.shard})")
+        with self.lock:
+            index = self.galleries.get((request.gallery_id, request.shard))
+        if index is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"Галерея {request.gallery_id} (часть {request.shard}) не найдена")
+
+        with self.track_request():
+            hist_bw = self.reference_histogram(request.color_image)
+            if hist_bw is None:
+                return image_service_pb2.CompareResponse(matching_index=-1)
+            if request.top_k <= 0:
+                return image_service_pb2.CompareResponse(matching_index=index.first_match(hist_bw))
+
+            # Режим top-k: наиболее похожие изображения независимо от порога и порядка
+            indices, scores = index.search(hist_bw, request.top_k)
+            matching_index = int(indices[0]) if len(indices) else -1
+            return image_service_pb2.CompareResponse(matching_index=matching_index, indices=indices.tolist(),
+                                                     scores=scores.tolist())
+
+    def reference_histogram(self, color_image_bytes):
+        """
+        Декодирует цветное изображение, переводит его в градации серого
+        и вычисляет нормированную гистограмму.
+
+        :return: Гистограмма эталона или None при ошибке.
+        """
+        # Получаем цветное изображение и сразу переводим его в градации серого
         try:
-            color_image = Image.open(io.BytesIO(request.color_image)).convert('RGB')
-            color_array = np.array(color_image)
-            logging.debug("Цветное изображение получено и преобразовано в массив")
+            bw_image = decode_grayscale(color_image_bytes, self.decode_mode, reference=True)
+            logging.debug(f"Цветное изображение получено и преобразовано в черно-белое ({self.decode_mode})")
         except Exception as e:
             logging.error(f"Ошибка обработки цветного изображения: {e}")
-            return image_service_pb2.CompareResponse(matching_index=-1)
+            return None
 
-        # Преобразуем цветное изображение в черно-белое
-        try:
-            bw_image = cv2.cvtColor(color_array, cv2.COLOR_RGB2GRAY)
-            logging.debug("Цветное изображение преобразовано в черно-белое")
-        except Exception as e:
-            logging.error(f"Ошибка преобразования цветного изображения в черно-белое: {e}")
-            return image_service_pb2.CompareResponse(matching_index=-1)
-
-        # Сравнение с черно-белыми изображениями из запроса
-        matching_index = -1
-        for index, bw_image_bytes in enumerate(request.bw_images):
-            try:
-                logging.debug(f"Сравнение с черно-белым изображением с индексом {index}")
-                bw_array = Image.open(io.BytesIO(bw_image_bytes)).convert('L')
-                bw_array_resized = np.array(bw_array)
-
-                # Изменение размера черно-белого изображения до размеров цветного изображения
-                bw_array_resized = cv2.resize(bw_array_resized, (color_array.shape[1], color_array.shape[0]))
-
-                # Проверка размеров изображений
-                logging.debug(f"Размер цветного изображения: {color_array.shape}, размер черно-белого: {bw_array_resized.shape}")
-                if color_array.shape[0] != bw_array_resized.shape[0] or color_array.shape[1] != bw_array_resized.shape[1]:
-                    logging.warning(f"Размеры изображений не совпадают: цветное {color_array.shape}, ч/б {bw_array_resized.shape}")
-                    continue
-
-                # Сравнение изображений
-                if self.compare_images(bw_image, bw_array_resized):
-                    matching_index = index
-                    logging.debug(f"Соответствие найдено с черно-белым изображением под индексом {matching_index}")
-                    break
-            except Exception as e:
-                logging.error(f"Ошибка обработки черно-белого изображения под индексом {index}: {e}")
+        return histogram_engine.calc_histogram(bw_image)
 
-        logging.debug("Обработка изображений завершена, отправка ответа")
-        return image_service_pb2.CompareResponse(matching_index=matching_index)
+    def find_match_in_batch(self, hist_bw, bw_images, start_index=0, context=None):
+        """
+        Ищет первое ч/б изображение, совпадающее с эталоном. Гистограммы пачки
+        собираются в матрицу, и все оценки корреляции считаются одной операцией.
+        Нормированная гистограмма не зависит от размера изображения,
+        поэтому ч/б изображения сравниваются в исходном размере.
 
-    def compare_images(self, bw_image, bw_image_to_compare):
-        # Убедимся, что черно-белое изображение в правильном формате
-        if len(bw_image.shape) == 2:
-            bw_image = cv2.cvtColor(bw_image, cv2.COLOR_GRAY2BGR)
+        :param hist_bw: Нормированная гистограмма эталона.
+        :param bw_images: Данные ч/б изображений.
+        :param start_index: Индекс первого изображения порции в запросе.
+        :param context: Контекст gRPC; если сервер отменил вызов (совпадение уже
+            найдено в части с меньшим индексом), оставшиеся пачки не обрабатываются.
+        :return: Индекс совпадения в запросе или -1.
+        """
+        # В режиме процессов пачка должна быть достаточно большой, чтобы занять все процессы
+        batch_size = max(SCORING_BATCH_SIZE, self.processes * PROCESS_CHUNK_SIZE)
+        for batch_start in range(0, len(bw_images), batch_size):
+            if context is not None and not context.is_active():
+                logging.debug(f"Вызов отменен сервером, не обработано изображений: {len(bw_images) - batch_start}")
+                return -1
+            batch = bw_images[batch_start:batch_start + batch_size]
+            first_index = start_index + batch_start
+            logging.debug(f"Сравнение с черно-белыми изображениями с индексами {first_index}-{first_index + len(batch) - 1}")
+            histograms = self.batch_histograms(batch, first_index)
+            match = histogram_engine.first_match(hist_bw, histogram_engine.histogram_matrix(histograms))
+            if match >= 0:
+                logging.debug(f"Соответствие найдено с черно-белым изображением под индексом {first_index + match}")
+                return first_index + match
 
-        # Проверяем, что размеры изображений совпадают
-        if bw_image.shape[:2] != bw_image_to_compare.shape[:2]:
-            logging.warning(f"Размеры изображений не совпадают: bw {bw_image.shape}, bw_compare {bw_image_to_compare.shape}")
-            return False
+        return -1
 
-        # Вычисление гистограмм
-        hist_bw = cv2.calcHist([bw_image], [0], None, [256], [0, 256])
-        hist_bw_compare = cv2.calcHist([bw_image_to_compare], [0], None, [256], [0, 256])
+    def find_match_in_features(self, color_histogram, bw_histograms, start_index=0):
+        """
+        Ищет первое совпадение среди гистограмм, вычисленных клиентом:
+        изображения не декодируются, все оценки считаются одной операцией.
 
-        # Нормализация гистограмм
-        cv2.normalize(hist_bw, hist_bw, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX)
-        cv2.normalize(hist_bw_compare, hist_bw_compare, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX)
+        :param color_histogram: Гистограмма эталона (histogram_engine.encode_features).
+        :param bw_histograms: Гистограммы ч/б изображений.
+        :param start_index: Индекс первой гистограммы порции в запросе.
+        :return: Индекс совпадения в запросе или -1.
+        """
+        reference = histogram_engine.decode_features([color_histogram])[0]
+        if np.isnan(reference).any():
+            logging.error("Гистограмма эталона имеет неверный размер")
+            return -1
+        match = histogram_engine.first_match(reference, histogram_engine.decode_features(bw_histograms))
+        if match >= 0:
+            logging.debug(f"Соответствие найдено с гистограммой под индексом {start_index + match}")
+            return start_index + match
+        return -1
 
-        # Сравнение гистограмм
-        score = cv2.compareHist(hist_bw, hist_bw_compare, cv2.HISTCMP_CORREL)
+    def batch_histograms(self, bw_images, first_index):
+        """
+        Нормированные гистограммы пачки ч/б изображений. Изображения из кэша
+        не декодируются; остальные декодируются в потоке или в пуле процессов.
 
-        # Установка порога для соответствия
-        threshold = 0.9  # Этот порог может быть настроен в зависимости от требований
+        :return: Список гистограмм (None для изображений, которые не удалось декодировать).
+        """
+        histograms = [None] * len(bw_images)
+        misses = []
+        repeats = []  # Повторы промахов внутри пачки заполняются после декодирования
+        missed_keys = set()
+        for offset, bw_image_bytes in enumerate(bw_images):
+            cache_key = HistogramCache.make_key(bw_image_bytes)
+            if cache_key in missed_keys:
+                repeats.append((offset, cache_key))
+                continue
+            hist_bw_compare = self.cache.get(cache_key)
+            if hist_bw_compare is None:
+                misses.append((offset, cache_key, bw_image_bytes))
+                missed_keys.add(cache_key)
+            else:
+                histograms[offset] = hist_bw_compare
+        if not misses:
+            return histograms
 
-        if score > threshold:
-            logging.info(f"Изображения совпадают с оценкой {score}")
-            return True
+        images_bytes = [bw_image_bytes for _, _, bw_image_bytes in misses]
+        if self.process_pool is None:
+            decoded = decode_histograms(images_bytes, self.decode_mode)
         else:
-            logging.info(f"Изображения не совпадают. Оценка: {score}")
-            return False
-
-def start_grpc_server(ip, port):
-    # Устанавливаем лимиты на отправляемые и принимаемые сообщения (100 МБ)
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), options=[
-        ('grpc.max_send_message_length', 100 * 1024 * 1024),
-        ('grpc.max_receive_message_length', 100 * 1024 * 1024)
+            # Делим промахи кэша поровну между процессами
+            chunk_size = max(1, math.ceil(len(images_bytes) / self.processes))
+            chunk_futures = [self.process_pool.submit(decode_histograms, images_bytes[i:i + chunk_size], self.decode_mode)
+                             for i in range(0, len(images_bytes), chunk_size)]
+            decoded = [result for future in chunk_futures for result in future.result()]
+
+        # Повторы берутся из декодированных гистограмм, а не из кэша: кэш может быть
+        # отключен, или запись может быть вытеснена в этой же пачке
+        decoded_by_key = {}
+        for (offset, cache_key, _), (hist_bw_compare, error) in zip(misses, decoded):
+            if hist_bw_compare is None:
+                logging.error(f"Ошибка обработки черно-белого изображения под индексом {first_index + offset}: {error}")
+                continue
+            self.cache.put(cache_key, hist_bw_compare)
+            decoded_by_key[cache_key] = hist_bw_compare
+            histograms[offset] = hist_bw_compare
+        for offset, cache_key in repeats:
+            histograms[offset] = decoded_by_key.get(cache_key)
+        return histograms
+
+def start_grpc_server(ip, port, workers=MAX_WORKERS, max_message_mb=MAX_MESSAGE_MB,
+                      decode_mode=DECODE_MODE, processes=PROCESSES, cpus=None,
+                      cache_entries=HISTOGRAM_CACHE_ENTRIES, cache_mb=HISTOGRAM_CACHE_BYTES // (1024 * 1024)):
+    # Привязка узла к выбранным ядрам (только там, где ОС это поддерживает)
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+        logging.info(f"Узел {ip}:{port} привязан к ядрам {sorted(cpus)}")
+
+    # Пул процессов создается до запуска gRPC
+    cache = HistogramCache(max_entries=cache_entries, max_bytes=cache_mb * 1024 * 1024)
+    service = ImageService(workers=workers, cache=cache, decode_mode=decode_mode, processes=processes)
+
+    # Устанавливаем лимиты на отправляемые и принимаемые сообщения
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=workers), options=[
+        ('grpc.max_send_message_length', max_message_mb * 1024 * 1024),
+        ('grpc.max_receive_message_length', max_message_mb * 1024 * 1024)
     ])
-    image_service_pb2_grpc.add_ImageServiceServicer_to_server(ImageService(), server)
+    image_service_pb2_grpc.add_ImageServiceServicer_to_server(service, server)
     server.add_insecure_port(f'{ip}:{port}')
     server.start()
     logging.info(f"gRPC сервер запущен на {ip}:{port}")
-    server.wait_for_termination()
+    try:
+        server.wait_for_termination()
+    finally:
+        service.close()
+
+def node_addresses(host, port, count):
+    return [{"ip": host, "port": port + i} for i in range(count)]
+
+def write_config(path, host, nodes):
+    """
+    Записывает список узлов в config.json, который читает server.py.
+    Узлы других хостов сохраняются, узлы этого хоста заменяются новыми.
+    """
+    config = {}
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            config = json.load(file)
+    clusters = [node for node in config.get("clusters", []) if node.get("ip") != host]
+    config["clusters"] = nodes + clusters
+    with open(path, 'w') as file:
+        json.dump(config, file, indent='\t')
+    logging.info(f"Список узлов ({len(config['clusters'])}) записан в {path}")
+
+def launch_nodes(host, port, count, pin_cpus=False, **options):
+    """
+    Запускает count узлов кластера в отдельных процессах на портах port, port + 1, ...
+    При pin_cpus каждый узел привязывается к своему ядру (по кругу).
+
+    :param options: Параметры start_grpc_server (workers, max_message_mb, decode_mode, processes,
+        cache_entries, cache_mb).
+    """
+    if count == 1 and not pin_cpus:
+        start_grpc_server(host, port, **options)
+        return
+
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+    context = multiprocessing.get_context('spawn')
+    nodes = []
+    for i in range(count):
+        node_cpus = {cpus[i % len(cpus)]} if pin_cpus and cpus else None
+        # Узлы не демонические: при processes > 0 узел сам создает пул процессов
+        node = context.Process(target=start_grpc_server, args=(host, port + i),
+                               kwargs=dict(options, cpus=node_cpus))
+        node.start()
+        nodes.append(node)
+    logging.info(f"Запущено узлов: {count} на портах {port}-{port + count - 1}")
+    try:
+        for node in nodes:
+            node.join()
+    except KeyboardInterrupt:
+        logging.info("Остановка узлов кластера")
+    finally:
+        for node in nodes:
+            if node.is_alive():
+                node.terminate()
+                node.join()
+
+def processes_arg(value):
+    """Значение --processes: число процессов или auto (-1) - по числу доступных ядер."""
+    if value in ('auto', '-1'):
+        return None
+    processes = int(value)
+    if processes < 0:
+        raise argparse.ArgumentTypeError("ожидается неотрицательное число или auto")
+    return processes
+
+def parse_args(argv=None, config_path=CONFIG_PATH):
+    """
+    Параметры узлов берутся из командной строки; значения по умолчанию
+    можно задать в разделе "node" файла config.json.
+    """
+    defaults = {}
+    if os.path.exists(config_path):
+        with open(config_path, 'r') as file:
+            defaults = json.load(file).get("node", {})
+
+    parser = argparse.ArgumentParser(description="Запуск узлов кластера сравнения изображений")
+    parser.add_argument('--host', default=defaults.get("host", DEFAULT_HOST), help="IP-адрес узлов")
+    parser.add_argument('--port', type=int, default=defaults.get("port", DEFAULT_PORT), help="Порт первого узла")
+    parser.add_argument('--count', type=int, default=defaults.get("count", 1),
+                        help="Число узлов на последовательных портах (0 - по числу ядер)")
+    parser.add_argument('--workers', type=int, default=defaults.get("workers", MAX_WORKERS),
+                        help="Число потоков gRPC на узел")
+    parser.add_argument('--max-message-mb', type=int, default=defaults.get("max_message_mb", MAX_MESSAGE_MB),
+                        help="Лимит размера сообщений gRPC (МБ)")
+    parser.add_argument('--decode-mode', choices=list(DECODE_MODES), default=defaults.get("decode_mode", DECODE_MODE),
+                        help="Режим декодирования изображений")
+    parser.add_argument('--processes', type=processes_arg, default=defaults.get("processes", PROCESSES),
+                        help="Число процессов декодирования на узел (0 - без пула, auto - по числу ядер)")
+    parser.add_argument('--cache-entries', type=int, default=defaults.get("cache_entries", HISTOGRAM_CACHE_ENTRIES),
+                        help="Наибольшее число гистограмм в кэше узла (0 - кэш отключен)")
+    parser.add_argument('--cache-mb', type=int,
+                        default=defaults.get("cache_mb", HISTOGRAM_CACHE_BYTES // (1024 * 1024)),
+                        help="Наибольший объем кэша гистограмм узла (МБ)")
+    parser.add_argument('--pin-cpus', action='store_true', default=defaults.get("pin_cpus", False),
+                        help="Привязать каждый узел к отдельному ядру")
+    parser.add_argument('--write-config', nargs='?', const=config_path, default=None, metavar='PATH',
+                        help="Записать список узлов в config.json для server.py")
+    parser.add_argument('--config-only', action='store_true',
+                        help="Только записать список узлов (с --write-config), не запуская узлы")
+    args = parser.parse_args(argv)
+    if args.count <= 0:
+        args.count = available_cpus()
+    return args
 
 if __name__ == '__main__':
-    # запуск кластера на определенном IP и порту
-    start_grpc_server('192.168.159.12', 50051)
+    # запуск узлов кластера с параметрами из командной строки
+    args = parse_args()
+    if args.write_config:
+        write_config(args.write_config, args.host, node_addresses(args.host, args.port, args.count))
+    if not args.config_only:
+        launch_nodes(args.host, args.port, args.count, pin_cpus=args.pin_cpus, workers=args.workers,
+                     max_message_mb=args.max_message_mb, decode_mode=args.decode_mode, processes=args.processes,
+                     cache_entries=args.cache_entries, cache_mb=args.cache_mb)
@@ -1,3 +0,0 @@
-@echo off
-python cluster3.py
-pause
\ No newline at end of file
@@ -0,0 +1,193 @@
+import asyncio
+
+# Размер заранее выделенного буфера приема одного соединения
+RECEIVE_BUFFER_BYTES = 256 * 1024
+
+# Кадры от этого размера принимаются сразу в собственный буфер точной длины (recv_into),
+# меньшие - через общий буфер соединения с одним копированием
+DIRECT_FRAME_BYTES = 64 * 1024
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """
+    Прием кадров протокола сервера без лишних копий. Данные сокета читаются
+    (recv_into) в заранее выделенный буфер соединения, а крупный кадр - сразу в
+    bytearray ровно его длины, поэтому кадр никогда не принимается частично и
+    не склеивается из временных объектов bytes.
+
+    Объект предоставляет обработчику соединения тот же набор методов, что пара
+    asyncio.StreamReader/StreamWriter (readexactly, write, drain, close, wait_closed,
+    get_extra_info), и передается ему в качестве обоих аргументов.
+    """
+
+    def __init__(self, handler, buffer_bytes=RECEIVE_BUFFER_BYTES, direct_frame_bytes=DIRECT_FRAME_BYTES):
+        """
+        :param handler: Корутина обработчика соединения handler(reader, writer).
+        :param buffer_bytes: Размер буфера приема соединения.
+        :param direct_frame_bytes: Минимальный размер кадра для приема в собственный буфер.
+        """
+        self.handler = handler
+        self.direct_frame_bytes = direct_frame_bytes
+        self.buffer = bytearray(buffer_bytes)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # Начало непрочитанных данных в буфере
+        self.end = 0  # Конец принятых данных в буфере
+        self.target = None  # Кадр, принимаемый в собственный буфер: [bytearray, memoryview, принято байт]
+        self.transport = None
+        self.task = None
+        self.waiter = None
+        self.eof = False
+        self.error = None
+        self.reading_paused = False
+        self.writing_paused = False
+        self.drain_waiter = None
+        self.closed = None
+
+    # Обратные вызовы транспорта
+
+    def connection_made(self, transport):
+        loop = asyncio.get_running_loop()
+        self.transport = transport
+        self.closed = loop.create_future()
+        self.task = loop.create_task(self.handler(self, self))
+
+    def get_buffer(self, sizehint):
+        if self.target is not None:
+            frame, view, received = self.target
+            return view[received:]
+        if self.end == len(self.buffer):
+            self.compact()
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        if self.target is not None:
+            self.target[2] += nbytes
+        else:
+            self.end += nbytes
+            # Буфер заполнен непрочитанными данными: ждем, пока обработчик их заберет
+            if self.start == 0 and self.end == len(self.buffer):
+                self.pause_reading()
+        self.wake()
+
+    def eof_received(self):
+        self.eof = True
+        self.wake()
+        return True  # Соединение остается открытым для отправки ответа
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.error = exc
+        self.wake()
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+
+    # Управление буфером
+
+    def compact(self):
+        """Переносит непрочитанный остаток в начало буфера, при нехватке места увеличивает буфер."""
+        unread = self.end - self.start
+        if self.start == 0:
+            buffer = bytearray(2 * len(self.buffer))
+            buffer[:unread] = self.view[:unread]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+            return
+        self.view[:unread] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = unread
+
+    def pause_reading(self):
+        if not self.reading_paused and not self.eof:
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+    def resume_reading(self):
+        if self.reading_paused and not self.eof:
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def wait_data(self):
+        """Ждет новых данных; при закрытом соединении возбуждает IncompleteReadError."""
+        if self.eof:
+            raise self.error or asyncio.IncompleteReadError(bytes(self.view[self.start:self.end]), None)
+        self.resume_reading()
+        self.waiter = asyncio.get_running_loop().create_future()
+        try:
+            await self.waiter
+        finally:
+            self.waiter = None
+
+    # Чтение (интерфейс StreamReader)
+
+    async def readexactly(self, n):
+        """Читает ровно n байт (одно копирование из буфера соединения)."""
+        while self.end - self.start < n:
+            if self.end - self.start + len(self.buffer) - self.end < n:
+                self.compact()
+                continue
+            await self.wait_data()
+        data = bytes(self.view[self.start:self.start + n])
+        self.consume(n)
+        return data
+
+    async def read_frame_data(self, n):
+        """
+        Читает данные кадра длины n. Крупный кадр принимается сокетом прямо в
+        bytearray длины n, без промежуточных копий; мелкий возвращается как bytes.
+        """
+        if n < self.direct_frame_bytes:
+            return await self.readexactly(n)
+        frame = bytearray(n)
+        view = memoryview(frame)
+        # Уже принятое начало кадра забирается из буфера соединения
+        received = min(n, self.end - self.start)
+        view[:received] = self.view[self.start:self.start + received]
+        self.consume(received)
+        self.target = [frame, view, received]
+        try:
+            while self.target[2] < n:
+                await self.wait_data()
+        finally:
+            self.target = None
+            view.release()
+        return frame
+
+    def consume(self, n):
+        self.start += n
+        if self.start == self.end:
+            self.start = self.end = 0
+        self.resume_reading()
+
+    # Запись (интерфейс StreamWriter)
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def write(self, data):
+        self.transport.write(data)
+
+    async def drain(self):
+        if self.error is not None:
+            raise self.error
+        if self.writing_paused and not self.closed.done():
+            self.drain_waiter = asyncio.get_running_loop().create_future()
+            await self.drain_waiter
+
+    def close(self):
+        self.transport.close()
+
+    async def wait_closed(self):
+        await self.closed
@@ -0,0 +1,97 @@
+import numpy as np
+import cv2
+
+# Число ячеек гистограммы яркости
+HIST_BINS = 256
+
+# Порог корреляции гистограмм для соответствия
+MATCH_THRESHOLD = 0.9  # Этот порог может быть настроен в зависимости от требований
+
+def calc_histogram(image):
+    """
+    Вычисляет гистограмму яркости изображения, нормированную в [0, 1].
+
+    :param image: Изображение в градациях серого (массив NumPy uint8).
+    :return: Вектор float32 длины HIST_BINS.
+    """
+    hist = cv2.calcHist([image], [0], None, [HIST_BINS], [0, HIST_BINS])
+    cv2.normalize(hist, hist, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX)
+    return hist.ravel()
+
+def histogram_matrix(histograms):
+    """
+    Собирает гистограммы в матрицу (N, HIST_BINS) float32.
+    Вместо отсутствующей гистограммы (None) подставляется строка NaN,
+    которая никогда не проходит порог.
+    """
+    matrix = np.full((len(histograms), HIST_BINS), np.nan, dtype=np.float32)
+    for row, hist in enumerate(histograms):
+        if hist is not None:
+            matrix[row] = np.asarray(hist, dtype=np.float32).ravel()
+    return matrix
+
+def correlation_scores(reference, matrix):
+    """
+    Коэффициенты корреляции эталона со всеми строками матрицы одной операцией.
+    Совпадает с cv2.compareHist(..., cv2.HISTCMP_CORREL), включая случай нулевой
+    дисперсии (оценка 1.0).
+
+    :param reference: Гистограмма эталона (HIST_BINS,).
+    :param matrix: Матрица гистограмм (N, HIST_BINS).
+    :return: Вектор оценок (N,) float64.
+    """
+    reference = np.asarray(reference, dtype=np.float64).ravel()
+    matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, HIST_BINS)
+    reference_centered = reference - reference.mean()
+
+    # Эталон центрирован, поэтому M·r = (M - mean(M))·r: матрицу центрировать не нужно.
+    # Строка NaN дает NaN в числителе и никогда не проходит порог
+    numerator = matrix @ reference_centered.astype(np.float32)
+    row_sums = matrix.sum(axis=1, dtype=np.float64)
+    row_variance = np.einsum('ij,ij->i', matrix, matrix, dtype=np.float64) - row_sums * row_sums / HIST_BINS
+    denominator = row_variance * reference_centered.dot(reference_centered)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = numerator / np.sqrt(denominator)
+    # Как в OpenCV: при нулевой дисперсии гистограммы считаются совпадающими
+    scores[np.abs(denominator) <= np.finfo(np.float32).eps] = 1.0
+    return scores
+
+def first_match(reference, matrix, threshold=MATCH_THRESHOLD):
+    """
+    Индекс первой строки матрицы, корреляция которой с эталоном выше порога.
+
+    :return: Индекс строки или -1, если совпадений нет.
+    """
+    if len(matrix) == 0:
+        return -1
+    matches = np.flatnonzero(correlation_scores(reference, matrix) > threshold)
+    return int(matches[0]) if len(matches) else -1
+
+# Гистограмма в протоколе передается как HIST_BINS чисел float32 (little-endian)
+FEATURE_DTYPE = np.dtype('<f4')
+FEATURE_BYTES = HIST_BINS * FEATURE_DTYPE.itemsize
+
+def encode_features(hist):
+    """Байтовое представление гистограммы для передачи вместо изображения."""
+    return np.asarray(hist, dtype=FEATURE_DTYPE).ravel().tobytes()
+
+def decode_features(features):
+    """
+    Собирает переданные гистограммы в матрицу (N, HIST_BINS) без декодирования изображений.
+    Данные неверной длины заменяются строкой NaN, которая никогда не проходит порог.
+    """
+    matrix = np.full((len(features), HIST_BINS), np.nan, dtype=np.float32)
+    for row, data in enumerate(features):
+        if len(data) == FEATURE_BYTES:
+            matrix[row] = np.frombuffer(data, dtype=FEATURE_DTYPE)
+    return matrix
+
+def image_features(image_bytes):
+    """
+    Гистограмма изображения в виде для передачи (вычисляется на стороне клиента).
+    Изображение декодируется в градации серого так же, как на кластере.
+    """
+    image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError("Не удалось декодировать изображение")
+    return encode_features(calc_histogram(image))
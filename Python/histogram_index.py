@@ -0,0 +1,107 @@
+import numpy as np
+
+import histogram_engine
+
+# Начиная с этого размера галереи строится разбиение на списки (IVF),
+# меньшие галереи просматриваются полностью
+INDEX_MIN_SIZE = 4096
+
+# Сколько ближайших списков просматривается при поиске
+DEFAULT_PROBES = 8
+
+# Параметры обучения центроидов (сферический k-means)
+TRAIN_SAMPLE_SIZE = 65536
+TRAIN_ITERATIONS = 10
+
+# Размер пачки строк при распределении по спискам (ограничивает память)
+ASSIGN_BATCH_SIZE = 16384
+
+def unit_centered(matrix):
+    """
+    Центрирует строки и нормирует их к единичной длине: скалярное произведение
+    таких векторов равно коэффициенту корреляции исходных гистограмм.
+    Строки NaN и строки с нулевой дисперсией становятся нулевыми.
+    """
+    matrix = np.nan_to_num(np.asarray(matrix, dtype=np.float32).reshape(-1, histogram_engine.HIST_BINS))
+    centered = matrix - matrix.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(centered, axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(norms > 0, centered / norms, 0).astype(np.float32)
+
+class HistogramIndex:
+    """
+    Индекс нормированных гистограмм для поиска k наиболее похожих изображений.
+    Большая галерея делится на списки вокруг центроидов (IVF): при поиске
+    точные оценки считаются только для строк из probes ближайших списков,
+    поэтому время поиска растет медленнее размера галереи.
+    """
+
+    def __init__(self, matrix, lists=None, seed=0):
+        """
+        :param matrix: Матрица гистограмм (N, HIST_BINS), строки NaN не находятся.
+        :param lists: Число списков; по умолчанию sqrt(N) для галерей от INDEX_MIN_SIZE, иначе 0.
+        """
+        self.matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, histogram_engine.HIST_BINS)
+        self.valid = ~np.isnan(self.matrix).any(axis=1)
+        size = len(self.matrix)
+        if lists is None:
+            lists = int(np.sqrt(size)) if size >= INDEX_MIN_SIZE else 0
+        self.centroids = None
+        if lists > 0 and self.valid.sum() >= lists:
+            self.build_lists(min(lists, int(self.valid.sum())), np.random.default_rng(seed))
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def build_lists(self, lists, rng):
+        valid_ids = np.flatnonzero(self.valid)
+
+        # Центроиды обучаются на случайной выборке строк
+        sample_ids = valid_ids if len(valid_ids) <= TRAIN_SAMPLE_SIZE else rng.choice(valid_ids, TRAIN_SAMPLE_SIZE, replace=False)
+        sample = unit_centered(self.matrix[sample_ids])
+        centroids = sample[rng.choice(len(sample), lists, replace=False)]
+        for _ in range(TRAIN_ITERATIONS):
+            assignment = (sample @ centroids.T).argmax(axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Пустой список сохраняет прежний центроид
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids).astype(np.float32)
+        self.centroids = centroids
+
+        # Все строки распределяются по спискам пачками
+        assignment = np.empty(len(valid_ids), dtype=np.int64)
+        for start in range(0, len(valid_ids), ASSIGN_BATCH_SIZE):
+            batch = unit_centered(self.matrix[valid_ids[start:start + ASSIGN_BATCH_SIZE]])
+            assignment[start:start + len(batch)] = (batch @ centroids.T).argmax(axis=1)
+        order = np.argsort(assignment, kind='stable')
+        self.list_ids = valid_ids[order]
+        self.list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=lists))))
+
+    def candidates(self, reference, probes):
+        """Номера строк, для которых при поиске считаются точные оценки."""
+        if self.centroids is None:
+            return np.flatnonzero(self.valid)
+        probes = min(probes, len(self.centroids))
+        centroid_scores = self.centroids @ unit_centered(reference)[0]
+        nearest = np.argpartition(-centroid_scores, probes - 1)[:probes]
+        return np.concatenate([self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in nearest])
+
+    def search(self, reference, k, probes=DEFAULT_PROBES):
+        """
+        Находит k строк с наибольшей корреляцией с эталоном.
+
+        :return: Пара массивов (номера строк, оценки) по убыванию оценки.
+        """
+        ids = self.candidates(reference, probes)
+        if k <= 0 or len(ids) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        scores = histogram_engine.correlation_scores(reference, self.matrix[ids])
+        k = min(k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((ids[top], -scores[top]))]
+        return ids[top], scores[top]
+
+    def first_match(self, reference, threshold=histogram_engine.MATCH_THRESHOLD):
+        """Первая строка выше порога (полный просмотр, как в CompareImages)."""
+        return histogram_engine.first_match(reference, self.matrix, threshold)
@@ -2,6 +2,8 @@ import cv2
 import numpy as np
 import matplotlib.pyplot as plt
 
+import histogram_engine
+
 def calculate_and_plot_histograms(color_image_path, bw_image_paths):
     # Загрузка цветного изображения
     color_image = cv2.imread(color_image_path)
@@ -12,7 +14,6 @@ def calculate_and_plot_histograms(color_image_path, bw_image_paths):
     hist_color = hist_color / hist_color.sum()  # Нормализация
 
     # Хранение результатов
-    correlations = []
     histograms_bw = []
 
     for bw_image_path in bw_image_paths:
@@ -24,9 +25,8 @@ def calculate_and_plot_histograms(color_image_path, bw_image_paths):
         hist_bw = hist_bw / hist_bw.sum()  # Нормализация
         histograms_bw.append(hist_bw)
 
-        # Сравнение гистограмм
-        correlation = cv2.compareHist(hist_color, hist_bw, cv2.HISTCMP_CORREL)
-        correlations.append(correlation)
+    # Сравнение гистограмм: все коэффициенты корреляции одной операцией
+    correlations = list(histogram_engine.correlation_scores(hist_color, histogram_engine.histogram_matrix(histograms_bw)))
 
     # Построение графиков гистограмм
     plt.figure(figsize=(12, 8))
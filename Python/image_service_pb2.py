@@ -24,7 +24,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x13image_service.proto\x12\x0fimageprocessing\"8\n\x0e\x43ompareRequest\x12\x13\n\x0b\x63olor_image\x18\x01 \x01(\x0c\x12\x11\n\tbw_images\x18\x02 \x03(\x0c\")\n\x0f\x43ompareResponse\x12\x16\n\x0ematching_index\x18\x01 \x01(\x05\"\r\n\x0bPingRequest\"\x1f\n\x0cPingResponse\x12\x0f\n\x07message\x18\x01 \x01(\t2\xa7\x01\n\x0cImageService\x12R\n\rCompareImages\x12\x1f.imageprocessing.CompareRequest\x1a .imageprocessing.CompareResponse\x12\x43\n\x04Ping\x12\x1c.imageprocessing.PingRequest\x1a\x1d.imageprocessing.PingResponseb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x13image_service.proto\x12\x0fimageprocessing\"h\n\x0e\x43ompareRequest\x12\x13\n\x0b\x63olor_image\x18\x01 \x01(\x0c\x12\x11\n\tbw_images\x18\x02 \x03(\x0c\x12\x17\n\x0f\x63olor_histogram\x18\x03 \x01(\x0c\x12\x15\n\rbw_histograms\x18\x04 \x03(\x0c\"f\n\x0c\x43ompareChunk\x12\x13\n\x0b\x63olor_image\x18\x01 \x01(\x0c\x12\x11\n\tbw_images\x18\x02 \x03(\x0c\x12\x17\n\x0f\x63olor_histogram\x18\x03 \x01(\x0c\x12\x15\n\rbw_histograms\x18\x04 \x03(\x0c\"J\n\x0f\x43ompareResponse\x12\x16\n\x0ematching_index\x18\x01 \x01(\x05\x12\x0f\n\x07indices\x18\x02 \x03(\x05\x12\x0e\n\x06scores\x18\x03 \x03(\x02\"D\n\x0cGalleryChunk\x12\x12\n\ngallery_id\x18\x01 \x01(\t\x12\r\n\x05shard\x18\x02 \x01(\x05\x12\x11\n\tbw_images\x18\x03 \x03(\x0c\"\x1f\n\x0fGalleryResponse\x12\x0c\n\x04size\x18\x01 \x01(\x05\"U\n\x0cGalleryQuery\x12\x12\n\ngallery_id\x18\x01 \x01(\t\x12\r\n\x05shard\x18\x02 \x01(\x05\x12\x13\n\x0b\x63olor_image\x18\x03 \x01(\x0c\x12\r\n\x05top_k\x18\x04 \x01(\x05\"\r\n\x0bPingRequest\"\x86\x01\n\x0cPingResponse\x12\x0f\n\x07message\x18\x01 \x01(\t\x12\x11\n\tin_flight\x18\x02 \x01(\x05\x12\x0f\n\x07workers\x18\x03 \x01(\x05\x12\x12\n\ncache_hits\x18\x04 \x01(\x03\x12\x14\n\x0c\x63\x61\x63he_misses\x18\x05 \x01(\x03\x12\x17\n\x0f\x63\x61\x63he_evictions\x18\x06 \x01(\x03\x32\xa8\x03\n\x0cImageService\x12R\n\rCompareImages\x12\x1f.imageprocessing.CompareRequest\x1a .imageprocessing.CompareResponse\x12X\n\x13\x43ompareImagesStream\x12\x1d.imageprocessing.CompareChunk\x1a .imageprocessing.CompareResponse(\x01\x12\x43\n\x04Ping\x12\x1c.imageprocessing.PingRequest\x1a\x1d.imageprocessing.PingResponse\x12T\n\x0fRegisterGallery\x12\x1d.imageprocessing.GalleryChunk\x1a .imageprocessing.GalleryResponse(\x01\x12O\n\x0cQueryGallery\x12\x1d.imageprocessing.GalleryQuery\x1a .imageprocessing.CompareResponseb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -32,13 +32,21 @@ _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'image_service_pb2', _global
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
   _globals['_COMPAREREQUEST']._serialized_start=40
-  _globals['_COMPAREREQUEST']._serialized_end=96
-  _globals['_COMPARERESPONSE']._serialized_start=98
-  _globals['_COMPARERESPONSE']._serialized_end=139
-  _globals['_PINGREQUEST']._serialized_start=141
-  _globals['_PINGREQUEST']._serialized_end=154
-  _globals['_PINGRESPONSE']._serialized_start=156
-  _globals['_PINGRESPONSE']._serialized_end=187
-  _globals['_IMAGESERVICE']._serialized_start=190
-  _globals['_IMAGESERVICE']._serialized_end=357
+  _globals['_COMPAREREQUEST']._serialized_end=144
+  _globals['_COMPARECHUNK']._serialized_start=146
+  _globals['_COMPARECHUNK']._serialized_end=248
+  _globals['_COMPARERESPONSE']._serialized_start=250
+  _globals['_COMPARERESPONSE']._serialized_end=324
+  _globals['_GALLERYCHUNK']._serialized_start=326
+  _globals['_GALLERYCHUNK']._serialized_end=394
+  _globals['_GALLERYRESPONSE']._serialized_start=396
+  _globals['_GALLERYRESPONSE']._serialized_end=427
+  _globals['_GALLERYQUERY']._serialized_start=429
+  _globals['_GALLERYQUERY']._serialized_end=514
+  _globals['_PINGREQUEST']._serialized_start=516
+  _globals['_PINGREQUEST']._serialized_end=529
+  _globals['_PINGRESPONSE']._serialized_start=532
+  _globals['_PINGRESPONSE']._serialized_end=666
+  _globals['_IMAGESERVICE']._serialized_start=669
+  _globals['_IMAGESERVICE']._serialized_end=1093
 # @@protoc_insertion_point(module_scope)
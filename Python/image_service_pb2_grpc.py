@@ -39,11 +39,26 @@ class ImageServiceStub(object):
                 request_serializer=image__service__pb2.CompareRequest.SerializeToString,
                 response_deserializer=image__service__pb2.CompareResponse.FromString,
                 _registered_method=True)
+        self.CompareImagesStream = channel.stream_unary(
+                '/imageprocessing.ImageService/CompareImagesStream',
+                request_serializer=image__service__pb2.CompareChunk.SerializeToString,
+                response_deserializer=image__service__pb2.CompareResponse.FromString,
+                _registered_method=True)
         self.Ping = channel.unary_unary(
                 '/imageprocessing.ImageService/Ping',
                 request_serializer=image__service__pb2.PingRequest.SerializeToString,
                 response_deserializer=image__service__pb2.PingResponse.FromString,
                 _registered_method=True)
+        self.RegisterGallery = channel.stream_unary(
+                '/imageprocessing.ImageService/RegisterGallery',
+                request_serializer=image__service__pb2.GalleryChunk.SerializeToString,
+                response_deserializer=image__service__pb2.GalleryResponse.FromString,
+                _registered_method=True)
+        self.QueryGallery = channel.unary_unary(
+                '/imageprocessing.ImageService/QueryGallery',
+                request_serializer=image__service__pb2.GalleryQuery.SerializeToString,
+                response_deserializer=image__service__pb2.CompareResponse.FromString,
+                _registered_method=True)
 
 
 class ImageServiceServicer(object):
@@ -55,12 +70,32 @@ class ImageServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def CompareImagesStream(self, request_iterator, context):
+        """Потоковый вариант: первое сообщение несет цветное изображение, затем ч/б порциями
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def Ping(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def RegisterGallery(self, request_iterator, context):
+        """Галерея: ч/б изображения загружаются один раз, кластер хранит их гистограммы
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def QueryGallery(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_ImageServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -69,11 +104,26 @@ def add_ImageServiceServicer_to_server(servicer, server):
                     request_deserializer=image__service__pb2.CompareRequest.FromString,
                     response_serializer=image__service__pb2.CompareResponse.SerializeToString,
             ),
+            'CompareImagesStream': grpc.stream_unary_rpc_method_handler(
+                    servicer.CompareImagesStream,
+                    request_deserializer=image__service__pb2.CompareChunk.FromString,
+                    response_serializer=image__service__pb2.CompareResponse.SerializeToString,
+            ),
             'Ping': grpc.unary_unary_rpc_method_handler(
                     servicer.Ping,
                     request_deserializer=image__service__pb2.PingRequest.FromString,
                     response_serializer=image__service__pb2.PingResponse.SerializeToString,
             ),
+            'RegisterGallery': grpc.stream_unary_rpc_method_handler(
+                    servicer.RegisterGallery,
+                    request_deserializer=image__service__pb2.GalleryChunk.FromString,
+                    response_serializer=image__service__pb2.GalleryResponse.SerializeToString,
+            ),
+            'QueryGallery': grpc.unary_unary_rpc_method_handler(
+                    servicer.QueryGallery,
+                    request_deserializer=image__service__pb2.GalleryQuery.FromString,
+                    response_serializer=image__service__pb2.CompareResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'imageprocessing.ImageService', rpc_method_handlers)
@@ -112,6 +162,33 @@ class ImageService(object):
             metadata,
             _registered_method=True)
 
+    @staticmethod
+    def CompareImagesStream(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(
+            request_iterator,
+            target,
+            '/imageprocessing.ImageService/CompareImagesStream',
+            image__service__pb2.CompareChunk.SerializeToString,
+            image__service__pb2.CompareResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
     @staticmethod
     def Ping(request,
             target,
@@ -138,3 +215,57 @@ class ImageService(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def RegisterGallery(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(
+            request_iterator,
+            target,
+            '/imageprocessing.ImageService/RegisterGallery',
+            image__service__pb2.GalleryChunk.SerializeToString,
+            image__service__pb2.GalleryResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def QueryGallery(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/imageprocessing.ImageService/QueryGallery',
+            image__service__pb2.GalleryQuery.SerializeToString,
+            image__service__pb2.CompareResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
@@ -1,10 +1,136 @@
 from tkinter import Tk, filedialog, Label, Button, messagebox, Frame, Listbox, Scrollbar
 import tkinter as tk
 from PIL import Image, ImageTk
-import numpy as np
-import cv2
 import logging
 import time
+import argparse
+import multiprocessing
+import os
+from collections import deque
+from concurrent import futures
+
+import histogram_engine
+import cluster
+
+# Число изображений в одной задаче пула: изображения задачи декодируются в одном процессе,
+# и их оценки считаются одной операцией
+SCORING_BATCH_SIZE = 64
+
+# Число задач в работе на один процесс: задачи выдаются по порядку,
+# поэтому после совпадения обрабатывается не больше этого числа лишних пачек
+TASKS_PER_PROCESS = 2
+
+# Расширения файлов изображений при передаче каталога в командной строке
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+def read_file(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+def reference_histogram(path, decode_mode=cluster.DECODE_MODE):
+    """Гистограмма эталона: цветное изображение переводится в градации серого так же, как на узле кластера."""
+    return histogram_engine.calc_histogram(cluster.decode_grayscale(read_file(path), decode_mode, reference=True))
+
+def scan_files(hist_color, paths, decode_mode=cluster.DECODE_MODE):
+    """
+    Декодирует пачку ч/б изображений и ищет среди них первое совпадение с эталоном.
+    Функция уровня модуля, чтобы ее можно было выполнять в процессе пула.
+
+    :param hist_color: Гистограмма эталона.
+    :param paths: Пути к ч/б изображениям пачки.
+    :param decode_mode: Режим декодирования (ключ cluster.DECODE_MODES).
+    :return: Пара (номер совпадения в пачке или -1, список (номер, текст ошибки)).
+    """
+    histograms = []
+    errors = []
+    for offset, path in enumerate(paths):
+        try:
+            hist_bw, error = cluster.decode_histogram(read_file(path), decode_mode)
+        except OSError as e:
+            hist_bw, error = None, str(e)
+        if hist_bw is None:
+            errors.append((offset, error))
+        histograms.append(hist_bw)
+    return histogram_engine.first_match(hist_color, histogram_engine.histogram_matrix(histograms)), errors
+
+class LocalMatcher:
+    """
+    Поиск первого совпадения на одной машине с использованием всех ядер. Пачки
+    изображений декодируются в пуле процессов и оцениваются одной операцией;
+    результаты пачек разбираются по порядку, поэтому ответ - наименьший индекс
+    совпадения, как в последовательном поиске и в распределенной системе.
+    """
+
+    def __init__(self, processes=None, chunk_size=SCORING_BATCH_SIZE, decode_mode=cluster.DECODE_MODE):
+        """
+        :param processes: Число процессов (None - по числу доступных ядер, 0 - без пула, в текущем процессе).
+        :param chunk_size: Число изображений в одной задаче пула.
+        :param decode_mode: Режим декодирования (ключ cluster.DECODE_MODES).
+        """
+        if decode_mode not in cluster.DECODE_MODES:
+            raise ValueError(f"Неизвестный режим декодирования: {decode_mode}")
+        if processes is None:
+            processes = cluster.available_cpus()
+        self.processes = processes
+        self.chunk_size = max(1, chunk_size)
+        self.decode_mode = decode_mode
+        self.process_pool = None
+        if processes > 0:
+            # spawn, как на узле кластера: одинаково работает в Windows и Linux
+            self.process_pool = futures.ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+
+    def close(self):
+        if self.process_pool is not None:
+            self.process_pool.shutdown(cancel_futures=True)
+
+    def find_first_match(self, color_path, bw_paths):
+        """
+        Ищет первое ч/б изображение, совпадающее с цветным.
+
+        :param color_path: Путь к цветному изображению.
+        :param bw_paths: Пути к ч/б изображениям.
+        :return: Индекс совпадения или -1, если совпадений нет.
+        """
+        hist_color = reference_histogram(color_path, self.decode_mode)
+        chunk_starts = iter(range(0, len(bw_paths), self.chunk_size))
+
+        if self.process_pool is None:
+            for start in chunk_starts:
+                match, errors = scan_files(hist_color, bw_paths[start:start + self.chunk_size], self.decode_mode)
+                self.log_errors(bw_paths, start, errors)
+                if match >= 0:
+                    return start + match
+            return -1
+
+        pending = deque()
+
+        def submit_next():
+            start = next(chunk_starts, None)
+            if start is not None:
+                pending.append((start, self.process_pool.submit(
+                    scan_files, hist_color, bw_paths[start:start + self.chunk_size], self.decode_mode)))
+
+        try:
+            for _ in range(self.processes * TASKS_PER_PROCESS):
+                submit_next()
+            while pending:
+                start, future = pending.popleft()
+                match, errors = future.result()
+                self.log_errors(bw_paths, start, errors)
+                if match >= 0:
+                    return start + match
+                submit_next()
+            return -1
+        finally:
+            # Пачки после совпадения больше не нужны
+            for _, future in pending:
+                future.cancel()
+
+    def log_errors(self, bw_paths, start, errors):
+        for offset, error in errors:
+            logging.error(f"Ошибка обработки черно-белого изображения под индексом {start + offset} "
+                          f"({bw_paths[start + offset]}): {error}")
 
 class ImageComparisonApp:
     def __init__(self, master):
@@ -70,12 +196,17 @@ class ImageComparisonApp:
         self.status_label.pack(pady=10)
 
         self.color_image = None
-        self.bw_images = []
+        self.color_path = None
+        self.bw_paths = []
         self.bw_list_visible = False  # Отслеживание видимости списка
 
+        # Сравнение выполняется в пуле процессов; процессы запускаются при первом сравнении
+        self.matcher = LocalMatcher()
+
     def load_color_image(self):
         file_path = filedialog.askopenfilename(filetypes=[("Файлы изображений", "*.jpg;*.jpeg;*.png")])
         if file_path:
+            self.color_path = file_path
             self.color_image = Image.open(file_path)
             self.color_image.thumbnail((400, 400))  # Уменьшаем изображение для отображения
             self.show_image(self.original_label, self.color_image)
@@ -83,13 +214,11 @@ class ImageComparisonApp:
     def load_bw_images(self):
         file_paths = filedialog.askopenfilenames(filetypes=[("Файлы изображений", "*.jpg;*.jpeg;*.png")])
         if file_paths:
-            self.bw_images = []
+            # Изображения читаются только при сравнении, в процессах пула
+            self.bw_paths = list(file_paths)
             self.bw_listbox.delete(0, tk.END)  # Очистить список перед загрузкой новых изображений
-            for path in file_paths:
-                bw_image = Image.open(path)
-                bw_image.thumbnail((400, 400))  # Уменьшаем изображение для отображения
-                self.bw_images.append(bw_image)
-                self.bw_listbox.insert(tk.END, f"Index: {len(self.bw_images) - 1}: {path}")  # Добавляем в список с индексом
+            for index, path in enumerate(self.bw_paths):
+                self.bw_listbox.insert(tk.END, f"Index: {index}: {path}")  # Добавляем в список с индексом
 
     def toggle_bw_image_list(self):
         """Переключить видимость списка черно-белых изображений."""
@@ -102,84 +231,92 @@ class ImageComparisonApp:
         self.bw_list_visible = not self.bw_list_visible  # Изменить состояние видимости
 
     def compare_images(self):
-        if self.color_image is None or not self.bw_images:
+        if self.color_image is None or not self.bw_paths:
             messagebox.showwarning("Предупреждение", "Пожалуйста, загрузите цветное и черно-белые изображения!")
             return
 
         start_time = time.time()
-        
-        # Преобразование цветного изображения в черно-белое
-        color_image_bw = self.convert_to_grayscale(self.color_image)
 
-        best_match_index, best_match_image = self.find_best_match(color_image_bw)
+        try:
+            best_match_index = self.matcher.find_first_match(self.color_path, self.bw_paths)
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось выполнить сравнение: {e}")
+            return
 
         if best_match_index != -1:
             # Замер времени окончания
             end_time = time.time()
             # Рассчитываем время выполнения в миллисекундах
             execution_time_ms = (end_time - start_time) * 1000
+            best_match_image = Image.open(self.bw_paths[best_match_index])
+            best_match_image.thumbnail((400, 400))  # Уменьшаем изображение для отображения
             self.show_image(self.matched_bw_label, best_match_image)
             messagebox.showinfo("Результат", f"Совпадение найдено с изображением под индексом: {best_match_index}. Время выполнения сравнения изображений: {execution_time_ms:.2f} мс")
         else:
             self.matched_bw_label.config(image='', text='')  # Убираем изображение, если совпадений нет
             messagebox.showinfo("Результат", "Совпадений изображения в черно-белом варианте не найдено.")
 
-    def convert_to_grayscale(self, image):
-        """Преобразовать изображение в градации серого, если оно не в таком формате."""
-        # Преобразуем изображение PIL в массив NumPy
-        image_np = np.array(image)
-
-        # Если изображение уже в градациях серого, возвращаем его без изменений
-        if len(image_np.shape) == 2:  # Уже одноканальное изображение (черно-белое)
-            return image_np
-        else:
-            # Если изображение цветное, конвертируем его в градации серого
-            return cv2.cvtColor(image_np, cv2.COLOR_RGB2GRAY)
-
-    def compare_images_hist(self, bw_image, bw_image_to_compare):
-        """Сравнить два изображения с помощью гистограммы."""
-        if len(bw_image.shape) == 2:
-            bw_image = cv2.cvtColor(bw_image, cv2.COLOR_GRAY2BGR)
-
-        if bw_image.shape[:2] != bw_image_to_compare.shape[:2]:
-            logging.warning(f"Размеры изображений не совпадают: bw {bw_image.shape}, bw_compare {bw_image_to_compare.shape}")
-            return False
-
-        hist_bw = cv2.calcHist([bw_image], [0], None, [256], [0, 256])
-        hist_bw_compare = cv2.calcHist([bw_image_to_compare], [0], None, [256], [0, 256])
-
-        cv2.normalize(hist_bw, hist_bw, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX)
-        cv2.normalize(hist_bw_compare, hist_bw_compare, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX)
-
-        score = cv2.compareHist(hist_bw, hist_bw_compare, cv2.HISTCMP_CORREL)
-
-        threshold = 0.9  # Порог для совпадения
-
-        return score > threshold
-
-    def find_best_match(self, color_image_bw):
-        """Найти лучшее совпадение среди черно-белых изображений."""
-        best_diff = float('inf')
-        matching_index = -1
-        best_match_image = None
-        
-        for index, bw_image in enumerate(self.bw_images):
-            bw_image_resized = self.convert_to_grayscale(bw_image)
-            if self.compare_images_hist(color_image_bw, bw_image_resized):
-                best_match_index = index
-                best_match_image = bw_image
-                break
-
-        return best_match_index, best_match_image
-
     def show_image(self, label, image):
         """Отобразить изображение в метке."""
         image_tk = ImageTk.PhotoImage(image)
         label.config(image=image_tk, text='')
         label.image = image_tk  # Сохраняем ссылку на изображение
 
+def expand_paths(paths):
+    """Пути из командной строки: каталог заменяется отсортированным списком его изображений."""
+    expanded = []
+    for path in paths:
+        if os.path.isdir(path):
+            expanded.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                   if name.lower().endswith(IMAGE_EXTENSIONS)))
+        else:
+            expanded.append(path)
+    return expanded
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Поиск черно-белого варианта изображения на одной машине")
+    parser.add_argument('--color', help="Цветное изображение (без параметров запускается графический интерфейс)")
+    parser.add_argument('bw', nargs='*', help="Черно-белые изображения или каталоги с ними")
+    parser.add_argument('--processes', type=cluster.processes_arg, default=None,
+                        help="Число процессов (0 - без пула, auto - по числу ядер, по умолчанию auto)")
+    parser.add_argument('--chunk-size', type=int, default=SCORING_BATCH_SIZE,
+                        help="Число изображений в одной задаче пула")
+    parser.add_argument('--decode-mode', choices=list(cluster.DECODE_MODES), default=cluster.DECODE_MODE,
+                        help="Режим декодирования изображений")
+    parser.add_argument('--repeats', type=int, default=1,
+                        help="Число повторов сравнения (первый включает запуск процессов)")
+    args = parser.parse_args(argv)
+    if args.color is not None and not args.bw:
+        parser.error("не заданы черно-белые изображения")
+    if args.repeats < 1:
+        parser.error("число повторов должно быть не меньше 1")
+    return args
+
+def run_cli(args):
+    """Сравнение из командной строки, без Tk; выводит индекс совпадения и время каждого повтора."""
+    bw_paths = expand_paths(args.bw)
+    matcher = LocalMatcher(processes=args.processes, chunk_size=args.chunk_size, decode_mode=args.decode_mode)
+    best_match_index = -1
+    try:
+        for repeat in range(args.repeats):
+            start_time = time.perf_counter()
+            best_match_index = matcher.find_first_match(args.color, bw_paths)
+            execution_time_ms = (time.perf_counter() - start_time) * 1000
+            print(f"Повтор {repeat + 1}: индекс совпадения {best_match_index}, изображений: {len(bw_paths)}, "
+                  f"процессов: {matcher.processes}, время: {execution_time_ms:.2f} мс")
+    finally:
+        matcher.close()
+    return best_match_index
+
 # Создаем и запускаем приложение
 if __name__ == "__main__":
-    root = Tk()
-    app = ImageComparisonApp(root)
-    root.mainloop()
+    args = parse_args()
+    if args.color is not None:
+        run_cli(args)
+    else:
+        root = Tk()
+        app = ImageComparisonApp(root)
+        try:
+            root.mainloop()
+        finally:
+            app.matcher.close()
@@ -1,10 +1,20 @@
-import socket
+import asyncio
+import bisect
+import functools
 import grpc
-import threading
+import hashlib
 import logging
+import os
+import threading
+import time
+import struct
+import sys
+from collections import OrderedDict
+from concurrent import futures
 import json  # Для работы с конфигурационным файлом
 
 import image_service_pb2
+import frame_protocol
 import image_service_pb2_grpc
 
 # Настройка логирования
@@ -15,23 +25,363 @@ def load_config():
     with open('config.json', 'r') as file:
         return json.load(file)
 
-# Функция для поиска свободного кластера
-def find_available_cluster(clusters):
-    available_clusters = []
-    for cluster in clusters:
-        ip = cluster["ip"]
-        port = cluster["port"]
-        try:
-            # Попытка подключения к кластеру
-            channel = grpc.insecure_channel(f'{ip}:{port}')
+# Лимиты на размер сообщений gRPC (как у кластеров, 100 МБ)
+GRPC_CHANNEL_OPTIONS = [
+    ('grpc.max_send_message_length', 100 * 1024 * 1024),
+    ('grpc.max_receive_message_length', 100 * 1024 * 1024),
+]
+
+# Размер одного сообщения потокового CompareImagesStream (в байтах ч/б изображений)
+STREAM_CHUNK_BYTES = 4 * 1024 * 1024
+
+# Сколько секунд ждать установления соединения с кластером при запуске
+WARM_UP_TIMEOUT = 5.0
+
+# Период опроса кластеров методом Ping и таймаут одного опроса (в секундах)
+PING_INTERVAL = 2.0
+PING_TIMEOUT = 1.0
+
+# Коэффициент сглаживания измеренного времени отклика (RTT)
+RTT_SMOOTHING = 0.3
+
+# Коэффициент сглаживания измеренной производительности кластеров (изображений/с)
+THROUGHPUT_SMOOTHING = 0.3
+
+# Калибровка при запуске: сколько изображений из каталога отправить каждому кластеру
+CALIBRATION_DIR = 'images/BW'
+CALIBRATION_IMAGES = 32
+
+# Распределение работы: "parts" - по одной части на кластер (размер по производительности),
+# "queue" - общая очередь небольших порций, которые кластеры забирают по мере готовности.
+# Режим действует и при конвейерной обработке (pipeline_chunk_size > 0): в режиме "parts"
+# каждая принятая порция уходит кластеру, который раньше закончит ее обработку,
+# в режиме "queue" принятые порции пополняют общую очередь
+SCHEDULING = "parts"
+
+# Режим очереди: начальный размер порции, его границы, желаемое время обработки
+# порции (по нему подстраивается размер) и число порций в обработке на кластер
+QUEUE_CHUNK_SIZE = 16
+QUEUE_MIN_CHUNK = 4
+QUEUE_MAX_CHUNK = 1024
+QUEUE_TARGET_SECONDS = 0.5
+QUEUE_DEPTH = 2
+
+# Кэш ответов на повторяющиеся запросы: число записей, время жизни (с) и объем памяти
+RESULT_CACHE_ENTRIES = 10000
+RESULT_CACHE_TTL = 300.0
+RESULT_CACHE_BYTES = 16 * 1024 * 1024
+
+# Предельное время обработки одной части кластером (в секундах): зависший
+# кластер не должен задерживать ответ клиенту навсегда
+RPC_TIMEOUT = 120.0
+
+# Ошибки транспорта: кластер исключается из маршрутизации до следующего Ping
+NODE_FAILURE_CODES = {grpc.StatusCode.UNAVAILABLE}
+
+# Ошибки, после которых часть повторяется на другом кластере. Ошибки самого
+# запроса (RESOURCE_EXHAUSTED, INVALID_ARGUMENT и т.п.) не повторяются
+RETRY_CODES = NODE_FAILURE_CODES | {grpc.StatusCode.DEADLINE_EXCEEDED, grpc.StatusCode.INTERNAL,
+                                    grpc.StatusCode.UNKNOWN}
+
+class ClusterPool:
+    """
+    Пул долгоживущих gRPC каналов: по одному каналу и заглушке на кластер.
+    Каналы создаются один раз при запуске сервера и используются всеми запросами
+    одновременно (каналы и заглушки gRPC потокобезопасны).
+
+    Фоновый поток периодически вызывает Ping на каждом кластере и ведет реестр
+    состояния: доступен ли кластер, время отклика и его текущая загрузка.
+    """
+
+    def __init__(self, clusters, streaming=True, stream_chunk_bytes=STREAM_CHUNK_BYTES, rpc_timeout=RPC_TIMEOUT,
+                 scheduling=SCHEDULING):
+        if scheduling not in ("parts", "queue"):
+            raise ValueError(f"Неизвестный режим распределения: {scheduling}")
+        self.lock = threading.Lock()
+        self.scheduling = scheduling
+        self.streaming = streaming
+        self.stream_chunk_bytes = stream_chunk_bytes
+        self.rpc_timeout = rpc_timeout
+        self.unary_only = set()  # Кластеры старой версии без CompareImagesStream
+        self.nodes = []
+        self.compare_calls = {}
+        self.health = {}
+        self.stop_event = threading.Event()
+        self.prober = None
+        for cluster in clusters:
+            ip = cluster["ip"]
+            port = cluster["port"]
+            channel = grpc.insecure_channel(f'{ip}:{port}', options=GRPC_CHANNEL_OPTIONS)
             stub = image_service_pb2_grpc.ImageServiceStub(channel)
-            # Если кластер доступен, добавляем его в список
-            available_clusters.append((ip, port, channel, stub))
-            logging.info(f"Кластер {ip}:{port} доступен.")
-        except Exception as e:
-            logging.error(f"Кластер {ip}:{port} недоступен: {e}")
-            continue
+            self.nodes.append((ip, port, channel, stub))
+            # Вызовы сравнения с готовым байтовым представлением запроса (см. encode_compare_request)
+            self.compare_calls[(ip, port)] = (
+                channel.unary_unary(COMPARE_METHOD, response_deserializer=image_service_pb2.CompareResponse.FromString),
+                channel.stream_unary(COMPARE_STREAM_METHOD,
+                                     response_deserializer=image_service_pb2.CompareResponse.FromString))
+            self.health[(ip, port)] = {"healthy": False, "rtt": None, "in_flight": 0, "workers": 0, "last_seen": None,
+                                       "cache_hits": 0, "cache_misses": 0, "cache_evictions": 0, "throughput": None}
+
+    def warm_up(self, timeout=WARM_UP_TIMEOUT):
+        """
+        Устанавливает соединения со всеми кластерами заранее, чтобы первый запрос
+        не платил за установку HTTP/2 соединения, и выполняет первый опрос Ping.
+
+        :return: Количество доступных кластеров.
+        """
+        # Первый Ping ждет установления соединения (wait_for_ready), а не падает сразу
+        self.probe_all(timeout=timeout, wait_for_ready=True)
+        available = self.available()
+        for ip, port, channel, stub in self.nodes:
+            if not self.health[(ip, port)]["healthy"]:
+                logging.error(f"Кластер {ip}:{port} недоступен: нет ответа на Ping за {timeout} с")
+        return len(available)
+
+    def probe_all(self, timeout=PING_TIMEOUT, wait_for_ready=False):
+        """Опрашивает все кластеры методом Ping одновременно и обновляет реестр."""
+        probes = []
+        for ip, port, channel, stub in self.nodes:
+            future = stub.Ping.future(image_service_pb2.PingRequest(), timeout=timeout, wait_for_ready=wait_for_ready)
+            probes.append((ip, port, time.monotonic(), future))
+        for ip, port, started, future in probes:
+            try:
+                response = future.result()
+                self._record_ping(ip, port, time.monotonic() - started, response)
+            except grpc.RpcError as e:
+                if e.code() == grpc.StatusCode.UNIMPLEMENTED:
+                    # Кластер старой версии без Ping: он отвечает, значит жив
+                    self._record_ping(ip, port, time.monotonic() - started)
+                else:
+                    self.mark_failed((ip, port), f"Ping: {e.code().name}")
+
+    def _record_ping(self, ip, port, rtt, response=None):
+        with self.lock:
+            health = self.health[(ip, port)]
+            was_healthy = health["healthy"]
+            previous_rtt = health["rtt"]
+            health["rtt"] = rtt if previous_rtt is None else previous_rtt + RTT_SMOOTHING * (rtt - previous_rtt)
+            if response is not None:
+                health["in_flight"] = response.in_flight
+                health["workers"] = response.workers
+                health["cache_hits"] = response.cache_hits
+                health["cache_misses"] = response.cache_misses
+                health["cache_evictions"] = response.cache_evictions
+            health["last_seen"] = time.time()
+            health["healthy"] = True
+            workers = health["workers"]
+        if not was_healthy:
+            logging.info(f"Кластер {ip}:{port} доступен (RTT {rtt * 1000:.1f} мс, потоков: {workers}).")
+
+    def calibrate(self, bw_images, timeout=RPC_TIMEOUT):
+        """
+        Измеряет производительность каждого доступного кластера на тестовом наборе:
+        кластеры опрашиваются по очереди, чтобы узлы одного хоста не мешали друг другу.
+        Эталоном служит первое изображение, остальные - кандидаты.
+        """
+        if len(bw_images) < 2:
+            return
+        color_image_data, candidates = bw_images[0], bw_images[1:]
+        for node in self.available():
+            request = image_service_pb2.CompareRequest(color_image=color_image_data, bw_images=candidates)
+            started = time.monotonic()
+            try:
+                response = node[3].CompareImages(request, timeout=timeout)
+            except grpc.RpcError as e:
+                logging.warning(f"Калибровка кластера {node[0]}:{node[1]} не выполнена: {e.code().name}")
+                continue
+            processed = response.matching_index + 1 if response.matching_index >= 0 else len(candidates)
+            self.record_throughput(node, processed, time.monotonic() - started)
+        logging.info(f"Калибровка кластеров: {self.describe_throughput()}")
+
+    def record_throughput(self, node, images, elapsed):
+        """Обновляет оценку производительности кластера (изображений/с) по обработанной части."""
+        if images <= 0:
+            return
+        with self.lock:
+            health = self.health[node[:2]]
+            # Время передачи по сети (RTT) не относится к обработке
+            busy = max(elapsed - (health["rtt"] or 0.0), 1e-3)
+            rate = images / busy
+            previous = health["throughput"]
+            health["throughput"] = rate if previous is None else previous + THROUGHPUT_SMOOTHING * (rate - previous)
+
+    def describe_throughput(self):
+        with self.lock:
+            return ", ".join(f"{ip}:{port} - " + (f"{health['throughput']:.0f} изобр./с" if health["throughput"] else "нет данных")
+                             for (ip, port), health in self.health.items())
+
+    def shares(self, nodes, total):
+        """
+        Делит total изображений между кластерами пропорционально производительности
+        так, чтобы все части были готовы одновременно: кластеру достается
+        throughput * (T - RTT), где T - общее время обработки. Пока производительность
+        кластеров неизвестна, изображения делятся поровну.
+
+        :return: Список размеров частей в порядке nodes.
+        """
+        rates, rtts = self.estimates(nodes)
+        if rates is None:
+            return [total // len(nodes) + (1 if i < total % len(nodes) else 0) for i in range(len(nodes))]
+
+        # Медленный канал может не получить ничего: такие кластеры исключаются и T пересчитывается
+        active = list(range(len(nodes)))
+        while True:
+            finish = (total + sum(rates[i] * rtts[i] for i in active)) / sum(rates[i] for i in active)
+            dropped = [i for i in active if finish <= rtts[i]]
+            if not dropped or len(dropped) == len(active):
+                break
+            active = [i for i in active if i not in dropped]
+        exact = [rates[i] * max(finish - rtts[i], 0.0) if i in active else 0.0 for i in range(len(nodes))]
+
+        # Округление с сохранением суммы: остаток достается частям с наибольшей дробной долей
+        sizes = [int(value) for value in exact]
+        for i in sorted(range(len(nodes)), key=lambda i: sizes[i] - exact[i])[:total - sum(sizes)]:
+            sizes[i] += 1
+        return sizes
+
+    def estimates(self, nodes):
+        """
+        Измеренные производительность (изобр./с) и RTT (с) кластеров.
+        Кластер без измерений производительности считается средним.
+
+        :return: Пара списков в порядке nodes; вместо производительности None, если она не измерена ни у одного кластера.
+        """
+        with self.lock:
+            rates = [self.health[node[:2]]["throughput"] for node in nodes]
+            rtts = [self.health[node[:2]]["rtt"] or 0.0 for node in nodes]
+        known = [rate for rate in rates if rate]
+        if not known:
+            return None, rtts
+        return [rate or sum(known) / len(known) for rate in rates], rtts
+
+    def mark_failed(self, node, reason):
+        """Исключает кластер из маршрутизации до следующего успешного Ping."""
+        ip, port = node[0], node[1]
+        with self.lock:
+            was_healthy = self.health[(ip, port)]["healthy"]
+            self.health[(ip, port)]["healthy"] = False
+        if was_healthy:
+            logging.error(f"Кластер {ip}:{port} недоступен: {reason}")
+
+    def report_error(self, node, error, method):
+        """
+        Учитывает ошибку вызова кластера: при ошибке транспорта кластер
+        исключается до следующего успешного Ping.
+
+        :return: True, если запрос имеет смысл повторить на другом кластере.
+        """
+        if error.code() in NODE_FAILURE_CODES:
+            self.mark_failed(node, f"{method}: {error.code().name}")
+        return error.code() in RETRY_CODES
+
+    def start_health_checks(self, interval=PING_INTERVAL):
+        """Запускает фоновый поток, опрашивающий кластеры каждые interval секунд."""
+        def probe_loop():
+            while not self.stop_event.wait(interval):
+                try:
+                    self.probe_all()
+                except Exception as e:
+                    logging.error(f"Ошибка при опросе кластеров: {e}")
+
+        self.prober = threading.Thread(target=probe_loop, name="cluster-prober", daemon=True)
+        self.prober.start()
+
+    def compare_async(self, node, color_image_data, part, features=False):
+        """
+        Отправляет часть на кластер, не дожидаясь ответа. По умолчанию используется
+        потоковый CompareImagesStream, что снимает ограничение на размер сообщения.
+
+        :param features: Вместо изображений переданы гистограммы (режим гистограмм).
+        :return: Future gRPC с CompareResponse.
+        """
+        ip, port, channel, stub = node
+        compare, compare_stream = self.compare_calls[(ip, port)]
+        if self.streaming and (ip, port) not in self.unary_only:
+            return compare_stream.future(iter_compare_chunks(color_image_data, part, self.stream_chunk_bytes, features),
+                                         timeout=self.rpc_timeout)
+        return compare.future(encode_compare_request(color_image_data, part, features), timeout=self.rpc_timeout)
+
+    def supports_streaming(self, node):
+        with self.lock:
+            return self.streaming and node[:2] not in self.unary_only
+
+    def disable_streaming(self, node):
+        """Переводит кластер, не поддерживающий CompareImagesStream, на унарный вызов."""
+        with self.lock:
+            if node[:2] in self.unary_only:
+                return
+            self.unary_only.add(node[:2])
+        logging.warning(f"Кластер {node[0]}:{node[1]} не поддерживает потоковый режим, используется CompareImages")
+
+    def available(self):
+        """Возвращает кластеры, ответившие на последний Ping, в порядке возрастания RTT."""
+        with self.lock:
+            healthy = [node for node in self.nodes if self.health[(node[0], node[1])]["healthy"]]
+            return sorted(healthy, key=lambda node: self.health[(node[0], node[1])]["rtt"])
+
+    def close(self):
+        self.stop_event.set()
+        if self.prober is not None:
+            self.prober.join()
+        for ip, port, channel, stub in self.nodes:
+            channel.close()
+
+def iter_image_chunks(bw_images, make_chunk, chunk_bytes=STREAM_CHUNK_BYTES):
+    """
+    Делит ч/б изображения на порции не больше chunk_bytes (но не меньше одного изображения).
+
+    :param make_chunk: Функция, формирующая сообщение из списка изображений порции.
+    """
+    chunk = []
+    chunk_size = 0
+    for bw_image in bw_images:
+        if chunk and chunk_size + len(bw_image) > chunk_bytes:
+            yield make_chunk(chunk)
+            chunk = []
+            chunk_size = 0
+        chunk.append(bw_image)
+        chunk_size += len(bw_image)
+    if chunk:
+        yield make_chunk(chunk)
+
+def iter_compare_chunks(color_image_data, bw_images, chunk_bytes=STREAM_CHUNK_BYTES, features=False):
+    """Формирует сообщения для CompareImagesStream: сначала цветное изображение, затем ч/б порциями."""
+    yield encode_compare_request(color_image_data, [], features)
+    yield from iter_image_chunks(bw_images, lambda chunk: encode_compare_request(b"", chunk, features), chunk_bytes)
+
+def encode_field_header(field, size):
+    """Заголовок поля bytes в формате protobuf: ключ (номер поля, тип 2) и длина в varint."""
+    header = bytearray([field << 3 | 2])
+    while size > 0x7f:
+        header.append(size & 0x7f | 0x80)
+        size >>= 7
+    header.append(size)
+    return bytes(header)
+
+def encode_compare_request(color_image_data, bw_images, features=False):
+    """
+    Байтовое представление CompareRequest/CompareChunk (поля color_image = 1, bw_images = 2,
+    в режиме гистограмм color_histogram = 3, bw_histograms = 4).
+    Данные изображений (bytes, bytearray или memoryview) копируются один раз - сразу
+    в итоговое сообщение, без промежуточного объекта protobuf.
+    """
+    color_field, bw_field = (3, 4) if features else (1, 2)
+    parts = []
+    if color_image_data:
+        parts += [encode_field_header(color_field, len(color_image_data)), color_image_data]
+    for bw_image in bw_images:
+        parts += [encode_field_header(bw_field, len(bw_image)), bw_image]
+    return b"".join(parts)
 
+# Полные имена методов сравнения (вызываются с готовым байтовым представлением запроса)
+COMPARE_METHOD = '/imageprocessing.ImageService/CompareImages'
+COMPARE_STREAM_METHOD = '/imageprocessing.ImageService/CompareImagesStream'
+
+# Функция для поиска свободного кластера
+def find_available_cluster(pool):
+    available_clusters = pool.available()
+    if len(available_clusters) < len(pool.nodes):
+        logging.warning(f"Доступно кластеров: {len(available_clusters)} из {len(pool.nodes)}")
     return available_clusters
 
 # Функция для разбиения черно-белых изображений между кластерами
@@ -50,125 +400,1130 @@ def distribute_bw_images(bw_images, num_clusters):
         distributed[i % num_clusters].append(bw_image)
     return distributed
 
-def process_images(color_image_data, bw_images, clusters):
+def split_by_sizes(bw_images, sizes):
     """
-    Обрабатывает изображения, распределяя задачи между кластерами.
+    Делит черно-белые изображения на непрерывные части заданных размеров.
 
-    :param color_image_data: Данные цветного изображения.
-    :param bw_images: Список черно-белых изображений.
-    :param clusters: Список кластеров (IP и порты).
-    :return: Итоговый индекс совпадающего изображения.
+    :return: Список пар (смещение части в исходном списке, часть); пустые части пропускаются.
     """
-    num_clusters = len(clusters)
-    num_images = len(bw_images)
+    parts = []
+    start_idx = 0
+    for size in sizes:
+        if size > 0:
+            parts.append((start_idx, bw_images[start_idx:start_idx + size]))
+        start_idx += size
+    return parts
 
-    # Разделяем изображения между кластерами
-    num_images_per_cluster = num_images // num_clusters
-    remaining_images = num_images % num_clusters  # Оставшиеся изображения
+def split_into_parts(bw_images, num_parts):
+    """
+    Делит черно-белые изображения на непрерывные части и запоминает смещение каждой.
+
+    :param bw_images: Список черно-белых изображений.
+    :param num_parts: Количество частей.
+    :return: Список пар (смещение части в исходном списке, часть).
+    """
+    num_images_per_part = len(bw_images) // num_parts
+    remaining_images = len(bw_images) % num_parts  # Оставшиеся изображения
 
-    # Массив частей изображений для каждого кластера
     parts = []
     start_idx = 0
-    for i in range(num_clusters):
-        end_idx = start_idx + num_images_per_cluster + (1 if i < remaining_images else 0)
-        parts.append(bw_images[start_idx:end_idx])
+    for i in range(num_parts):
+        end_idx = start_idx + num_images_per_part + (1 if i < remaining_images else 0)
+        if end_idx > start_idx:
+            parts.append((start_idx, bw_images[start_idx:end_idx]))
         start_idx = end_idx
+    return parts
+
+# Ответ неизвестен: часть изображений до найденного совпадения не удалось обработать
+# (клиенту передается REPLY_UNKNOWN, а не 0 - "совпадений нет")
+RESULT_UNKNOWN = -2
+
+class ResultCollector:
+    """
+    Собирает ответы кластеров по частям по мере их готовности. Нужен наименьший
+    индекс совпадения, поэтому как только найдено совпадение и все части с меньшим
+    смещением обработаны, ответ окончателен: части с большим смещением отменяются
+    (отмена gRPC вызова останавливает обработку на кластере), результат доступен сразу.
+    Часть, не обработанную кластером, повторяет на другом доступном кластере.
+    """
+
+    def __init__(self, pool, color_image_data, features=False):
+        self.pool = pool
+        self.color_image_data = color_image_data
+        self.features = features
+        self.lock = threading.Lock()
+        # Номер части -> [смещение, часть, кластер, future, опрошенные кластеры, унарный повтор, время отправки]
+        self.active = {}
+        self.best = None  # Наименьший найденный индекс (с единицы)
+        self.failed_offsets = []
+        self.closed = False  # Все части уже добавлены
+        self.answer = futures.Future()
+
+    def add(self, i, offset, part, node, future):
+        with self.lock:
+            if self.answer.done():
+                # Ответ уже известен, а индексы новой части заведомо больше
+                future.cancel()
+                return
+            self.active[i] = [offset, part, node, future, {node[:2]}, set(), time.monotonic()]
+        future.add_done_callback(lambda done, i=i: self.on_done(i, done))
+
+    def resolve(self, result):
+        """Задает ответ извне (например, из кэша) и отменяет оставшиеся части."""
+        with self.lock:
+            if self.answer.done():
+                return
+            cancelled = [state[3] for state in self.active.values()]
+            self.active.clear()
+        for future in cancelled:
+            future.cancel()
+        self.answer.set_result(result)
+
+    def is_complete(self):
+        """Ответ получен и не зависит от частей, которые не удалось обработать."""
+        return self.answer.done() and not self.failed_offsets
+
+    def fail(self, offset):
+        """Изображения, начиная со смещения offset, обработать не удалось."""
+        with self.lock:
+            self.failed_offsets.append(offset)
+
+    def close(self):
+        """Новых частей не будет: ответ окончателен, когда обработаны все нужные части."""
+        with self.lock:
+            self.closed = True
+        self.check_final()
+
+    def on_done(self, i, future):
+        with self.lock:
+            state = self.active.get(i)
+            if state is None or state[3] is not future or self.answer.done():
+                return
+        # Дальше блокировка не удерживается: пока ждем результат, другой обратный вызов
+        # может сделать ответ окончательным, поэтому состояние части проверяется повторно
+        offset, part, node, _, tried, fell_back, started = state
+        try:
+            response = future.result()
+        except grpc.FutureCancelledError:
+            return
+        except grpc.RpcError as e:
+            self.retry(i, state, e)
+            return
+
+        logging.debug(f"Ответ от кластера {node[0]}:{node[1]}: {response.matching_index}")
+        # Кластер обрабатывает часть до первого совпадения
+        processed = response.matching_index + 1 if response.matching_index >= 0 else len(part)
+        self.pool.record_throughput(node, processed, time.monotonic() - started)
+        with self.lock:
+            if self.active.get(i) is not state:
+                return  # Ответ уже окончателен, часть отменена
+            del self.active[i]
+            # Если найдено совпадение, сохраняем индекс, учитывая смещение части
+            if response.matching_index >= 0:
+                found = offset + response.matching_index + 1
+                self.best = found if self.best is None else min(self.best, found)
+        self.check_final()
+
+    def retry(self, i, state, e):
+        if self.answer.done():
+            return  # Ответ уже окончателен: повторять часть не нужно
+        offset, part, node, _, tried, fell_back, _ = state
+        if e.code() == grpc.StatusCode.UNIMPLEMENTED and self.pool.streaming and node[:2] not in fell_back:
+            # Кластер старой версии: повторяем ту же часть унарным вызовом
+            fell_back.add(node[:2])
+            self.pool.disable_streaming(node)
+            self.resend(i, state, node)
+            return
+        logging.error(f"Ошибка при обработке части {i} на {node[0]}:{node[1]}: {e.code().name}")
+        retry = self.pool.report_error(node, e, "CompareImages")
+        node = next((n for n in find_available_cluster(self.pool) if n[:2] not in tried), None) if retry else None
+        if node is None:
+            with self.lock:
+                if self.active.get(i) is not state:
+                    return
+                del self.active[i]
+                self.failed_offsets.append(offset)
+            self.check_final()
+            return
+        tried.add(node[:2])
+        logging.info(f"Повторная отправка части {i} на кластер {node[0]}:{node[1]}")
+        self.resend(i, state, node)
+
+    def resend(self, i, state, node):
+        future = self.pool.compare_async(node, self.color_image_data, state[1], self.features)
+        with self.lock:
+            if self.active.get(i) is not state or self.answer.done():
+                # Пока часть отправлялась, ответ стал окончательным: новый вызов не отслеживался бы
+                future.cancel()
+                return
+            state[2] = node
+            state[3] = future
+            state[6] = time.monotonic()
+        future.add_done_callback(lambda done: self.on_done(i, done))
+
+    def check_final(self):
+        with self.lock:
+            if self.answer.done():
+                return
+            if self.best is not None:
+                # Части со смещением не меньше найденного индекса не могут дать меньший индекс
+                if any(state[0] < self.best for state in self.active.values()):
+                    return
+            elif not (self.closed and not self.active):
+                return
+            cancelled = [state[3] for state in self.active.values()]
+            self.active.clear()
+            result = self.final_index()
+        if cancelled:
+            logging.debug(f"Ответ окончателен ({result}), отмена частей с большими индексами: {len(cancelled)}")
+        for future in cancelled:
+            future.cancel()
+        try:
+            self.answer.set_result(result)
+        except futures.InvalidStateError:
+            pass  # Ответ уже задан через resolve
+
+    def final_index(self):
+        # Часть, которую не удалось обработать, делает ответ неизвестным,
+        # только если она стоит раньше найденного совпадения
+        if self.failed_offsets and (self.best is None or min(self.failed_offsets) + 1 < self.best):
+            logging.error(f"Не удалось обработать частей: {len(self.failed_offsets)}, результат неизвестен")
+            return RESULT_UNKNOWN
+
+        # Если совпадений не было, возвращаем -1
+        return self.best if self.best is not None else -1
+
+    def result(self):
+        """Дожидается окончательного ответа (блокирующий вызов)."""
+        return self.answer.result()
+
+def collect_results(pool, color_image_data, pending):
+    """
+    Собирает ответы кластеров по отправленным частям (см. ResultCollector).
+
+    :param pool: Пул соединений с кластерами.
+    :param color_image_data: Данные цветного изображения (для повторной отправки).
+    :param pending: Список (номер части, смещение, часть, кластер, future).
+    :return: Итоговый индекс совпадающего изображения (с единицы), -1 или RESULT_UNKNOWN.
+    """
+    return start_collector(pool, color_image_data, pending).result()
+
+def start_collector(pool, color_image_data, pending, features=False):
+    collector = ResultCollector(pool, color_image_data, features)
+    for i, offset, part, node, future in pending:
+        collector.add(i, offset, part, node, future)
+    collector.close()
+    return collector
+
+class ResultCache:
+    """
+    Кэш ответов сервера: одинаковый запрос (то же цветное изображение и тот же
+    упорядоченный набор ч/б изображений) получает ответ без обращения к кластерам.
+    Записи вытесняются по давности использования (LRU), по времени жизни и по объему памяти.
+
+    Для конвейерной обработки вместе с записью хранится отпечаток начала запроса
+    (первой порции): если начала нового запроса нет в кэше, повтором он быть не может,
+    и порции можно отправлять кластерам, не дожидаясь конца загрузки.
+    """
+
+    ENTRY_OVERHEAD = 160  # Оценка памяти на запись помимо ключа (байт)
+
+    def __init__(self, max_entries=RESULT_CACHE_ENTRIES, ttl=RESULT_CACHE_TTL, max_bytes=RESULT_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # Ключ -> (момент устаревания, индекс, отпечаток начала запроса)
+        self.prefixes = {}  # Отпечаток начала запроса -> число записей с ним
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def entry_bytes(self, key):
+        return sys.getsizeof(key) + self.ENTRY_OVERHEAD
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                # Запись устарела
+                self.remove(key)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, result, prefix=None):
+        """
+        :param prefix: Отпечаток начала запроса (см. has_prefix) или None.
+        """
+        with self.lock:
+            if self.max_entries <= 0:
+                return
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, result, prefix)
+            self.size_bytes += self.entry_bytes(key)
+            if prefix is not None:
+                self.prefixes[prefix] = self.prefixes.get(prefix, 0) + 1
+            while len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        """Удаляет запись (вызывается под блокировкой)."""
+        _, _, prefix = self.entries.pop(key)
+        self.size_bytes -= self.entry_bytes(key)
+        if prefix is not None:
+            self.prefixes[prefix] -= 1
+            if not self.prefixes[prefix]:
+                del self.prefixes[prefix]
+
+    def has_prefix(self, prefix):
+        """Есть ли запись, запрос которой начинается так же (на счетчики попаданий не влияет)."""
+        with self.lock:
+            return prefix in self.prefixes
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {"entries": len(self.entries), "bytes": self.size_bytes, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "hit_rate": self.hits / requests if requests else 0.0}
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.info(f"Кэш ответов: попаданий {stats['hits']}, промахов {stats['misses']} "
+                     f"(доля попаданий {stats['hit_rate']:.1%}), записей {stats['entries']}")
+
+def image_digest(bw_image):
+    return hashlib.blake2b(bw_image, digest_size=16).digest()
+
+def image_digests(bw_images):
+    return [image_digest(bw_image) for bw_image in bw_images]
+
+class Deduplicator:
+    """
+    Исключает повторяющиеся ч/б изображения (одинаковые байты) до отправки кластерам.
+    Уникальные изображения идут в порядке первого появления, поэтому наименьший
+    индекс среди уникальных соответствует наименьшему исходному индексу.
+    """
 
-    results = []
+    def __init__(self):
+        self.seen = set()
+        self.first_indices = []  # Исходный индекс каждого уникального изображения
+        self.sequence = hashlib.blake2b(digest_size=16)  # Отпечаток всего упорядоченного набора
+        self.total = 0
+        self.total_bytes = 0
+        self.saved_bytes = 0
 
+    def add(self, bw_image, digest=None):
+        """
+        :param digest: Отпечаток изображения (image_digest), если он уже посчитан.
+        :return: True, если изображение встретилось впервые и его нужно обработать.
+        """
+        digest = digest or image_digest(bw_image)
+        self.sequence.update(digest)
+        index = self.total
+        self.total += 1
+        self.total_bytes += len(bw_image)
+        if digest in self.seen:
+            self.saved_bytes += len(bw_image)
+            return False
+        self.seen.add(digest)
+        self.first_indices.append(index)
+        return True
+
+    def original_index(self, result):
+        """Переводит индекс среди уникальных изображений (с единицы) в исходный индекс."""
+        return self.first_indices[result - 1] + 1 if result > 0 else result
+
+    def unique_index(self, result):
+        """Обратное преобразование: исходный индекс (с единицы) в индекс среди уникальных."""
+        return bisect.bisect_left(self.first_indices, result - 1) + 1 if result > 0 else result
+
+    def request_key(self, color_image_data, features=False):
+        """Ключ кэша ответов: отпечатки цветного изображения и упорядоченного набора ч/б изображений."""
+        return (hashlib.blake2b(color_image_data, digest_size=16, person=b"features" if features else b"").digest()
+                + self.sequence.digest() + self.total.to_bytes(4, 'big'))
+
+    def log_metrics(self):
+        if not self.total:
+            return
+        unique = len(self.first_indices)
+        logging.info(f"Дедупликация: уникальных изображений {unique} из {self.total} "
+                     f"(коэффициент {self.total / unique:.2f}), не отправлено {self.saved_bytes / (1024 * 1024):.2f} МБ "
+                     f"из {self.total_bytes / (1024 * 1024):.2f} МБ")
+
+def process_images(color_image_data, bw_images, pool, result_cache=None, features=False):
+    """
+    Обрабатывает изображения, распределяя задачи между кластерами.
+    Повторяющиеся изображения отправляются один раз; все части отправляются
+    одновременно, ответы собираются по мере готовности.
+
+    :param color_image_data: Данные цветного изображения.
+    :param bw_images: Список черно-белых изображений.
+    :param pool: Пул соединений с кластерами (ClusterPool).
+    :param result_cache: Кэш ответов (ResultCache) или None.
+    :param features: Вместо изображений переданы гистограммы (режим гистограмм).
+    :return: Итоговый индекс совпадающего изображения (с единицы), -1 или RESULT_UNKNOWN.
+    """
+    deduplicator = Deduplicator()
+    unique_images = [bw_image for bw_image in bw_images if deduplicator.add(bw_image)]
+
+    key = None
+    if result_cache is not None:
+        key = deduplicator.request_key(color_image_data, features)
+        cached = result_cache.get(key)
+        if cached is not None:
+            logging.info(f"Ответ {cached} взят из кэша, кластеры не опрашиваются")
+            result_cache.log_stats()
+            return cached
+    deduplicator.log_metrics()
+
+    if pool.scheduling == "queue":
+        search = WorkQueueSearch(pool, color_image_data, unique_images, features=features)
+        result = search.run()
+        collector = search.collector
+    else:
+        collector = distribute_parts(color_image_data, unique_images, pool, features)
+        result = collector.result() if collector is not None else RESULT_UNKNOWN
+    result = deduplicator.original_index(result)
+
+    # Кэшируется только ответ, полученный от всех нужных частей
+    if key is not None and collector is not None and collector.is_complete():
+        result_cache.put(key, result)
+    return result
+
+def distribute_parts(color_image_data, bw_images, pool, features=False):
+    """
+    Делит изображения на части по числу кластеров и отправляет их.
+
+    :return: ResultCollector с ответом или None, если кластеры недоступны.
+    """
     # Находим доступные кластеры
-    available_clusters = find_available_cluster(clusters)
-    
+    available_clusters = find_available_cluster(pool)
+
     # Если кластеры доступны, начинаем обработку
     if not available_clusters:
         logging.error("Нет доступных кластеров для обработки.")
-        return -1  # Возвращаем -1, если кластеры недоступны
-    
-    # Переменная для подсчета числа отправленных изображений на каждый кластер
-    images_processed_before = 0
-
-    # Обрабатываем каждую часть для каждого кластера
-    for i, part in enumerate(parts):
-        # Используем один из доступных кластеров для обработки
-        # Выбираем кластер по индексу, обеспечивая цикличность распределения
-        ip, port, channel, stub = available_clusters[i % len(available_clusters)]
+        return None
+
+    # Разделяем изображения между кластерами пропорционально их производительности;
+    # смещения частей известны заранее, поэтому порядок прихода ответов не влияет на итоговый индекс
+    sizes = pool.shares(available_clusters, len(bw_images))
+    logging.info("Распределение по кластерам: " + ", ".join(
+        f"{node[0]}:{node[1]} - {size}" for node, size in zip(available_clusters, sizes)))
+    assigned = [node for node, size in zip(available_clusters, sizes) if size > 0]
+    parts = split_by_sizes(bw_images, sizes)
+
+    # Отправляем все части, не дожидаясь ответов
+    pending = []
+    for i, ((offset, part), node) in enumerate(zip(parts, assigned)):
+        logging.debug(f"Отправка части {i} ({len(part)} изображений) на кластер {node[0]}:{node[1]}")
+        pending.append((i, offset, part, node, pool.compare_async(node, color_image_data, part, features)))
+
+    return start_collector(pool, color_image_data, pending, features)
+
+class WorkQueueSearch:
+    """
+    Обработка через общую очередь: изображения делятся на небольшие непрерывные
+    порции, и каждый кластер забирает следующую порцию, как только закончил
+    предыдущую. Быстрые кластеры обрабатывают больше, а медленный или упавший
+    задерживает только свою порцию. Размер порции для каждого кластера
+    подстраивается так, чтобы порция обрабатывалась около target_seconds.
+
+    При конвейерной обработке очередь пополняется во время загрузки (extend):
+    кластер, которому нечего забрать, ждет следующих изображений, а неполная
+    порция отправляется только после окончания загрузки (close_upload).
+    """
+
+    def __init__(self, pool, color_image_data, bw_images, chunk_size=QUEUE_CHUNK_SIZE,
+                 target_seconds=QUEUE_TARGET_SECONDS, depth=QUEUE_DEPTH, features=False, upload_complete=True):
+        self.pool = pool
+        self.color_image_data = color_image_data
+        self.features = features
+        self.bw_images = list(bw_images)
+        self.upload_complete = upload_complete
+        self.idle = []  # Кластеры, ожидающие изображений загрузки
+        self.abandoned = False  # Кластеров не осталось: новые изображения не принимаются
+        self.chunk_size = chunk_size
+        self.target_seconds = target_seconds
+        self.depth = depth
+        self.lock = threading.RLock()  # Обратный вызов может сработать сразу в потоке отправки
+        self.cursor = 0  # Начало следующей порции
+        self.parts = 0
+        self.chunk_sizes = {}  # Кластер -> текущий размер порции
+        self.in_flight = {}  # Кластер -> число его порций в обработке
+        self.collector = ResultCollector(pool, color_image_data, features)
+
+    def run(self):
+        """Раздает порции всем доступным кластерам и ждет ответ (блокирующий вызов)."""
+        if not self.start():
+            return RESULT_UNKNOWN
+        return self.collector.result()
+
+    def start(self):
+        """Раздает первые порции всем доступным кластерам, не дожидаясь ответа."""
+        available_clusters = find_available_cluster(self.pool)
+        if not available_clusters:
+            logging.error("Нет доступных кластеров для обработки.")
+            return False
+        for _ in range(self.depth):
+            for node in available_clusters:
+                self.dispatch(node)
+        self.close_if_dispatched()
+        return True
+
+    def extend(self, bw_images):
+        """Добавляет в очередь изображения, принятые во время загрузки."""
+        with self.lock:
+            if self.abandoned:
+                return
+            self.bw_images.extend(bw_images)
+            self.wake_idle()
+
+    def close_upload(self):
+        """Загрузка завершена: остаток очереди раздается, в том числе неполной порцией."""
+        with self.lock:
+            self.upload_complete = True
+            self.wake_idle()
+        self.close_if_dispatched()
+
+    def wake_idle(self):
+        idle, self.idle = self.idle, []
+        for node in idle:
+            for _ in range(self.depth - self.in_flight.get(node[:2], 0)):
+                if not self.dispatch(node):
+                    break
+
+    def dispatch(self, node):
+        """Отправляет кластеру следующую порцию очереди, если она еще нужна."""
+        with self.lock:
+            # После найденного совпадения новые порции заведомо дают больший индекс
+            if self.collector.best is not None or self.collector.answer.done():
+                return False
+            size = self.chunk_sizes.get(node[:2], self.chunk_size)
+            remaining = len(self.bw_images) - self.cursor
+            if remaining <= 0 or (remaining < size and not self.upload_complete):
+                # Порция еще не набрана: кластер заберет ее, когда изображения придут
+                if not self.upload_complete and node not in self.idle:
+                    self.idle.append(node)
+                return False
+            offset = self.cursor
+            part = self.bw_images[offset:offset + size]
+            i = self.parts
+            self.cursor += len(part)
+            self.parts += 1
+            self.in_flight[node[:2]] = self.in_flight.get(node[:2], 0) + 1
+            logging.debug(f"Отправка порции {i} ({len(part)} изображений, смещение {offset}) на кластер {node[0]}:{node[1]}")
+            future = self.pool.compare_async(node, self.color_image_data, part, self.features)
+            self.collector.add(i, offset, part, node, future)
+            started = time.monotonic()
+        future.add_done_callback(lambda done: self.on_chunk_done(node, len(part), started, done))
+        return True
+
+    def on_chunk_done(self, node, size, started, future):
+        with self.lock:
+            self.in_flight[node[:2]] -= 1
+            if future.cancelled():
+                return
+            if future.exception() is None:
+                self.adapt_chunk_size(node, size, time.monotonic() - started)
+                self.dispatch(node)
+            elif node in find_available_cluster(self.pool):
+                # Ошибка запроса, а не кластера: кластер продолжает забирать порции
+                self.dispatch(node)
+            elif not any(self.in_flight.values()):
+                # Последний работающий кластер выбыл: очередь передается доступным кластерам
+                available_clusters = find_available_cluster(self.pool)
+                for n in available_clusters:
+                    self.dispatch(n)
+                if not available_clusters and (self.cursor < len(self.bw_images) or not self.upload_complete):
+                    logging.error(f"Нет доступных кластеров, не обработаны изображения начиная с {self.cursor}")
+                    self.collector.fail(self.cursor)
+                    self.cursor = len(self.bw_images)
+                    self.abandoned = self.upload_complete = True
+            self.close_if_dispatched()
+
+    def adapt_chunk_size(self, node, size, elapsed):
+        # Размер порции приближается к тому, что обрабатывается за target_seconds
+        target = size * self.target_seconds / max(elapsed, 1e-3)
+        new_size = int(min(max((self.chunk_sizes.get(node[:2], self.chunk_size) + target) / 2, QUEUE_MIN_CHUNK), QUEUE_MAX_CHUNK))
+        if new_size != self.chunk_sizes.get(node[:2]):
+            logging.debug(f"Размер порции для кластера {node[0]}:{node[1]}: {new_size}")
+        self.chunk_sizes[node[:2]] = new_size
+
+    def close_if_dispatched(self):
+        with self.lock:
+            done = (self.upload_complete and self.cursor >= len(self.bw_images)) or self.collector.best is not None
+        if done:
+            self.collector.close()
+
+class PipelinedSearch:
+    """
+    Конвейерная обработка: ч/б изображения отправляются кластерам порциями
+    по мере приема от клиента, поэтому вычисления идут параллельно с загрузкой.
+    Ответ может стать окончательным еще до конца загрузки (см. ResultCollector).
+    Каждая порция уходит кластеру, который раньше всех ее закончит с учетом уже
+    отправленных ему порций, его производительности и RTT, поэтому медленный
+    или далекий кластер получает меньше порций. В режиме распределения "queue"
+    принятые порции пополняют общую очередь (WorkQueueSearch), из которой
+    кластеры забирают работу сами.
+
+    С кэшем ответов первая порция отправляется только после проверки начала запроса:
+    если запрос может оказаться повтором, порции задерживаются до конца загрузки,
+    и повтор получает ответ из кэша без обращения к кластерам.
+    """
+
+    def __init__(self, pool, color_image_data, chunk_size, result_cache=None, features=False):
+        self.pool = pool
+        self.color_image_data = color_image_data
+        self.features = features
+        self.chunk_size = chunk_size
+        self.result_cache = result_cache
+        self.available_clusters = find_available_cluster(pool)
+        # Пока производительность неизвестна, кластеры считаются одинаковыми
+        rates, self.rtts = pool.estimates(self.available_clusters)
+        self.rates = rates or [1.0] * len(self.available_clusters)
+        self.busy_until = [0.0] * len(self.available_clusters)  # Ожидаемое окончание порций кластера
+        self.started = time.monotonic()
+        self.buffer = []
+        self.prefix_key = None  # Отпечаток первой порции запроса (для кэша ответов)
+        self.held = False  # Порции задерживаются до конца загрузки: запрос может быть повтором
+        self.dispatched = 0  # Сколько изображений уже отправлено кластерам
+        self.parts = 0
+        self.deduplicator = Deduplicator()
+        self.queue = None
+        if pool.scheduling == "queue":
+            self.queue = WorkQueueSearch(pool, color_image_data, [], features=features, upload_complete=False)
+            self.collector = self.queue.collector
+        else:
+            self.collector = ResultCollector(pool, color_image_data, features)
+        if not self.available_clusters:
+            logging.error("Нет доступных кластеров для обработки.")
+            self.collector.fail(0)  # Ответ не должен попасть в кэш
+            self.collector.answer.set_result(RESULT_UNKNOWN)
+        elif self.queue is not None:
+            self.queue.start()
+
+    def add(self, bw_image, digest=None):
+        """
+        Добавляет принятое изображение; полная порция сразу уходит на кластер.
+
+        :param digest: Отпечаток изображения (image_digest), если он уже посчитан.
+        """
+        # Отпечаток считается по всем изображениям: он нужен для ключа кэша ответов
+        is_new = self.deduplicator.add(bw_image, digest)
+        if self.result_cache is not None and self.deduplicator.total == self.chunk_size:
+            # До этого момента порции не отправлялись (уникальных изображений меньше порции)
+            self.prefix_key = self.deduplicator.request_key(self.color_image_data, self.features)
+            if self.result_cache.has_prefix(self.prefix_key):
+                logging.debug("Начало запроса совпадает с запросом из кэша, порции отправляются после загрузки")
+                self.held = True
+        if not is_new or self.collector.answer.done() or self.collector.best is not None:
+            # Повтор, ответ уже известен или найдено совпадение с меньшим индексом: изображение не отправляется
+            return
+        self.buffer.append(bw_image)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        # После найденного совпадения новые порции заведомо дают больший индекс
+        if not self.buffer or self.collector.answer.done() or self.collector.best is not None:
+            self.buffer = []
+            return
+        if self.held:
+            return
+        if self.queue is not None:
+            self.queue.extend(self.buffer)
+            self.dispatched += len(self.buffer)
+            self.buffer = []
+            return
+        i = self.parts
+        node = self.choose_node(len(self.buffer))
+        logging.debug(f"Отправка порции {i} ({len(self.buffer)} изображений, смещение {self.dispatched}) на кластер {node[0]}:{node[1]}")
+        future = self.pool.compare_async(node, self.color_image_data, self.buffer, self.features)
+        self.collector.add(i, self.dispatched, self.buffer, node, future)
+        self.parts += 1
+        self.dispatched += len(self.buffer)
+        self.buffer = []
+
+    def choose_node(self, size):
+        """Кластер с наименьшим ожидаемым временем окончания порции из size изображений."""
+        now = time.monotonic() - self.started
+        finishes = [max(self.busy_until[k], now + self.rtts[k]) + size / self.rates[k]
+                    for k in range(len(self.available_clusters))]
+        k = finishes.index(min(finishes))
+        self.busy_until[k] = finishes[k]
+        return self.available_clusters[k]
+
+    def finish(self):
+        """Загрузка завершена: отправляет остаток или берет ответ из кэша."""
+        if self.result_cache is not None and not self.collector.answer.done():
+            cached = self.result_cache.get(self.deduplicator.request_key(self.color_image_data, self.features))
+            if cached is not None:
+                # Отправленные порции отменяются, остаток не отправляется
+                logging.info(f"Ответ {cached} взят из кэша")
+                self.result_cache.log_stats()
+                self.buffer = []
+                self.collector.resolve(self.deduplicator.unique_index(cached))
+        # Задержанные изображения отправляются обычными порциями
+        self.held = False
+        buffered, self.buffer = self.buffer, []
+        for start in range(0, len(buffered), self.chunk_size):
+            self.buffer = buffered[start:start + self.chunk_size]
+            self.flush()
+        if self.queue is not None:
+            self.queue.close_upload()
+        else:
+            self.collector.close()
+        self.deduplicator.log_metrics()
+
+    def cancel(self):
+        """Клиент прервал загрузку: отправленные порции отменяются, ответ не кэшируется."""
+        self.buffer = []
+        self.collector.fail(self.dispatched)
+        self.collector.resolve(RESULT_UNKNOWN)
+
+    def store(self):
+        """Сохраняет окончательный ответ в кэш (после окончания загрузки)."""
+        if self.result_cache is not None and self.collector.is_complete():
+            self.result_cache.put(self.deduplicator.request_key(self.color_image_data, self.features),
+                                  self.original_index(self.collector.answer.result()), self.prefix_key)
+
+    def original_index(self, result):
+        return self.deduplicator.original_index(result)
+
+    def result(self):
+        """Отправляет остаток и ждет ответы кластеров (блокирующий вызов)."""
+        self.finish()
+        return self.original_index(self.collector.result())
+
+def iter_gallery_chunks(gallery_id, shard, bw_images, chunk_bytes=STREAM_CHUNK_BYTES):
+    """Формирует сообщения RegisterGallery: ч/б изображения части порциями не больше chunk_bytes."""
+    make_chunk = lambda chunk: image_service_pb2.GalleryChunk(gallery_id=gallery_id, shard=shard, bw_images=chunk)
+    yield from iter_image_chunks(bw_images, make_chunk, chunk_bytes)
+
+class GalleryRegistry:
+    """
+    Именованные галереи ч/б изображений. Галерея делится на части по доступным
+    кластерам, которые хранят гистограммы в памяти; запрос передает кластерам
+    только цветное изображение. Сервер хранит сами изображения, чтобы заново
+    загрузить часть, если кластер перезапустился или стал недоступен.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.galleries = {}  # Имя галереи -> список частей [номер, смещение, изображения, кластер]
+
+    def register(self, gallery_id, bw_images):
+        """
+        Загружает галерею на кластеры (блокирующий вызов).
+
+        :return: Число изображений в галерее или -1, если загрузить не удалось.
+        """
+        available_clusters = find_available_cluster(self.pool)
+        if not available_clusters:
+            logging.error("Нет доступных кластеров для регистрации галереи.")
+            return -1
+
+        shards = []
+        uploads = []
+        for shard, (offset, part) in enumerate(split_into_parts(bw_images, len(available_clusters))):
+            node = available_clusters[shard % len(available_clusters)]
+            shards.append([shard, offset, part, node])
+            uploads.append(self.upload_async(gallery_id, shard, part, node))
+
+        for entry, future in zip(shards, uploads):
+            if not self.wait_upload(gallery_id, entry, future):
+                return -1
+
+        with self.lock:
+            self.galleries[gallery_id] = shards
+        logging.info(f"Галерея {gallery_id} зарегистрирована: {len(bw_images)} изображений, частей: {len(shards)}")
+        return len(bw_images)
+
+    def upload_async(self, gallery_id, shard, part, node):
+        logging.debug(f"Загрузка части {shard} галереи {gallery_id} ({len(part)} изображений) на кластер {node[0]}:{node[1]}")
+        return node[3].RegisterGallery.future(iter_gallery_chunks(gallery_id, shard, part, self.pool.stream_chunk_bytes),
+                                              timeout=self.pool.rpc_timeout)
+
+    def wait_upload(self, gallery_id, entry, future):
+        """Дожидается загрузки части; при ошибке загружает ее на другой доступный кластер."""
+        shard, offset, part, node = entry
+        tried = {node[:2]}
+        while True:
+            try:
+                future.result()
+                entry[3] = node
+                return True
+            except grpc.RpcError as e:
+                logging.error(f"Ошибка загрузки части {shard} галереи {gallery_id} на {node[0]}:{node[1]}: {e.code().name}")
+                retry = self.pool.report_error(node, e, "RegisterGallery")
+                node = next((n for n in find_available_cluster(self.pool) if n[:2] not in tried), None) if retry else None
+                if node is None:
+                    return False
+                tried.add(node[:2])
+                future = self.upload_async(gallery_id, shard, part, node)
+
+    def query(self, gallery_id, color_image_data):
+        """
+        Ищет цветное изображение в зарегистрированной галерее (блокирующий вызов).
+
+        :return: Индекс совпадающего изображения (с единицы) или -1.
+        """
+        responses = self.query_shards(gallery_id, color_image_data)
+        if responses is None:
+            return -1
+        results = [offset + response.matching_index + 1 for offset, response in responses if response.matching_index >= 0]
+        return min(results) if results else -1
+
+    def top_k(self, gallery_id, color_image_data, k):
+        """
+        Находит k изображений галереи, наиболее похожих на цветное (блокирующий вызов).
+        Каждый кластер возвращает k лучших из своей части, сервер объединяет ответы.
+
+        :return: Список пар (индекс с единицы, оценка) по убыванию оценки; None при ошибке.
+        """
+        responses = self.query_shards(gallery_id, color_image_data, top_k=k)
+        if responses is None:
+            return None
+        results = [(offset + index + 1, score) for offset, response in responses
+                   for index, score in zip(response.indices, response.scores)]
+        results.sort(key=lambda result: (-result[1], result[0]))
+        return results[:k]
+
+    def query_shards(self, gallery_id, color_image_data, top_k=0):
+        """
+        Отправляет запрос всем частям галереи.
+
+        :return: Список пар (смещение части, CompareResponse) или None при ошибке.
+        """
+        with self.lock:
+            shards = self.galleries.get(gallery_id)
+        if shards is None:
+            logging.error(f"Галерея {gallery_id} не зарегистрирована")
+            return None
+
+        pending = [(entry, self.query_async(gallery_id, entry, color_image_data, top_k)) for entry in shards]
+        responses = []
+        for entry, future in pending:
+            try:
+                response = future.result()
+            except grpc.RpcError as e:
+                # Кластер потерял часть (перезапуск) или недоступен: загружаем ее заново и повторяем запрос
+                shard, offset, part, node = entry
+                logging.warning(f"Часть {shard} галереи {gallery_id} недоступна на {node[0]}:{node[1]}: {e.code().name}")
+                if e.code() != grpc.StatusCode.NOT_FOUND:
+                    retry = self.pool.report_error(node, e, "QueryGallery")
+                    node = next(iter(find_available_cluster(self.pool)), None) if retry else None
+                    if node is None:
+                        return None
+                if not self.wait_upload(gallery_id, entry, self.upload_async(gallery_id, shard, part, node)):
+                    return None
+                try:
+                    response = self.query_async(gallery_id, entry, color_image_data, top_k).result()
+                except grpc.RpcError as e:
+                    logging.error(f"Повторный запрос части {shard} галереи {gallery_id} не выполнен: {e.code().name}")
+                    return None
+            responses.append((entry[1], response))
+        return responses
+
+    def query_async(self, gallery_id, entry, color_image_data, top_k=0):
+        shard, offset, part, node = entry
+        request = image_service_pb2.GalleryQuery(gallery_id=gallery_id, shard=shard, color_image=color_image_data,
+                                                 top_k=top_k)
+        return node[3].QueryGallery.future(request, timeout=self.pool.rpc_timeout)
+
+# Адрес, на котором TCP сервер принимает клиентов
+TCP_HOST = '192.168.159.12'
+TCP_PORT = 5000
+
+# Число потоков, в которых выполняется распределение задач между кластерами
+MAX_CONCURRENT_REQUESTS = 32
+
+# Размер порции при конвейерной обработке (0 - сначала принять все изображения)
+PIPELINE_CHUNK_SIZE = 256
+
+# Типы сообщений: вместо длины цветного изображения клиент передает маркер
+# (такие длины недопустимы, поэтому старый протокол не меняется)
+MSG_REGISTER_GALLERY = 0xFFFFFF01  # имя галереи, ч/б изображения, 0; ответ - число изображений
+MSG_QUERY_GALLERY = 0xFFFFFF02     # имя галереи, цветное изображение; ответ - индекс
+MSG_TOP_K_GALLERY = 0xFFFFFF03     # имя галереи, цветное изображение, k (4 байта);
+                                   # ответ - число n и n пар (индекс, оценка float32)
+MSG_COMPARE_FEATURES = 0xFFFFFF04  # режим гистограмм: гистограмма эталона, гистограммы ч/б изображений, 0;
+                                   # ответ - индекс (гистограммы: histogram_engine.encode_features)
+GALLERY_MESSAGES = (MSG_REGISTER_GALLERY, MSG_QUERY_GALLERY, MSG_TOP_K_GALLERY)
+
+# Ответ "результат неизвестен": часть изображений не удалось обработать (см. RESULT_UNKNOWN)
+REPLY_UNKNOWN = 0xFFFFFFFF
+
+async def read_frame(reader):
+    """
+    Читает один кадр протокола: 4 байта длины (big-endian) и данные указанной длины.
+
+    :param reader: asyncio.StreamReader соединения.
+    :return: Данные кадра или None, если получен маркер конца (нулевая длина).
+    """
+    return await read_frame_body(reader, int.from_bytes(await reader.readexactly(4), 'big'))
+
+async def read_frame_body(reader, size):
+    """Данные кадра: крупные принимаются в bytearray точной длины (см. FrameProtocol)."""
+    if not size:
+        return None
+    return await reader.read_frame_data(size)
+
+async def read_bw_images(reader, search=None, executor=None):
+    """
+    Читает ч/б изображения до маркера конца; при search передает их в конвейер
+    пачками, отпечатки которых считаются в executor (см. add_to_search).
+    """
+    bw_images = []
+    batch_bytes = 0
+    while True:
         try:
-            # Формируем запрос с частью черно-белых изображений
-            request = image_service_pb2.CompareRequest(color_image=color_image_data, bw_images=part)
-            logging.debug(f"Отправка части {i} на кластер {ip}:{port}")
-            response = stub.CompareImages(request)
-            logging.debug(f"Ответ от кластера {ip}:{port}: {response.matching_index}")
-            
-            # Если найдено совпадение, сохраняем индекс, учитывая смещение
-            if response.matching_index >= 0:
-                adjusted_index = response.matching_index + images_processed_before + 1
-                results.append(adjusted_index)
-            
-            # Увеличиваем общее количество обработанных изображений
-            images_processed_before += len(part)
+            bw_image_data = await read_frame(reader)
+            if bw_image_data is None:
+                break
+            bw_images.append(bw_image_data)
+            logging.debug("Получено черно-белое изображение")
+            if search is not None:
+                batch_bytes += len(bw_image_data)
+                if len(bw_images) >= search.chunk_size or batch_bytes >= STREAM_CHUNK_BYTES:
+                    await add_to_search(search, bw_images, executor)
+                    bw_images = []
+                    batch_bytes = 0
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # Соединение прервано: запрос не обрабатывается
+            raise
         except Exception as e:
-            logging.error(f"Ошибка при обработке части {i} на {ip}:{port}: {e}")
-        finally:
-            if channel:
-                channel.close()
+            logging.error(f"Ошибка при получении черно-белых изображений: {e}")
+            break
+    if search is not None:
+        if bw_images:
+            await add_to_search(search, bw_images, executor)
+        return []
+    return bw_images
 
-    # Если совпадений не было, возвращаем -1
-    if not results:
-        return -1
+async def add_to_search(search, bw_images, executor):
+    """
+    Передает пачку изображений в конвейер. Отпечатки (blake2b по всем байтам)
+    считаются в пуле потоков, чтобы хеширование больших загрузок не останавливало
+    цикл событий и другие соединения.
+    """
+    digests = await asyncio.get_running_loop().run_in_executor(executor, image_digests, bw_images)
+    for bw_image, digest in zip(bw_images, digests):
+        search.add(bw_image, digest)
+
+def encode_index(final_index):
+    """Ответ клиенту: индекс (с единицы) в 4 байтах, 0 - совпадений нет, REPLY_UNKNOWN - результат неизвестен."""
+    if final_index == RESULT_UNKNOWN:
+        return REPLY_UNKNOWN.to_bytes(4, 'big')
+    return max(final_index, 0).to_bytes(4, 'big')
+
+def encode_top_k(results):
+    """Ответ на запрос top-k: число результатов, затем пары (индекс, оценка float32), big-endian."""
+    results = results or []
+    reply = bytearray(len(results).to_bytes(4, 'big'))
+    for index, score in results:
+        reply += index.to_bytes(4, 'big') + struct.pack('>f', score)
+    return bytes(reply)
+
+async def handle_gallery_request(message_type, reader, galleries, executor):
+    """
+    Обслуживает регистрацию галереи или запрос к ней.
+
+    :return: Ответ клиенту (число изображений, индекс с единицы или результаты top-k).
+    """
+    if galleries is None:
+        logging.error("Галереи не поддерживаются этим сервером")
+        return encode_top_k(None) if message_type == MSG_TOP_K_GALLERY else encode_index(-1)
+    gallery_id = (await read_frame(reader)).decode('utf-8')
+    loop = asyncio.get_running_loop()
+    if message_type == MSG_REGISTER_GALLERY:
+        # Сообщения галерей собираются protobuf, которому нужны bytes (для bytes копии нет)
+        bw_images = [bytes(bw_image) for bw_image in await read_bw_images(reader)]
+        logging.debug(f"Регистрация галереи {gallery_id}: {len(bw_images)} изображений")
+        return encode_index(await loop.run_in_executor(executor, galleries.register, gallery_id, bw_images))
+    color_image_data = bytes(await read_frame(reader))
+    if message_type == MSG_TOP_K_GALLERY:
+        k = int.from_bytes(await read_frame(reader), 'big')
+        logging.debug(f"Поиск {k} наиболее похожих изображений в галерее {gallery_id}")
+        return encode_top_k(await loop.run_in_executor(executor, galleries.top_k, gallery_id, color_image_data, k))
+    logging.debug(f"Поиск в галерее {gallery_id}")
+    return encode_index(await loop.run_in_executor(executor, galleries.query, gallery_id, color_image_data))
+
+async def send_reply(writer, addr, reply):
+    try:
+        writer.write(reply)
+        await writer.drain()
+        logging.info(f"Отправлен ответ клиенту {addr}: {int.from_bytes(reply[:4], 'big')} ({len(reply)} байт)")
+    except Exception as e:
+        logging.error(f"Ошибка при отправке результата клиенту: {e}")
+
+async def handle_client(reader, writer, pool, executor, pipeline_chunk_size=PIPELINE_CHUNK_SIZE, galleries=None,
+                        result_cache=None):
+    """
+    Обслуживает одно TCP соединение: принимает изображения, передает их кластерам
+    в пуле потоков (чтобы не блокировать цикл событий) и отправляет результат клиенту.
+    При pipeline_chunk_size > 0 порции уходят кластерам еще во время загрузки.
+    Сообщения с маркером типа обслуживаются галереями (GalleryRegistry).
+    Соединение обслуживает запросы один за другим, пока клиент его не закроет.
+    """
+    addr = writer.get_extra_info('peername')
+    logging.info(f'Подключено к {addr}')
+    try:
+        while await handle_request(reader, writer, addr, pool, executor, pipeline_chunk_size, galleries,
+                                   result_cache):
+            pass
+    except (asyncio.IncompleteReadError, ConnectionError) as e:
+        # Клиент закрыл соединение посреди запроса (например, отменил его)
+        logging.warning(f"Клиент {addr} отключился до окончания запроса: {e!r}")
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+async def handle_request(reader, writer, addr, pool, executor, pipeline_chunk_size, galleries, result_cache):
+    """
+    Обслуживает один запрос соединения.
+
+    :return: False, если клиент закрыл соединение или запрос не удалось принять.
+    """
+    # Получаем цветное изображение (или маркер типа сообщения)
+    try:
+        header_bytes = await reader.readexactly(4)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            logging.info(f"Клиент {addr} закрыл соединение")
+            return False
+        raise
+    try:
+        header = int.from_bytes(header_bytes, 'big')
+        features = header == MSG_COMPARE_FEATURES
+        if header in GALLERY_MESSAGES:
+            reply = await handle_gallery_request(header, reader, galleries, executor)
+            color_image_data = None
+        elif features:
+            # Клиент передает гистограммы вместо изображений, кластеры их не декодируют
+            color_image_data = await read_frame(reader)
+            logging.debug("Получена гистограмма эталона")
+        else:
+            color_image_data = await read_frame_body(reader, header)
+            logging.debug("Color image received from client")
+    except (asyncio.IncompleteReadError, ConnectionError):
+        raise
+    except Exception as e:
+        logging.error(f"Ошибка при получении цветного изображения: {e}")
+        return False
+
+    if color_image_data is not None:
+        if pipeline_chunk_size > 0:
+            # Порции обрабатываются во время загрузки; ответ отправляется, как только
+            # он окончателен, а остаток загрузки дочитывается без обработки
+            search = PipelinedSearch(pool, color_image_data, pipeline_chunk_size, result_cache, features)
+            upload = asyncio.ensure_future(read_bw_images(reader, search, executor))
+            answer = asyncio.wrap_future(search.collector.answer)
+            await asyncio.wait({upload, answer}, return_when=asyncio.FIRST_COMPLETED)
+            if upload.done() and upload.exception() is not None:
+                # Загрузка прервана: отправленные порции отменяются
+                search.cancel()
+                raise upload.exception()
+            if not answer.done():
+                # Загрузка завершена раньше: отправляем остаток и ждем ответ
+                search.finish()
+                reply = encode_index(search.original_index(await answer))
+            else:
+                await send_reply(writer, addr, encode_index(search.original_index(answer.result())))
+                logging.debug("Ответ отправлен до окончания загрузки")
+                reply = None
+                await upload
+                search.finish()
+            search.store()
+        else:
+            # Получаем черно-белые изображения
+            bw_images = await read_bw_images(reader)
 
-    # Возвращаем первый найденный индекс совпадения
-    return min(results)
+            # Распределяем задачи между кластерами и обрабатываем изображения
+            logging.debug("Распределение задач между кластерами")
+            loop = asyncio.get_running_loop()
+            final_index = await loop.run_in_executor(executor, process_images, color_image_data, bw_images, pool,
+                                                     result_cache, features)
+            reply = encode_index(final_index)
+
+    # Отправляем результат клиенту
+    if reply is not None:
+        await send_reply(writer, addr, reply)
+    # Непрочитанный запрос к галерее на сервере без галерей не дает продолжить соединение
+    return galleries is not None or header not in GALLERY_MESSAGES
+
+async def create_tcp_server(host, port, pool, executor, pipeline_chunk_size=PIPELINE_CHUNK_SIZE, galleries=None,
+                            result_cache=None):
+    """
+    Создает асинхронный TCP сервер: каждое соединение обслуживается отдельной задачей,
+    поэтому долгая загрузка одного клиента не задерживает остальных.
+    """
+    handler = functools.partial(handle_client, pool=pool, executor=executor, pipeline_chunk_size=pipeline_chunk_size,
+                                galleries=galleries, result_cache=result_cache)
+    loop = asyncio.get_running_loop()
+    # Кадры принимаются в заранее выделенные буферы (recv_into) ровно нужной длины
+    return await loop.create_server(lambda: frame_protocol.FrameProtocol(handler), host, port)
 
+async def serve_tcp(host, port, pool, max_concurrent_requests=MAX_CONCURRENT_REQUESTS,
+                    pipeline_chunk_size=PIPELINE_CHUNK_SIZE, result_cache=None):
+    with futures.ThreadPoolExecutor(max_workers=max_concurrent_requests) as executor:
+        server = await create_tcp_server(host, port, pool, executor, pipeline_chunk_size, GalleryRegistry(pool),
+                                         result_cache)
+        logging.info(f"TCP сервер запущен на порту {port}")
+        async with server:
+            await server.serve_forever()
 
+def load_calibration_images(directory, count=CALIBRATION_IMAGES):
+    """Читает до count изображений из каталога для калибровки кластеров."""
+    if not os.path.isdir(directory):
+        logging.warning(f"Каталог {directory} не найден, калибровка кластеров пропущена")
+        return []
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+    images = []
+    for name in names[:count]:
+        with open(os.path.join(directory, name), 'rb') as file:
+            images.append(file.read())
+    return images
 
 def start_tcp_server():
     # Загрузка конфигурации кластеров
-    clusters = load_config()["clusters"]
+    config = load_config()
+    clusters = config["clusters"]
+    max_concurrent_requests = config.get("max_concurrent_requests", MAX_CONCURRENT_REQUESTS)
+    pipeline_chunk_size = config.get("pipeline_chunk_size", PIPELINE_CHUNK_SIZE)
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind(('192.168.159.12', 5000))
-        s.listen()
-        logging.info("TCP сервер запущен на порту 5000")
-        
-        while True:
-            conn, addr = s.accept()
-            with conn:
-                logging.info(f'Подключено к {addr}')
-                
-                # Получаем цветное изображение
-                try:
-                    color_image_size = int.from_bytes(conn.recv(4), 'big')
-                    color_image_data = conn.recv(color_image_size)
-                    logging.debug("Color image received from client")
-                except Exception as e:
-                    logging.error(f"Ошибка при получении цветного изображения: {e}")
-                    continue
-
-                # Получаем черно-белые изображения
-                bw_images = []
-                while True:
-                    try:
-                        bw_image_size = int.from_bytes(conn.recv(4), 'big')
-                        if not bw_image_size:
-                            break
-                        bw_image_data = conn.recv(bw_image_size)
-                        bw_images.append(bw_image_data)
-                        logging.debug("Получено черно-белое изображение")
-                    except Exception as e:
-                        logging.error(f"Ошибка при получении черно-белых изображений: {e}")
-                        break
-
-                # Распределяем задачи между кластерами и обрабатываем изображения
-                logging.debug("Распределение задач между кластерами")
-                final_index = process_images(color_image_data, bw_images, clusters)
-
-                # Отправляем результат клиенту
-                try:
-                    matching_index_to_send = final_index if final_index >= 0 else 0
-                    conn.sendall(matching_index_to_send.to_bytes(4, 'big'))
-                    logging.info(f"Отправлен индекс совпадающего изображения клиенту: {matching_index_to_send}")
-                except Exception as e:
-                    logging.error(f"Ошибка при отправке результата клиенту: {e}")
+    # Соединения с кластерами создаются один раз и прогреваются до приема клиентов
+    pool = ClusterPool(clusters, streaming=config.get("streaming", True),
+                       stream_chunk_bytes=config.get("stream_chunk_bytes", STREAM_CHUNK_BYTES),
+                       rpc_timeout=config.get("rpc_timeout", RPC_TIMEOUT),
+                       scheduling=config.get("scheduling", SCHEDULING))
+    logging.info(f"Распределение работы: {pool.scheduling}, " + (
+        f"конвейерная обработка порциями по {pipeline_chunk_size}" if pipeline_chunk_size > 0 else "без конвейера"))
+    pool.warm_up()
+    pool.calibrate(load_calibration_images(config.get("calibration_dir", CALIBRATION_DIR)))
+    pool.start_health_checks()
+
+    # Кэш ответов на повторяющиеся запросы
+    result_cache = ResultCache(max_entries=config.get("result_cache_entries", RESULT_CACHE_ENTRIES),
+                               ttl=config.get("result_cache_ttl", RESULT_CACHE_TTL),
+                               max_bytes=config.get("result_cache_mb", RESULT_CACHE_BYTES // (1024 * 1024)) * 1024 * 1024)
+    try:
+        asyncio.run(serve_tcp(TCP_HOST, TCP_PORT, pool, max_concurrent_requests, pipeline_chunk_size, result_cache))
+    finally:
+        pool.close()
 
 if __name__ == '__main__':
     # Запускаем TCP сервер
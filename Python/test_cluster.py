@@ -0,0 +1,215 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+import numpy as np
+from PIL import Image
+import image_service_pb2
+import cluster
+import histogram_engine
+
+# Генерация однотонного изображения в формате JPEG
+def generate_image(color, mode="RGB", size=(100, 100)):
+    img = Image.new(mode, size, color)
+    byte_stream = io.BytesIO()
+    img.save(byte_stream, format="JPEG")
+    return byte_stream.getvalue()
+
+# Красный цвет в градациях серого дает яркость 76
+COLOR_IMAGE = generate_image((255, 0, 0))
+MATCHING_BW_IMAGE = generate_image(76, mode="L")
+OTHER_BW_IMAGE = generate_image(200, mode="L")
+
+# Тесты сервиса кластера
+class TestImageService(unittest.TestCase):
+    def setUp(self):
+        self.service = cluster.ImageService()
+
+    def test_compare_images_finds_first_match(self):
+        request = image_service_pb2.CompareRequest(
+            color_image=COLOR_IMAGE, bw_images=[OTHER_BW_IMAGE, MATCHING_BW_IMAGE, MATCHING_BW_IMAGE])
+        response = self.service.CompareImages(request, None)
+        self.assertEqual(response.matching_index, 1)
+
+    def test_stream_stops_reading_after_match(self):
+        read_chunks = []
+
+        def chunks():
+            yield image_service_pb2.CompareChunk(color_image=COLOR_IMAGE)
+            for chunk in ([OTHER_BW_IMAGE, OTHER_BW_IMAGE], [OTHER_BW_IMAGE, MATCHING_BW_IMAGE], [MATCHING_BW_IMAGE]):
+                read_chunks.append(chunk)
+                yield image_service_pb2.CompareChunk(bw_images=chunk)
+
+        response = self.service.CompareImagesStream(chunks(), None)
+        # Индекс считается по всему потоку, последняя порция не прочитана
+        self.assertEqual(response.matching_index, 3)
+        self.assertEqual(len(read_chunks), 2)
+        self.assertEqual(self.service.in_flight, 0)
+
+    def test_cancelled_call_stops_processing(self):
+        class CancelledContext:
+            def is_active(self):
+                return False
+
+        request = image_service_pb2.CompareRequest(color_image=COLOR_IMAGE, bw_images=[MATCHING_BW_IMAGE])
+        self.assertEqual(self.service.CompareImages(request, CancelledContext()).matching_index, -1)
+        self.assertEqual(self.service.cache.stats()["misses"], 0)
+
+    def test_stream_without_match(self):
+        def chunks():
+            yield image_service_pb2.CompareChunk(color_image=COLOR_IMAGE)
+            yield image_service_pb2.CompareChunk(bw_images=[OTHER_BW_IMAGE])
+
+        response = self.service.CompareImagesStream(chunks(), None)
+        self.assertEqual(response.matching_index, -1)
+
+# Тесты режима гистограмм: кластер получает гистограммы и не декодирует изображения
+class TestFeatures(unittest.TestCase):
+    def setUp(self):
+        self.service = cluster.ImageService()
+
+    def test_features_give_same_result_as_images(self):
+        bw_images = [OTHER_BW_IMAGE, MATCHING_BW_IMAGE, MATCHING_BW_IMAGE]
+        request = image_service_pb2.CompareRequest(
+            color_histogram=histogram_engine.image_features(COLOR_IMAGE),
+            bw_histograms=[histogram_engine.image_features(image) for image in bw_images])
+        self.assertEqual(self.service.CompareImages(request, None).matching_index, 1)
+        self.assertEqual(self.service.cache.stats()["misses"], 0)
+
+    def test_stream_of_features(self):
+        def chunks():
+            yield image_service_pb2.CompareChunk(color_histogram=histogram_engine.image_features(COLOR_IMAGE))
+            yield image_service_pb2.CompareChunk(bw_histograms=[histogram_engine.image_features(OTHER_BW_IMAGE)])
+            # Гистограмма неверной длины не совпадает ни с чем
+            yield image_service_pb2.CompareChunk(bw_histograms=[b"bad", histogram_engine.image_features(MATCHING_BW_IMAGE)])
+
+        self.assertEqual(self.service.CompareImagesStream(chunks(), None).matching_index, 2)
+
+# Тесты галерей кластера
+class TestGallery(unittest.TestCase):
+    def test_query_uses_stored_histograms(self):
+        service = cluster.ImageService()
+        chunks = [image_service_pb2.GalleryChunk(gallery_id="g", shard=1, bw_images=[OTHER_BW_IMAGE]),
+                  image_service_pb2.GalleryChunk(gallery_id="g", shard=1, bw_images=[MATCHING_BW_IMAGE])]
+        self.assertEqual(service.RegisterGallery(iter(chunks), None).size, 2)
+        query = image_service_pb2.GalleryQuery(gallery_id="g", shard=1, color_image=COLOR_IMAGE)
+        self.assertEqual(service.QueryGallery(query, None).matching_index, 1)
+
+    def test_top_k_query(self):
+        service = cluster.ImageService()
+        bw_images = [OTHER_BW_IMAGE, MATCHING_BW_IMAGE, generate_image(90, mode="L")]
+        service.RegisterGallery(iter([image_service_pb2.GalleryChunk(gallery_id="g", bw_images=bw_images)]), None)
+        query = image_service_pb2.GalleryQuery(gallery_id="g", color_image=COLOR_IMAGE, top_k=2)
+        response = service.QueryGallery(query, None)
+        self.assertEqual(list(response.indices)[0], 1)
+        self.assertEqual(len(response.scores), 2)
+        self.assertGreaterEqual(response.scores[0], response.scores[1])
+
+# Тесты кэша гистограмм
+class TestHistogramCache(unittest.TestCase):
+    def test_repeated_images_hit_cache(self):
+        service = cluster.ImageService()
+        request = image_service_pb2.CompareRequest(color_image=COLOR_IMAGE, bw_images=[OTHER_BW_IMAGE, OTHER_BW_IMAGE])
+        service.CompareImages(request, None)
+        service.CompareImages(request, None)
+        stats = service.cache.stats()
+        # Одно уникальное изображение: один промах; повтор в первом запросе кэш не читает
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(service.Ping(None, None).cache_hits, 2)
+
+    def test_repeats_in_batch_without_cache(self):
+        for max_entries in (0, 1):
+            service = cluster.ImageService(cache=cluster.HistogramCache(max_entries=max_entries))
+            histograms = service.batch_histograms([MATCHING_BW_IMAGE, OTHER_BW_IMAGE, MATCHING_BW_IMAGE], 0)
+            self.assertTrue(all(hist is not None for hist in histograms))
+            np.testing.assert_array_equal(histograms[0], histograms[2])
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = cluster.HistogramCache(max_entries=2)
+        hist = np.zeros((256, 1), dtype=np.float32)
+        cache.put(b"a", hist)
+        cache.put(b"b", hist)
+        cache.get((b"a"))
+        cache.put(b"c", hist)
+        self.assertIsNotNone(cache.get((b"a")))
+        self.assertIsNone(cache.get((b"b")))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_byte_limit(self):
+        hist = np.zeros((256, 1), dtype=np.float32)
+        cache = cluster.HistogramCache(max_bytes=2 * (hist.nbytes + 1))
+        for key in (b"a", b"b", b"c"):
+            cache.put(key, hist)
+        stats = cache.stats()
+        self.assertEqual(stats["entries"], 2)
+        self.assertLessEqual(stats["bytes"], 2 * (hist.nbytes + 1))
+
+# Тесты режимов декодирования
+class TestDecodeModes(unittest.TestCase):
+    def test_reduced_decode_of_jpeg(self):
+        image = generate_image(120, mode="L", size=(160, 80))
+        self.assertEqual(cluster.decode_grayscale(image, "full").shape, (80, 160))
+        self.assertEqual(cluster.decode_grayscale(image, "reduced4").shape, (20, 40))
+
+    def test_png_falls_back_to_full_size(self):
+        byte_stream = io.BytesIO()
+        Image.new("RGB", (64, 32), (0, 128, 255)).save(byte_stream, format="PNG")
+        image = cluster.decode_grayscale(byte_stream.getvalue(), "reduced8", reference=True)
+        self.assertEqual(image.shape, (32, 64))
+
+    def test_all_modes_find_same_match(self):
+        request = image_service_pb2.CompareRequest(
+            color_image=COLOR_IMAGE, bw_images=[OTHER_BW_IMAGE, MATCHING_BW_IMAGE])
+        for mode in cluster.DECODE_MODES:
+            service = cluster.ImageService(decode_mode=mode)
+            self.assertEqual(service.CompareImages(request, None).matching_index, 1, mode)
+
+    def test_unknown_mode_is_rejected(self):
+        with self.assertRaises(ValueError):
+            cluster.ImageService(decode_mode="fast")
+
+# Тесты декодирования в пуле процессов
+class TestProcessPool(unittest.TestCase):
+    def test_process_pool_finds_same_match(self):
+        service = cluster.ImageService(processes=2)
+        self.addCleanup(service.close)
+        bw_images = [OTHER_BW_IMAGE, b"not an image"] * 40 + [MATCHING_BW_IMAGE]
+        request = image_service_pb2.CompareRequest(color_image=COLOR_IMAGE, bw_images=bw_images)
+        self.assertEqual(service.CompareImages(request, None).matching_index, 80)
+        self.assertEqual(service.Ping(None, None).workers, cluster.MAX_WORKERS)
+
+    def test_available_cpus_is_positive(self):
+        self.assertGreaterEqual(cluster.available_cpus(), 1)
+
+# Тесты параметров запуска узлов
+class TestLaunchOptions(unittest.TestCase):
+    def setUp(self):
+        self.config_path = os.path.join(tempfile.mkdtemp(), "config.json")
+        with open(self.config_path, "w") as file:
+            json.dump({"clusters": [{"ip": "10.0.0.1", "port": 50051}, {"ip": "10.0.0.2", "port": 50051}],
+                       "node": {"host": "10.0.0.1", "workers": 4}}, file)
+
+    def test_arguments_override_config(self):
+        args = cluster.parse_args(["--port", "6000", "--count", "3"], config_path=self.config_path)
+        self.assertEqual((args.host, args.port, args.count, args.workers), ("10.0.0.1", 6000, 3, 4))
+        self.assertEqual(args.max_message_mb, cluster.MAX_MESSAGE_MB)
+        self.assertEqual(args.cache_entries, cluster.HISTOGRAM_CACHE_ENTRIES)
+        self.assertIsNone(args.write_config)
+
+    def test_processes_accepts_auto(self):
+        self.assertIsNone(cluster.parse_args(["--processes", "auto"], config_path=self.config_path).processes)
+        self.assertIsNone(cluster.parse_args(["--processes", "-1"], config_path=self.config_path).processes)
+        self.assertEqual(cluster.parse_args(["--processes", "2"], config_path=self.config_path).processes, 2)
+
+    def test_write_config_replaces_nodes_of_host(self):
+        cluster.write_config(self.config_path, "10.0.0.1", cluster.node_addresses("10.0.0.1", 6000, 2))
+        with open(self.config_path) as file:
+            config = json.load(file)
+        self.assertEqual(config["clusters"], [{"ip": "10.0.0.1", "port": 6000}, {"ip": "10.0.0.1", "port": 6001},
+                                              {"ip": "10.0.0.2", "port": 50051}])
+        self.assertEqual(config["node"]["workers"], 4)
+
+if __name__ == '__main__':
+    unittest.main()
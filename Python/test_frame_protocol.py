@@ -0,0 +1,88 @@
+import asyncio
+import unittest
+import image_service_pb2
+import frame_protocol
+import server
+
+# Тест приема кадров в заранее выделенные буферы
+class TestFrameProtocol(unittest.IsolatedAsyncioTestCase):
+    async def start_echo_server(self, **options):
+        """Сервер читает кадры (длина + данные) до нулевой длины и отвечает их числом."""
+        self.frames = []
+
+        async def handler(reader, writer):
+            while True:
+                size = int.from_bytes(await reader.readexactly(4), 'big')
+                if not size:
+                    break
+                self.frames.append(await reader.read_frame_data(size))
+            writer.write(len(self.frames).to_bytes(4, 'big'))
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+
+        loop = asyncio.get_running_loop()
+        tcp_server = await loop.create_server(lambda: frame_protocol.FrameProtocol(handler, **options), '127.0.0.1', 0)
+        return tcp_server, tcp_server.sockets[0].getsockname()[1]
+
+    async def send_frames(self, port, frames, piece=None):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        data = b"".join(len(frame).to_bytes(4, 'big') + frame for frame in frames) + (0).to_bytes(4, 'big')
+        piece = piece or len(data)
+        for start in range(0, len(data), piece):
+            # Данные приходят произвольными кусками
+            writer.write(data[start:start + piece])
+            await writer.drain()
+            await asyncio.sleep(0)
+        count = int.from_bytes(await reader.readexactly(4), 'big')
+        writer.close()
+        await writer.wait_closed()
+        return count
+
+    async def test_frames_arrive_whole(self):
+        tcp_server, port = await self.start_echo_server(buffer_bytes=64, direct_frame_bytes=100)
+        frames = [bytes([i % 251]) * size for i, size in enumerate([1, 50, 99, 100, 1000, 70000, 3])]
+        async with tcp_server:
+            self.assertEqual(await self.send_frames(port, frames, piece=37), len(frames))
+        self.assertEqual([bytes(frame) for frame in self.frames], frames)
+        # Крупные кадры принимаются в собственный буфер, мелкие копируются в bytes
+        self.assertEqual([type(frame) for frame in self.frames],
+                         [bytes, bytes, bytes, bytearray, bytearray, bytearray, bytes])
+
+    async def test_connection_closed_mid_frame(self):
+        errors = []
+        handled = asyncio.Event()
+
+        async def handler(reader, writer):
+            try:
+                await reader.read_frame_data(1000)
+            except asyncio.IncompleteReadError as e:
+                errors.append(e)
+            writer.close()
+            handled.set()
+
+        loop = asyncio.get_running_loop()
+        tcp_server = await loop.create_server(lambda: frame_protocol.FrameProtocol(handler, direct_frame_bytes=10),
+                                              '127.0.0.1', 0)
+        async with tcp_server:
+            reader, writer = await asyncio.open_connection('127.0.0.1', tcp_server.sockets[0].getsockname()[1])
+            writer.write(b"x" * 500)
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+            await asyncio.wait_for(handled.wait(), 2)
+        self.assertEqual(len(errors), 1)
+
+# Тест байтового представления запроса к кластеру
+class TestCompareRequestEncoding(unittest.TestCase):
+    def test_matches_protobuf(self):
+        bw_images = [b"", b"a" * 200, bytearray(b"b" * 20000), memoryview(b"c" * 3)]
+        encoded = server.encode_compare_request(b"color", bw_images)
+        request = image_service_pb2.CompareRequest.FromString(encoded)
+        self.assertEqual(request.color_image, b"color")
+        self.assertEqual(list(request.bw_images), [bytes(bw_image) for bw_image in bw_images])
+        self.assertEqual(encoded, image_service_pb2.CompareRequest(
+            color_image=b"color", bw_images=[bytes(bw_image) for bw_image in bw_images]).SerializeToString())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+import numpy as np
+import cv2
+import histogram_engine
+
+# Тесты пакетного сравнения гистограмм
+class TestHistogramEngine(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.images = [rng.integers(0, 256, size=(40, 60), dtype=np.uint8) for _ in range(20)]
+        self.histograms = [histogram_engine.calc_histogram(image) for image in self.images]
+
+    def test_scores_match_opencv(self):
+        reference = self.histograms[0]
+        scores = histogram_engine.correlation_scores(reference, histogram_engine.histogram_matrix(self.histograms))
+        expected = [cv2.compareHist(reference, hist, cv2.HISTCMP_CORREL) for hist in self.histograms]
+        np.testing.assert_allclose(scores, expected, atol=1e-6)
+
+    def test_first_match_skips_missing_histograms(self):
+        reference = self.histograms[5]
+        histograms = self.histograms[:3] + [None] + self.histograms[3:]
+        # Пропущенная строка сдвигает индекс эталона на единицу и сама не совпадает
+        self.assertEqual(histogram_engine.first_match(reference, histogram_engine.histogram_matrix(histograms)), 6)
+
+    def test_constant_histograms_are_equal(self):
+        flat = np.ones(histogram_engine.HIST_BINS, dtype=np.float32)
+        scores = histogram_engine.correlation_scores(flat, histogram_engine.histogram_matrix([flat]))
+        self.assertEqual(scores[0], cv2.compareHist(flat, flat, cv2.HISTCMP_CORREL))
+
+    def test_empty_matrix(self):
+        self.assertEqual(histogram_engine.first_match(self.histograms[0], histogram_engine.histogram_matrix([])), -1)
+
+if __name__ == '__main__':
+    unittest.main()
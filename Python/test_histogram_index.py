@@ -0,0 +1,51 @@
+import unittest
+import numpy as np
+import histogram_engine
+import histogram_index
+
+# Синтетическая галерея: гистограммы группируются вокруг нескольких центров
+def generate_histograms(count, centers=20, seed=0):
+    rng = np.random.default_rng(seed)
+    base = rng.random((centers, histogram_engine.HIST_BINS)).astype(np.float32)
+    matrix = base[rng.integers(0, centers, count)] + rng.normal(0, 0.05, (count, histogram_engine.HIST_BINS))
+    matrix = np.clip(matrix, 0, None).astype(np.float32)
+    return matrix / matrix.max(axis=1, keepdims=True)
+
+# Тесты индекса для поиска top-k
+class TestHistogramIndex(unittest.TestCase):
+    def setUp(self):
+        self.matrix = generate_histograms(2000)
+        self.reference = self.matrix[17]
+
+    def exact_top_k(self, k):
+        scores = histogram_engine.correlation_scores(self.reference, self.matrix)
+        return np.argsort(-scores, kind='stable')[:k]
+
+    def test_flat_search_is_exact(self):
+        index = histogram_index.HistogramIndex(self.matrix)
+        self.assertIsNone(index.centroids)
+        ids, scores = index.search(self.reference, 5)
+        np.testing.assert_array_equal(ids, self.exact_top_k(5))
+        self.assertEqual(ids[0], 17)
+        self.assertTrue(np.all(np.diff(scores) <= 0))
+
+    def test_probing_all_lists_is_exact(self):
+        index = histogram_index.HistogramIndex(self.matrix, lists=16)
+        ids, _ = index.search(self.reference, 10, probes=16)
+        np.testing.assert_array_equal(ids, self.exact_top_k(10))
+
+    def test_partial_probe_keeps_nearest(self):
+        index = histogram_index.HistogramIndex(self.matrix, lists=16)
+        ids, _ = index.search(self.reference, 10, probes=2)
+        self.assertEqual(ids[0], 17)
+        self.assertGreaterEqual(len(set(ids) & set(self.exact_top_k(10))), 8)
+
+    def test_missing_rows_are_skipped(self):
+        matrix = self.matrix[:10].copy()
+        matrix[3] = np.nan
+        ids, _ = histogram_index.HistogramIndex(matrix).search(matrix[0], 10)
+        self.assertEqual(len(ids), 9)
+        self.assertNotIn(3, ids)
+
+if __name__ == '__main__':
+    unittest.main()
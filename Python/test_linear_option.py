@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+from PIL import Image
+import linearOption
+
+# Тесты локального поиска первого совпадения
+class TestLocalMatcher(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def save_image(self, name, color, mode="L", size=(100, 100)):
+        path = os.path.join(self.directory.name, name)
+        Image.new(mode, size, color).save(path, format="JPEG")
+        return path
+
+    def make_gallery(self, match_indices, count):
+        """Красный цвет в градациях серого дает яркость 76; остальные изображения светлее."""
+        self.color_path = self.save_image("color.jpg", (255, 0, 0), mode="RGB")
+        return [self.save_image(f"bw_{i:03}.jpg", 76 if i in match_indices else 200) for i in range(count)]
+
+    def test_first_match_across_chunks(self):
+        bw_paths = self.make_gallery({5, 9, 2}, 12)
+        matcher = linearOption.LocalMatcher(processes=0, chunk_size=3)
+        self.assertEqual(matcher.find_first_match(self.color_path, bw_paths), 2)
+        self.assertEqual(matcher.find_first_match(self.color_path, bw_paths[3:]), 2)
+
+    def test_no_match(self):
+        bw_paths = self.make_gallery(set(), 5)
+        matcher = linearOption.LocalMatcher(processes=0, chunk_size=2)
+        self.assertEqual(matcher.find_first_match(self.color_path, bw_paths), -1)
+        self.assertEqual(matcher.find_first_match(self.color_path, []), -1)
+
+    def test_unreadable_image_is_skipped(self):
+        bw_paths = self.make_gallery({3}, 4)
+        bw_paths[1] = os.path.join(self.directory.name, "missing.jpg")
+        matcher = linearOption.LocalMatcher(processes=0, chunk_size=2)
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(matcher.find_first_match(self.color_path, bw_paths), 3)
+
+    def test_process_pool_finds_same_match(self):
+        bw_paths = self.make_gallery({7, 11}, 16)
+        matcher = linearOption.LocalMatcher(processes=2, chunk_size=2)
+        self.addCleanup(matcher.close)
+        self.assertEqual(matcher.find_first_match(self.color_path, bw_paths), 7)
+
+# Тесты запуска из командной строки
+class TestCommandLine(unittest.TestCase):
+    def test_directory_is_expanded_in_sorted_order(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ("b.png", "a.JPG", "notes.txt"):
+                open(os.path.join(directory, name), "wb").close()
+            self.assertEqual(linearOption.expand_paths([directory, "c.jpg"]),
+                             [os.path.join(directory, "a.JPG"), os.path.join(directory, "b.png"), "c.jpg"])
+
+    def test_arguments(self):
+        args = linearOption.parse_args(["--color", "color.jpg", "bw", "--processes", "auto", "--chunk-size", "8"])
+        self.assertEqual((args.color, args.bw, args.processes, args.chunk_size), ("color.jpg", ["bw"], None, 8))
+        self.assertIsNone(linearOption.parse_args([]).color)
+
+    def test_repeats_must_be_positive(self):
+        with self.assertRaises(SystemExit):
+            linearOption.parse_args(["--color", "color.jpg", "bw", "--repeats", "0"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,14 @@
+import asyncio
+import struct
+import threading
+import time
+from concurrent import futures
 import unittest
 from unittest.mock import patch, MagicMock
+import grpc
 import image_service_pb2_grpc
 import image_service_pb2
+import server
 
 # Пример теста для метода обработки изображений
 class TestImageProcessing(unittest.TestCase):
@@ -33,5 +40,788 @@ class TestImageProcessing(unittest.TestCase):
         self.assertEqual(result, 1)
         mock_compare_images.assert_called_once()  # Проверяем, что метод был вызван
 
+# Вспомогательный клиент: отправляет запрос по протоколу сервера и возвращает индекс
+async def send_request(port, color_image_data, bw_images):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(len(color_image_data).to_bytes(4, 'big') + color_image_data)
+    for bw_image in bw_images:
+        writer.write(len(bw_image).to_bytes(4, 'big') + bw_image)
+    writer.write((0).to_bytes(4, 'big'))
+    await writer.drain()
+    result = int.from_bytes(await reader.readexactly(4), 'big')
+    writer.close()
+    await writer.wait_closed()
+    return result
+
+# Тест асинхронного TCP сервера
+class TestAsyncTcpServer(unittest.IsolatedAsyncioTestCase):
+    async def test_clients_are_served_concurrently(self):
+        def slow_process_images(color_image_data, bw_images, pool, result_cache=None, features=False):
+            time.sleep(0.5)
+            return len(bw_images)
+
+        with patch.object(server, 'process_images', side_effect=slow_process_images), \
+                futures.ThreadPoolExecutor(max_workers=4) as executor:
+            tcp_server = await server.create_tcp_server('127.0.0.1', 0, None, executor, pipeline_chunk_size=0)
+            port = tcp_server.sockets[0].getsockname()[1]
+            async with tcp_server:
+                start_time = time.time()
+                results = await asyncio.gather(
+                    send_request(port, b"color", [b"bw1"]),
+                    send_request(port, b"color", [b"bw1", b"bw2"]),
+                    send_request(port, b"color", [b"bw1", b"bw2", b"bw3"]))
+                elapsed = time.time() - start_time
+
+        self.assertEqual(results, [1, 2, 3])
+        # Три запроса по 0.5 с обработаны параллельно, а не последовательно
+        self.assertLess(elapsed, 1.2)
+
+# Различные ч/б изображения (одинаковые сервер отправил бы кластерам один раз)
+def unique_images(count, start=0):
+    return [b"bw%d" % i for i in range(start, start + count)]
+
+# Тестовый кластер: ищет изображение b"match" и отвечает с задержкой
+class FakeImageService(image_service_pb2_grpc.ImageServiceServicer):
+    def __init__(self, delay=0.3):
+        self.delay = delay
+        self.chunks_received = 0
+        self.calls = 0
+        self.images = 0
+        self.feature_calls = 0
+        self.galleries = {}
+
+    def find_match(self, bw_images):
+        self.calls += 1
+        self.images += len(bw_images)
+        time.sleep(self.delay)
+        return bw_images.index(b"match") if b"match" in bw_images else -1
+
+    def CompareImages(self, request, context):
+        if request.color_histogram:
+            # Режим гистограмм: "гистограммы" сравниваются так же, как изображения
+            self.feature_calls += 1
+            return image_service_pb2.CompareResponse(matching_index=self.find_match(list(request.bw_histograms)))
+        return image_service_pb2.CompareResponse(matching_index=self.find_match(list(request.bw_images)))
+
+    def CompareImagesStream(self, request_iterator, context):
+        bw_images = []
+        for chunk in request_iterator:
+            self.chunks_received += 1
+            self.feature_calls += bool(chunk.color_histogram)
+            bw_images.extend(chunk.bw_images)
+            bw_images.extend(chunk.bw_histograms)
+        return image_service_pb2.CompareResponse(matching_index=self.find_match(bw_images))
+
+    def Ping(self, request, context):
+        return image_service_pb2.PingResponse(message="pong", in_flight=0, workers=10)
+
+    def RegisterGallery(self, request_iterator, context):
+        bw_images = []
+        for chunk in request_iterator:
+            key = (chunk.gallery_id, chunk.shard)
+            bw_images.extend(chunk.bw_images)
+        self.galleries[key] = bw_images
+        return image_service_pb2.GalleryResponse(size=len(bw_images))
+
+    def QueryGallery(self, request, context):
+        bw_images = self.galleries.get((request.gallery_id, request.shard))
+        if bw_images is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, "gallery not found")
+        if request.top_k > 0:
+            # Оценка 1.0 у совпадающих изображений, у остальных убывает с индексом
+            scores = [1.0 if image == b"match" else 0.5 - 0.01 * i for i, image in enumerate(bw_images)]
+            indices = sorted(range(len(scores)), key=lambda i: -scores[i])[:request.top_k]
+            return image_service_pb2.CompareResponse(matching_index=indices[0], indices=indices,
+                                                     scores=[scores[i] for i in indices])
+        return image_service_pb2.CompareResponse(matching_index=self.find_match(bw_images))
+
+# Тестовый кластер старой версии без CompareImagesStream
+class UnaryImageService(FakeImageService):
+    def CompareImagesStream(self, request_iterator, context):
+        context.abort(grpc.StatusCode.UNIMPLEMENTED, "Method not implemented!")
+
+# Тестовый кластер, который отвечает на Ping, но не может обработать запрос
+class BrokenImageService(FakeImageService):
+    def __init__(self, delay=0.3, code=grpc.StatusCode.UNAVAILABLE):
+        super().__init__(delay)
+        self.code = code
+
+    def CompareImages(self, request, context):
+        context.abort(self.code, "broken")
+
+    def CompareImagesStream(self, request_iterator, context):
+        context.abort(self.code, "broken")
+
+def start_fake_cluster(servicer):
+    grpc_server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    image_service_pb2_grpc.add_ImageServiceServicer_to_server(servicer, grpc_server)
+    port = grpc_server.add_insecure_port('127.0.0.1:0')
+    grpc_server.start()
+    return grpc_server, {"ip": "127.0.0.1", "port": port}
+
+# Тест параллельной отправки частей кластерам
+class TestParallelFanOut(unittest.TestCase):
+    def setUp(self):
+        self.grpc_server, cluster = start_fake_cluster(FakeImageService())
+        self.pool = server.ClusterPool([cluster, cluster, cluster])
+        self.pool.warm_up()
+
+    def tearDown(self):
+        self.pool.close()
+        self.grpc_server.stop(None)
+
+    def test_parts_are_processed_in_parallel(self):
+        bw_images = unique_images(9)
+        start_time = time.time()
+        result = server.process_images(b"color", bw_images, self.pool)
+        elapsed = time.time() - start_time
+
+        self.assertEqual(result, -1)
+        # Три части по 0.3 с выполнены одновременно
+        self.assertLess(elapsed, 0.8)
+
+    def test_lowest_global_index_wins(self):
+        # Совпадения в первой (индекс 2) и третьей (индекс 7) частях
+        bw_images = unique_images(2) + [b"match"] + unique_images(4, 2) + [b"match"] + unique_images(1, 6)
+        result = server.process_images(b"color", bw_images, self.pool)
+        # Индекс возвращается клиенту с единицы
+        self.assertEqual(result, 3)
+
+# Тест пула соединений с кластерами
+class TestClusterPool(unittest.TestCase):
+    def test_channels_are_reused_between_requests(self):
+        grpc_server, cluster = start_fake_cluster(FakeImageService(delay=0))
+        pool = server.ClusterPool([cluster])
+        try:
+            self.assertEqual(pool.warm_up(), 1)
+            channel = pool.nodes[0][2]
+            # Частей больше, чем кластеров, и запросов несколько: канал не закрывается
+            for _ in range(3):
+                self.assertEqual(server.process_images(b"color", [b"bw", b"match"], pool), 2)
+            self.assertIs(pool.nodes[0][2], channel)
+        finally:
+            pool.close()
+            grpc_server.stop(None)
+
+    def test_unreachable_cluster_is_reported_by_warm_up(self):
+        pool = server.ClusterPool([{"ip": "127.0.0.1", "port": 1}])
+        try:
+            self.assertEqual(pool.warm_up(timeout=0.5), 0)
+        finally:
+            pool.close()
+
+# Тест распределения изображений по производительности кластеров
+class TestWeightedPartitioning(unittest.TestCase):
+    def setUp(self):
+        self.pool = server.ClusterPool([{"ip": "127.0.0.1", "port": 1}, {"ip": "127.0.0.1", "port": 2}])
+        self.nodes = self.pool.nodes
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_equal_split_without_measurements(self):
+        self.assertEqual(self.pool.shares(self.nodes, 5), [3, 2])
+
+    def test_shares_follow_throughput_and_rtt(self):
+        for node, rate in zip(self.nodes, (300, 100)):
+            self.pool.record_throughput(node, rate, 1.0)
+        self.assertEqual(self.pool.shares(self.nodes, 400), [300, 100])
+
+        # Удаленный кластер теряет часть работы на передачу
+        self.pool.health[self.nodes[1][:2]]["rtt"] = 0.5
+        sizes = self.pool.shares(self.nodes, 400)
+        self.assertEqual(sum(sizes), 400)
+        self.assertGreater(sizes[0], 300)
+
+    def test_pipelined_chunks_follow_throughput_and_rtt(self):
+        for node, rate, rtt in zip(self.nodes, (300, 100), (0.0, 0.5)):
+            self.pool.health[node[:2]].update(healthy=True, rtt=rtt)
+            self.pool.record_throughput(node, rate, 1.0 + rtt)
+        search = server.PipelinedSearch(self.pool, b"color", chunk_size=50)
+        chosen = [search.choose_node(50) for _ in range(16)]
+        # Быстрый ближний кластер получает больше порций, чем при поочередной раздаче
+        self.assertGreater(chosen.count(self.nodes[0]), 12)
+        self.assertIn(self.nodes[1], chosen)
+
+    def test_calibration_measures_clusters(self):
+        grpc_server, cluster = start_fake_cluster(FakeImageService(delay=0.1))
+        pool = server.ClusterPool([cluster])
+        try:
+            pool.warm_up()
+            pool.calibrate([b"color"] + [b"bw"] * 10)
+            self.assertLess(pool.health[("127.0.0.1", cluster["port"])]["throughput"], 110)
+        finally:
+            pool.close()
+            grpc_server.stop(None)
+
+# Тест исключения повторяющихся изображений
+class TestDeduplication(unittest.TestCase):
+    def test_duplicates_are_sent_once(self):
+        servicer = FakeImageService(delay=0)
+        grpc_server, cluster = start_fake_cluster(servicer)
+        pool = server.ClusterPool([cluster])
+        received = []
+        find_match = servicer.find_match
+        servicer.find_match = lambda bw_images: received.extend(bw_images) or find_match(bw_images)
+        try:
+            pool.warm_up()
+            bw_images = [b"a", b"b", b"a", b"b", b"c", b"match", b"c", b"match"]
+            # Сообщается первое вхождение совпадающего изображения
+            self.assertEqual(server.process_images(b"color", bw_images, pool), 6)
+            self.assertEqual(received, [b"a", b"b", b"c", b"match"])
+        finally:
+            pool.close()
+            grpc_server.stop(None)
+
+    def test_index_mapping(self):
+        deduplicator = server.Deduplicator()
+        unique = [image for image in [b"x", b"x", b"y", b"x", b"z"] if deduplicator.add(image)]
+        self.assertEqual(unique, [b"x", b"y", b"z"])
+        self.assertEqual([deduplicator.original_index(r) for r in (1, 2, 3, -1)], [1, 3, 5, -1])
+        self.assertEqual(deduplicator.saved_bytes, 2)
+
+# Тест общей очереди порций
+class TestWorkQueue(unittest.TestCase):
+    def test_fast_cluster_takes_more_chunks(self):
+        fast, slow = FakeImageService(delay=0.01), FakeImageService(delay=0.4)
+        clusters = [start_fake_cluster(fast), start_fake_cluster(slow)]
+        pool = server.ClusterPool([cluster for _, cluster in clusters], scheduling="queue")
+        try:
+            pool.warm_up()
+            bw_images = unique_images(150) + [b"match"] + unique_images(40, 150)
+            self.assertEqual(server.process_images(b"color", bw_images, pool), 151)
+            self.assertGreater(fast.calls, slow.calls)
+        finally:
+            pool.close()
+            for grpc_server, _ in clusters:
+                grpc_server.stop(None)
+
+    def test_failed_cluster_delays_only_its_chunk(self):
+        good_server, good_cluster = start_fake_cluster(FakeImageService(delay=0))
+        broken_server, broken_cluster = start_fake_cluster(BrokenImageService(delay=0))
+        pool = server.ClusterPool([good_cluster, broken_cluster], scheduling="queue")
+        try:
+            pool.warm_up()
+            bw_images = unique_images(100) + [b"match"]
+            self.assertEqual(server.process_images(b"color", bw_images, pool), 101)
+        finally:
+            pool.close()
+            good_server.stop(None)
+            broken_server.stop(None)
+
+# Тест реестра состояния кластеров
+class TestClusterHealth(unittest.TestCase):
+    def test_dead_cluster_is_not_routed(self):
+        grpc_server, cluster = start_fake_cluster(FakeImageService(delay=0))
+        pool = server.ClusterPool([cluster, {"ip": "127.0.0.1", "port": 1}])
+        try:
+            self.assertEqual(pool.warm_up(timeout=0.5), 1)
+            self.assertEqual([node[:2] for node in pool.available()], [("127.0.0.1", cluster["port"])])
+            self.assertIsNotNone(pool.health[("127.0.0.1", cluster["port"])]["rtt"])
+            self.assertEqual(pool.health[("127.0.0.1", cluster["port"])]["workers"], 10)
+        finally:
+            pool.close()
+            grpc_server.stop(None)
+
+    def test_failed_part_is_retried_on_another_cluster(self):
+        good_server, good_cluster = start_fake_cluster(FakeImageService(delay=0))
+        broken_server, broken_cluster = start_fake_cluster(BrokenImageService(delay=0))
+        pool = server.ClusterPool([good_cluster, broken_cluster])
+        try:
+            pool.warm_up()
+            # Совпадение находится во второй части, которую должен был обработать сломанный кластер
+            bw_images = unique_images(3) + [b"match"]
+            self.assertEqual(server.process_images(b"color", bw_images, pool), 4)
+            # Сломанный кластер исключен до следующего успешного Ping
+            self.assertEqual([node[:2] for node in pool.available()], [("127.0.0.1", good_cluster["port"])])
+        finally:
+            pool.close()
+            good_server.stop(None)
+            broken_server.stop(None)
+
+    def test_failed_part_gives_unknown_result(self):
+        broken_server, broken_cluster = start_fake_cluster(BrokenImageService(delay=0))
+        pool = server.ClusterPool([broken_cluster])
+        try:
+            pool.warm_up()
+            self.assertEqual(server.process_images(b"color", [b"bw", b"match"], pool), server.RESULT_UNKNOWN)
+            # Клиент отличает неизвестный результат от "совпадений нет"
+            self.assertEqual(server.encode_index(server.RESULT_UNKNOWN), server.REPLY_UNKNOWN.to_bytes(4, 'big'))
+            self.assertEqual(server.encode_index(-1), (0).to_bytes(4, 'big'))
+        finally:
+            pool.close()
+            broken_server.stop(None)
+
+    def test_request_error_does_not_mark_cluster_failed(self):
+        grpc_server, cluster = start_fake_cluster(BrokenImageService(delay=0, code=grpc.StatusCode.RESOURCE_EXHAUSTED))
+        pool = server.ClusterPool([cluster])
+        try:
+            pool.warm_up()
+            self.assertEqual(server.process_images(b"color", [b"bw", b"match"], pool), server.RESULT_UNKNOWN)
+            # Ошибка относится к запросу, кластер остается доступным
+            self.assertEqual(len(pool.available()), 1)
+        finally:
+            pool.close()
+            grpc_server.stop(None)
+
+    def test_hung_cluster_is_retried_after_deadline(self):
+        hung_server, hung_cluster = start_fake_cluster(FakeImageService(delay=2))
+        good_server, good_cluster = start_fake_cluster(FakeImageService(delay=0))
+        pool = server.ClusterPool([hung_cluster, good_cluster], rpc_timeout=0.5)
+        try:
+            pool.warm_up()
+            pending = [(0, 0, [b"bw", b"match"], pool.nodes[0], pool.compare_async(pool.nodes[0], b"color", [b"bw", b"match"]))]
+            start_time = time.time()
+            self.assertEqual(server.collect_results(pool, b"color", pending), 2)
+            self.assertLess(time.time() - start_time, 1.5)
+        finally:
+            pool.close()
+            hung_server.stop(None)
+            good_server.stop(None)
+
+# Тест досрочного ответа: части с большими индексами отменяются
+class TestEarlyTermination(unittest.TestCase):
+    def setUp(self):
+        self.fast_server, fast_cluster = start_fake_cluster(FakeImageService(delay=0))
+        self.slow_server, slow_cluster = start_fake_cluster(FakeImageService(delay=2))
+        self.pool = server.ClusterPool([fast_cluster, slow_cluster])
+        self.pool.warm_up()
+        self.fast_node, self.slow_node = self.pool.nodes
+
+    def tearDown(self):
+        self.pool.close()
+        self.fast_server.stop(None)
+        self.slow_server.stop(None)
+
+    def dispatch(self, parts):
+        return [(i, offset, part, node, self.pool.compare_async(node, b"color", part))
+                for i, (offset, part, node) in enumerate(parts)]
+
+    def test_higher_parts_are_cancelled_after_match(self):
+        pending = self.dispatch([(0, [b"bw", b"match"], self.fast_node), (2, [b"match", b"bw"], self.slow_node)])
+        start_time = time.time()
+        self.assertEqual(server.collect_results(self.pool, b"color", pending), 2)
+        self.assertLess(time.time() - start_time, 1)
+        self.assertEqual(pending[1][4].code(), grpc.StatusCode.CANCELLED)
+
+    def test_lower_part_is_awaited(self):
+        pending = self.dispatch([(0, [b"bw", b"match"], self.slow_node), (2, [b"match", b"bw"], self.fast_node)])
+        self.assertEqual(server.collect_results(self.pool, b"color", pending), 2)
+
+    def test_answer_finalized_while_part_result_is_read(self):
+        collector = server.ResultCollector(self.pool, b"color")
+
+        class RacingFuture(futures.Future):
+            def result(self, timeout=None):
+                # Другой обратный вызов делает ответ окончательным, пока читается результат этой части
+                collector.resolve(1)
+                return super().result(timeout)
+
+        future = RacingFuture()
+        collector.add(0, 0, [b"bw"], self.fast_node, future)
+        with self.assertNoLogs('concurrent.futures', level='ERROR'):
+            future.set_result(image_service_pb2.CompareResponse(matching_index=-1))
+        self.assertEqual(collector.result(), 1)
+
+# Тест потоковой отправки частей
+class TestStreaming(unittest.TestCase):
+    def test_part_is_streamed_in_chunks(self):
+        servicer = FakeImageService(delay=0)
+        grpc_server, cluster = start_fake_cluster(servicer)
+        pool = server.ClusterPool([cluster], stream_chunk_bytes=10)
+        try:
+            pool.warm_up()
+            bw_images = [image * 4 for image in unique_images(5)] + [b"match"]
+            self.assertEqual(server.process_images(b"color", bw_images, pool), 6)
+            # Цветное изображение и шесть порций по одному изображению
+            self.assertEqual(servicer.chunks_received, 7)
+        finally:
+            pool.close()
+            grpc_server.stop(None)
+
+    def test_falls_back_to_unary_call(self):
+        grpc_server, cluster = start_fake_cluster(UnaryImageService(delay=0))
+        pool = server.ClusterPool([cluster])
+        try:
+            pool.warm_up()
+            self.assertEqual(server.process_images(b"color", [b"bw", b"match"], pool), 2)
+            self.assertFalse(pool.supports_streaming(pool.nodes[0]))
+            self.assertEqual(len(pool.available()), 1)
+        finally:
+            pool.close()
+            grpc_server.stop(None)
+
+# Тест конвейерной обработки во время загрузки
+class TestPipelinedIngest(unittest.IsolatedAsyncioTestCase):
+    async def test_chunks_are_dispatched_during_upload(self):
+        servicer = FakeImageService(delay=0)
+        grpc_server, cluster = start_fake_cluster(servicer)
+        pool = server.ClusterPool([cluster, cluster])
+        pool.warm_up()
+        try:
+            with futures.ThreadPoolExecutor(max_workers=4) as executor:
+                tcp_server = await server.create_tcp_server('127.0.0.1', 0, pool, executor, pipeline_chunk_size=2)
+                port = tcp_server.sockets[0].getsockname()[1]
+                async with tcp_server:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                    writer.write((5).to_bytes(4, 'big') + b"color")
+                    for bw_image in unique_images(3) + [b"match"]:
+                        writer.write(len(bw_image).to_bytes(4, 'big') + bw_image)
+                    await writer.drain()
+
+                    # Загрузка еще не завершена, а две порции уже у кластера
+                    await asyncio.sleep(0.3)
+                    self.assertEqual(servicer.chunks_received, 4)
+
+                    writer.write((3).to_bytes(4, 'big') + b"bw3" + (0).to_bytes(4, 'big'))
+                    await writer.drain()
+                    result = int.from_bytes(await reader.readexactly(4), 'big')
+                    # Ответ мог прийти до конца загрузки: ждем, пока сервер ее дочитает и закроет соединение
+                    writer.write_eof()
+                    self.assertEqual(await reader.read(), b"")
+                    writer.close()
+                    await writer.wait_closed()
+            self.assertEqual(result, 4)
+        finally:
+            pool.close()
+            grpc_server.stop(None)
+
+    async def test_images_are_hashed_off_the_event_loop(self):
+        threads = []
+        image_digests = server.image_digests
+
+        def recording_digests(bw_images):
+            threads.append(threading.get_ident())
+            return image_digests(bw_images)
+
+        pool = server.ClusterPool([])
+        try:
+            search = server.PipelinedSearch(pool, b"color", chunk_size=2)
+            with patch.object(server, 'image_digests', side_effect=recording_digests):
+                await server.add_to_search(search, unique_images(3) + [b"bw0"], None)
+            self.assertEqual(len(threads), 1)
+            self.assertNotEqual(threads[0], threading.get_ident())
+            self.assertEqual((search.deduplicator.total, len(search.deduplicator.first_indices)), (4, 3))
+        finally:
+            pool.close()
+
+    async def test_queue_scheduling_during_upload(self):
+        fast, slow = FakeImageService(delay=0.01), FakeImageService(delay=0.4)
+        clusters = [start_fake_cluster(fast), start_fake_cluster(slow)]
+        pool = server.ClusterPool([cluster for _, cluster in clusters], scheduling="queue")
+        pool.warm_up()
+        try:
+            with futures.ThreadPoolExecutor(max_workers=4) as executor:
+                tcp_server = await server.create_tcp_server('127.0.0.1', 0, pool, executor, pipeline_chunk_size=8)
+                port = tcp_server.sockets[0].getsockname()[1]
+                async with tcp_server:
+                    bw_images = unique_images(150) + [b"match"] + unique_images(40, 150)
+                    self.assertEqual(await send_request(port, b"color", bw_images), 151)
+                    # Загрузка короче одной порции очереди
+                    self.assertEqual(await send_request(port, b"color", [b"bw0", b"match"]), 2)
+                    self.assertEqual(await send_request(port, b"color", [b"bw0"]), 0)
+            # Порции забираются из общей очереди: быстрый кластер обработал больше изображений
+            self.assertGreater(fast.images, slow.images)
+        finally:
+            pool.close()
+            for grpc_server, _ in clusters:
+                grpc_server.stop(None)
+
+# Тест галерей: изображения загружаются один раз, запрос передает только эталон
+class TestGalleries(unittest.IsolatedAsyncioTestCase):
+    async def send_gallery_message(self, port, message_type, frames):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(message_type.to_bytes(4, 'big'))
+        for frame in frames:
+            writer.write(len(frame).to_bytes(4, 'big') + frame)
+        if message_type == server.MSG_REGISTER_GALLERY:
+            writer.write((0).to_bytes(4, 'big'))
+        await writer.drain()
+        if message_type == server.MSG_TOP_K_GALLERY:
+            count = int.from_bytes(await reader.readexactly(4), 'big')
+            result = [struct.unpack('>If', await reader.readexactly(8)) for _ in range(count)]
+        else:
+            result = int.from_bytes(await reader.readexactly(4), 'big')
+        writer.close()
+        await writer.wait_closed()
+        return result
+
+    async def test_register_and_query_gallery(self):
+        servicers = [FakeImageService(delay=0), FakeImageService(delay=0)]
+        clusters = [start_fake_cluster(servicer) for servicer in servicers]
+        pool = server.ClusterPool([cluster for _, cluster in clusters])
+        pool.warm_up()
+        try:
+            with futures.ThreadPoolExecutor(max_workers=4) as executor:
+                tcp_server = await server.create_tcp_server('127.0.0.1', 0, pool, executor,
+                                                            galleries=server.GalleryRegistry(pool))
+                port = tcp_server.sockets[0].getsockname()[1]
+                async with tcp_server:
+                    images = [b"bw"] * 6 + [b"match", b"bw"]
+                    size = await self.send_gallery_message(port, server.MSG_REGISTER_GALLERY, [b"g1"] + images)
+                    self.assertEqual(size, 8)
+                    # Галерея разделена между двумя кластерами
+                    self.assertEqual([len(s.galleries) for s in servicers], [1, 1])
+
+                    query = [b"g1", b"color"]
+                    self.assertEqual(await self.send_gallery_message(port, server.MSG_QUERY_GALLERY, query), 7)
+
+                    # Кластер перезапустился и потерял свою часть: сервер загружает ее заново
+                    servicers[1].galleries.clear()
+                    self.assertEqual(await self.send_gallery_message(port, server.MSG_QUERY_GALLERY, query), 7)
+
+                    # Ответы частей объединяются по оценке, индексы глобальные
+                    top = await self.send_gallery_message(port, server.MSG_TOP_K_GALLERY,
+                                                          query + [(3).to_bytes(4, 'big')])
+                    self.assertEqual([index for index, _ in top], [7, 1, 5])
+                    self.assertAlmostEqual(top[0][1], 1.0)
+
+                    unknown = [b"g2", b"color"]
+                    self.assertEqual(await self.send_gallery_message(port, server.MSG_QUERY_GALLERY, unknown), 0)
+        finally:
+            pool.close()
+            for grpc_server, _ in clusters:
+                grpc_server.stop(None)
+
+# Тест досрочного ответа клиенту во время загрузки
+class TestEarlyReply(unittest.IsolatedAsyncioTestCase):
+    async def test_reply_is_sent_before_upload_ends(self):
+        grpc_server, cluster = start_fake_cluster(FakeImageService(delay=0))
+        pool = server.ClusterPool([cluster])
+        pool.warm_up()
+        try:
+            with futures.ThreadPoolExecutor(max_workers=4) as executor:
+                tcp_server = await server.create_tcp_server('127.0.0.1', 0, pool, executor, pipeline_chunk_size=2)
+                port = tcp_server.sockets[0].getsockname()[1]
+                async with tcp_server:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                    writer.write((5).to_bytes(4, 'big') + b"color")
+                    for bw_image in [b"bw", b"match"]:
+                        writer.write(len(bw_image).to_bytes(4, 'big') + bw_image)
+                    await writer.drain()
+
+                    # Совпадение в первой порции: ответ приходит до конца загрузки
+                    result = int.from_bytes(await asyncio.wait_for(reader.readexactly(4), 2), 'big')
+                    self.assertEqual(result, 2)
+
+                    # Остаток загрузки сервер дочитывает
+                    for bw_image in [b"bw", b"match", b"bw"]:
+                        writer.write(len(bw_image).to_bytes(4, 'big') + bw_image)
+                    writer.write((0).to_bytes(4, 'big'))
+                    await writer.drain()
+
+                    # Следующий запрос идет по тому же соединению
+                    writer.write((5).to_bytes(4, 'big') + b"color")
+                    for bw_image in [b"bw", b"bw1", b"match"]:
+                        writer.write(len(bw_image).to_bytes(4, 'big') + bw_image)
+                    writer.write((0).to_bytes(4, 'big'))
+                    await writer.drain()
+                    result = int.from_bytes(await asyncio.wait_for(reader.readexactly(4), 2), 'big')
+                    self.assertEqual(result, 3)
+
+                    # Клиент закрывает соединение между запросами
+                    writer.write_eof()
+                    self.assertEqual(await reader.read(), b"")
+                    writer.close()
+                    await writer.wait_closed()
+        finally:
+            pool.close()
+            grpc_server.stop(None)
+
+# Тест постоянного соединения: несколько запросов подряд и отмена запроса клиентом
+class TestPersistentConnection(unittest.IsolatedAsyncioTestCase):
+    async def test_requests_share_connection(self):
+        servicer = FakeImageService(delay=0)
+        grpc_server, cluster = start_fake_cluster(servicer)
+        pool = server.ClusterPool([cluster])
+        pool.warm_up()
+        try:
+            with futures.ThreadPoolExecutor(max_workers=4) as executor:
+                for pipeline_chunk_size in (0, 2):
+                    tcp_server = await server.create_tcp_server('127.0.0.1', 0, pool, executor, pipeline_chunk_size)
+                    port = tcp_server.sockets[0].getsockname()[1]
+                    async with tcp_server:
+                        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                        results = []
+                        for bw_images in (unique_images(2) + [b"match"], unique_images(3), [b"match"]):
+                            writer.write((5).to_bytes(4, 'big') + b"color")
+                            for bw_image in bw_images:
+                                writer.write(len(bw_image).to_bytes(4, 'big') + bw_image)
+                            writer.write((0).to_bytes(4, 'big'))
+                            await writer.drain()
+                            results.append(int.from_bytes(await asyncio.wait_for(reader.readexactly(4), 2), 'big'))
+                        writer.close()
+                        await writer.wait_closed()
+                    self.assertEqual(results, [3, 0, 1])
+        finally:
+            pool.close()
+            grpc_server.stop(None)
+
+    async def test_cancelled_upload_is_not_processed(self):
+        servicer = FakeImageService(delay=0)
+        grpc_server, cluster = start_fake_cluster(servicer)
+        pool = server.ClusterPool([cluster])
+        pool.warm_up()
+        try:
+            with futures.ThreadPoolExecutor(max_workers=4) as executor:
+                tcp_server = await server.create_tcp_server('127.0.0.1', 0, pool, executor, pipeline_chunk_size=8)
+                port = tcp_server.sockets[0].getsockname()[1]
+                async with tcp_server:
+                    # Клиент обрывает соединение посреди загрузки
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                    writer.write((5).to_bytes(4, 'big') + b"color")
+                    for bw_image in unique_images(3):
+                        writer.write(len(bw_image).to_bytes(4, 'big') + bw_image)
+                    await writer.drain()
+                    writer.close()
+                    await writer.wait_closed()
+                    await asyncio.sleep(0.2)
+                    self.assertEqual(servicer.calls, 0)
+
+                    # Сервер продолжает обслуживать новые соединения
+                    self.assertEqual(await send_request(port, b"color", [b"match"]), 1)
+        finally:
+            pool.close()
+            grpc_server.stop(None)
+
+# Тест режима гистограмм: клиент передает гистограммы вместо изображений
+class TestFeatureRequests(unittest.IsolatedAsyncioTestCase):
+    async def check_features(self, pipeline_chunk_size, streaming):
+        servicer = FakeImageService(delay=0)
+        grpc_server, cluster = start_fake_cluster(servicer)
+        pool = server.ClusterPool([cluster], streaming=streaming)
+        pool.warm_up()
+        try:
+            with futures.ThreadPoolExecutor(max_workers=4) as executor:
+                tcp_server = await server.create_tcp_server('127.0.0.1', 0, pool, executor, pipeline_chunk_size)
+                port = tcp_server.sockets[0].getsockname()[1]
+                async with tcp_server:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                    writer.write(server.MSG_COMPARE_FEATURES.to_bytes(4, 'big'))
+                    for frame in [b"reference"] + unique_images(3) + [b"match", b"bw0"]:
+                        writer.write(len(frame).to_bytes(4, 'big') + frame)
+                    writer.write((0).to_bytes(4, 'big'))
+                    await writer.drain()
+                    result = int.from_bytes(await reader.readexactly(4), 'big')
+                    writer.close()
+                    await writer.wait_closed()
+            self.assertEqual(result, 4)
+            self.assertGreater(servicer.feature_calls, 0)
+        finally:
+            pool.close()
+            grpc_server.stop(None)
+
+    async def test_features_are_forwarded(self):
+        await self.check_features(pipeline_chunk_size=2, streaming=True)
+        await self.check_features(pipeline_chunk_size=0, streaming=False)
+
+# Тест кэша ответов: повторный запрос не доходит до кластеров
+class TestResultCache(unittest.IsolatedAsyncioTestCase):
+    def test_repeated_request_is_served_from_cache(self):
+        servicer = FakeImageService(delay=0)
+        grpc_server, cluster = start_fake_cluster(servicer)
+        pool = server.ClusterPool([cluster])
+        cache = server.ResultCache()
+        try:
+            pool.warm_up()
+            bw_images = unique_images(3) + [b"match", b"bw0"]
+            self.assertEqual(server.process_images(b"color", bw_images, pool, cache), 4)
+            calls = servicer.calls
+            self.assertEqual(server.process_images(b"color", bw_images, pool, cache), 4)
+            self.assertEqual(servicer.calls, calls)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # Другой порядок изображений - другой запрос
+            self.assertEqual(server.process_images(b"color", bw_images[::-1], pool, cache), 2)
+            self.assertGreater(servicer.calls, calls)
+        finally:
+            pool.close()
+            grpc_server.stop(None)
+
+    async def test_pipelined_request_is_served_from_cache(self):
+        servicer = FakeImageService(delay=0)
+        grpc_server, cluster = start_fake_cluster(servicer)
+        pool = server.ClusterPool([cluster])
+        pool.warm_up()
+        cache = server.ResultCache()
+        try:
+            with futures.ThreadPoolExecutor(max_workers=4) as executor:
+                tcp_server = await server.create_tcp_server('127.0.0.1', 0, pool, executor, pipeline_chunk_size=8,
+                                                            result_cache=cache)
+                port = tcp_server.sockets[0].getsockname()[1]
+                async with tcp_server:
+                    bw_images = unique_images(2) + [b"bw0", b"match"]
+                    results = [await send_request(port, b"color", bw_images) for _ in range(2)]
+            self.assertEqual(results, [4, 4])
+            self.assertEqual(servicer.calls, 1)
+            self.assertEqual(cache.hits, 1)
+        finally:
+            pool.close()
+            grpc_server.stop(None)
+
+    async def test_pipelined_repeat_does_not_reach_clusters(self):
+        servicer = FakeImageService(delay=0.05)
+        grpc_server, cluster = start_fake_cluster(servicer)
+        pool = server.ClusterPool([cluster])
+        pool.warm_up()
+        cache = server.ResultCache()
+        try:
+            with futures.ThreadPoolExecutor(max_workers=4) as executor:
+                tcp_server = await server.create_tcp_server('127.0.0.1', 0, pool, executor, pipeline_chunk_size=8,
+                                                            result_cache=cache)
+                port = tcp_server.sockets[0].getsockname()[1]
+                async with tcp_server:
+                    # Несколько полных порций уходят кластеру еще во время первой загрузки
+                    bw_images = unique_images(35) + [b"match"] + unique_images(5, 35)
+                    self.assertEqual(await send_request(port, b"color", bw_images), 36)
+                    calls = servicer.calls
+                    self.assertGreater(calls, 1)
+
+                    self.assertEqual(await send_request(port, b"color", bw_images), 36)
+                    self.assertEqual(servicer.calls, calls)
+                    self.assertEqual(cache.hits, 1)
+
+                    # То же начало, другой конец: запрос обрабатывается кластерами после загрузки
+                    other_images = unique_images(20) + [b"match"]
+                    self.assertEqual(await send_request(port, b"color", other_images), 21)
+                    self.assertGreater(servicer.calls, calls)
+        finally:
+            pool.close()
+            grpc_server.stop(None)
+
+    def test_prefixes_follow_entries(self):
+        cache = server.ResultCache(max_entries=1)
+        cache.put(b"a", 1, prefix=b"p")
+        self.assertTrue(cache.has_prefix(b"p"))
+        cache.put(b"b", 2)
+        self.assertFalse(cache.has_prefix(b"p"))
+        self.assertEqual(cache.prefixes, {})
+
+    def test_entries_expire(self):
+        cache = server.ResultCache(ttl=0.05)
+        cache.put(b"key", 3)
+        self.assertEqual(cache.get(b"key"), 3)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get(b"key"))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = server.ResultCache(max_entries=2)
+        cache.put(b"a", 1)
+        cache.put(b"b", 2)
+        cache.get(b"a")
+        cache.put(b"c", 3)
+        self.assertIsNone(cache.get(b"b"))
+        self.assertEqual((cache.get(b"a"), cache.get(b"c")), (1, 3))
+
+        # Ограничение по памяти
+        small = server.ResultCache(max_bytes=3 * small_entry_bytes())
+        for i in range(10):
+            small.put(bytes([i]), i)
+        self.assertEqual(len(small.entries), 3)
+        self.assertEqual(small.stats()["evictions"], 7)
+
+def small_entry_bytes():
+    return server.ResultCache().entry_bytes(b"x")
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,10 @@
 @echo off
-echo Starting cluster.py in a new window...
-start cmd /k "python cluster.py"
-echo cluster.py started. 
+echo Writing the node list to config.json...
+python cluster.py --count 1 --write-config --config-only
+
+echo Starting 1 cluster node(s) in a new window...
+start cmd /k "python cluster.py --count 1"
+echo cluster.py started.
 
 echo Starting server.py in a new window...
 start cmd /k "python server.py"
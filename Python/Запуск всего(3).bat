@@ -1,15 +1,10 @@
 @echo off
-echo Starting cluster.py in a new window...
-start cmd /k "python cluster.py"
-echo cluster.py started.
-
-echo Starting cluster2.py in a new window...
-start cmd /k "python cluster2.py"
-echo cluster2.py started.
+echo Writing the node list to config.json...
+python cluster.py --count 3 --write-config --config-only
 
-echo Starting cluster3.py in a new window...
-start cmd /k "python cluster3.py"
-echo cluster3.py started.
+echo Starting 3 cluster node(s) in a new window...
+start cmd /k "python cluster.py --count 3"
+echo cluster.py started.
 
 echo Starting server.py in a new window...
 start cmd /k "python server.py"